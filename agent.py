@@ -1,49 +1,135 @@
 import re
+from typing import NamedTuple
 
 HELP_TEXT = (
     "Try:\n"
     "• I studied ...\n"
     "• recent\n"
     "• recollect\n"
+    "• search ...\n"
+    "• next (an item to review)\n"
     "• add resource (then paste a link)\n"
     "• cancel"
 )
 
+class Intent(NamedTuple):
+    name: str                 # "none" when nothing matched
+    slots: dict[str, str]     # named groups captured by the matching pattern
+
+NO_INTENT = Intent("none", {})
+_SLOT_GROUP = re.compile(r"\(\?P<(\w+)>")
+
+class IntentRouter:
+    """
+    Single-pass intent matcher.
+
+    Text is normalised once; exact phrases are a dict lookup, and every pattern
+    is folded into one precompiled alternation, tried in registration order.
+    Named groups in a pattern come back as the intent's slots.
+    """
+    def __init__(self):
+        self._exact: dict[str, str] = {}
+        self._patterns: list[tuple[str, str]] = []
+        self._combined: re.Pattern | None = None
+        self._slots: dict[str, tuple[str, tuple]] = {}   # alternation group -> (intent, ((group, slot), ...))
+
+    def exact(self, name: str, *phrases: str):
+        for p in phrases:
+            self._exact.setdefault(p.strip().lower(), name)
+
+    def pattern(self, name: str, regex: str):
+        """regex must match the whole (stripped) message; matched case-insensitively."""
+        self._patterns.append((name, regex))
+        self._combined = None
+
+    def _compile(self) -> re.Pattern:
+        alts = []
+        for i, (name, regex) in enumerate(self._patterns):
+            group, slots = f"i{i}", {}
+
+            def rename(m, i=i, slots=slots):
+                # group names must be unique across the whole alternation
+                slots[f"i{i}_{m.group(1)}"] = m.group(1)
+                return f"(?P<i{i}_{m.group(1)}>"
+
+            body = _SLOT_GROUP.sub(rename, regex)
+            alts.append(f"(?P<{group}>{body})")
+            self._slots[group] = (name, tuple(slots.items()))
+        return re.compile("|".join(alts), re.I)
+
+    def route(self, text: str) -> Intent:
+        t = (text or "").strip()
+        name = self._exact.get(t.lower())
+        if name:
+            return Intent(name, {})
+        if self._combined is None:
+            self._combined = self._compile()
+        m = self._combined.fullmatch(t)
+        if not m:
+            return NO_INTENT
+        name, slots = self._slots[m.lastgroup]
+        found = {}
+        for group, slot in slots:
+            value = m.group(group)
+            if value:
+                found[slot] = value.strip()
+        return Intent(name, found)
+
+router = IntentRouter()
+router.exact("help", "help", "/help", "menu")
+router.exact("cancel", "cancel", "/cancel")
+router.exact("recent", "recent", "/recent")
+router.exact("recollect", "recollect", "/recollect", "random")
+router.exact("next", "next", "/next")
+# prefix-anchored patterns first: they fail on the first character, the "contains" ones scan the text
+router.pattern("add_resource", r"add resource(?s:.*?(?P<url>https?://\S+))?(?s:.*)")
+router.pattern("search", r"/?(?:search|find)\s+(?P<query>.+)")
+router.pattern("study", r"i\s+(?:studied|learned)\s+(?P<topic>.+)")
+router.pattern("recent", r"(?s:.*?what did i study recently.*)")
+router.pattern("recollect", r"(?s:.*?random note.*)")
+
+route = router.route
+
+_URL_RE = re.compile(r"(https?://\S+)", re.I)
+
 def norm(text: str) -> str:
     return (text or "").strip()
 
+# Single-intent checks, kept for callers that only care about one intent
 def is_help(text: str) -> bool:
-    t = text.lower().strip()
-    return t in {"help", "/help", "menu"}
+    return route(text).name == "help"
 
 def is_recent(text: str) -> bool:
-    t = text.lower()
-    return t in {"recent", "/recent"} or "what did i study recently" in t
+    return route(text).name == "recent"
 
 def is_recollect(text: str) -> bool:
-    t = text.lower().strip()
-    return t in {"recollect", "/recollect", "random"} or "random note" in t
+    return route(text).name == "recollect"
 
 def is_add_resource(text: str) -> bool:
-    t = text.lower().strip()
-    return t == "add resource" or t.startswith("add resource")
+    return route(text).name == "add_resource"
 
 def is_cancel(text: str) -> bool:
-    return text.lower().strip() in {"cancel", "/cancel"}
+    return route(text).name == "cancel"
 
 def extract_study_topic(text: str):
     # "I studied EOQ", "I learned about EOQ"
-    m = re.match(r"^i\s+(studied|learned)\s+(.+)$", text, flags=re.I)
-    return m.group(2).strip() if m else None
+    intent = route(text)
+    return intent.slots.get("topic") if intent.name == "study" else None
+
+def extract_search_query(text: str):
+    # "search EOQ", "/search safety stock", "find reorder point"
+    intent = route(text)
+    return intent.slots.get("query") if intent.name == "search" else None
 
 def extract_url(text: str):
-    m = re.search(r"(https?://\S+)", text, flags=re.I)
+    m = _URL_RE.search(text or "")
     return m.group(1) if m else None
 
 async def send_recall_prompt(chat_id: str, item: dict, tg_send):
     """
     Sends a recall-style prompt for spaced repetition.
     Expects item to have: topic, ts, and optionally notes.
+    Returns whatever tg_send returns.
     """
     topic = item.get("topic", "Unknown topic")
     ts = item.get("ts", "")
@@ -58,4 +144,4 @@ async def send_recall_prompt(chat_id: str, item: dict, tg_send):
         "_Reply when done, or type `next`._"
     )
 
-    await tg_send(chat_id, message)
+    return await tg_send(chat_id, message)
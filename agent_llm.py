@@ -1,10 +1,19 @@
-import os, json
+import os, re, json, asyncio, time
 import httpx
 
+import metrics
+
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "").strip()
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1-mini").strip()
 
-API_URL = "https://api.openai.com/v1/responses"
+API_URL = os.getenv("OPENAI_API_URL", "https://api.openai.com/v1/responses").strip()
+
+# Cap on concurrent upstream calls, and the time budget per call (queueing included)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_TIMEOUT_SEC = float(os.getenv("LLM_TIMEOUT_SEC", "25"))
+
+_client: httpx.AsyncClient | None = None
+_sem = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
 
 def _headers():
     return {
@@ -12,15 +21,55 @@ def _headers():
         "Content-Type": "application/json",
     }
 
-async def llm_generate_quiz(topic: str, n: int = 5) -> list[dict]:
-    """
-    Returns: [{"q": "...", "ideal": "...(short outline)", "tags": ["..."]}, ...]
-    """
-    if not OPENAI_API_KEY:
-        # Safe fallback: deterministic non-LLM questions
-        return [{"q": f"Explain {topic} in 3 bullet points.", "ideal": "Definition + why it matters + example", "tags": ["fallback"]}]
+def saturated() -> bool:
+    """True when every LLM slot is taken (new calls would queue)."""
+    return _sem.locked()
 
-    prompt = f"""
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=LLM_TIMEOUT_SEC,
+            limits=httpx.Limits(max_connections=LLM_MAX_CONCURRENCY, max_keepalive_connections=LLM_MAX_CONCURRENCY),
+        )
+    return _client
+
+async def aclose():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def _output_text(data: dict) -> str:
+    # Responses API returns content in output items; we concatenate the text blocks.
+    text = ""
+    for item in data.get("output", []):
+        for c in item.get("content", []):
+            if c.get("type") in ("output_text", "text"):
+                text += c.get("text", "")
+    return text.strip()
+
+async def _respond(system: str, prompt: str, timeout: float | None = None) -> str:
+    """One Responses API call under the global concurrency cap; returns the output text."""
+    payload = {
+        "model": OPENAI_MODEL,
+        "input": [
+            {"role": "system", "content": system},
+            {"role": "user", "content": prompt.strip()},
+        ],
+    }
+
+    async def call():
+        async with _sem:
+            r = await _get_client().post(API_URL, headers=_headers(), json=payload)
+            r.raise_for_status()
+            return r.json()
+
+    data = await asyncio.wait_for(call(), timeout or LLM_TIMEOUT_SEC)
+    return _output_text(data)
+
+def _quiz_prompt(topic: str, n: int) -> str:
+    return f"""
 Create a short quiz on the topic: {topic}
 
 Return ONLY valid JSON with this exact schema:
@@ -36,30 +85,145 @@ Rules:
 - Keep each question answerable in <90 seconds.
 """
 
+@metrics.timed(metrics.llm_seconds, metrics.llm_errors, "generate_quiz")
+async def llm_generate_quiz(topic: str, n: int = 5) -> list[dict]:
+    """
+    Returns: [{"q": "...", "ideal": "...(short outline)", "tags": ["..."]}, ...]
+    """
+    if not OPENAI_API_KEY:
+        # Safe fallback: deterministic non-LLM questions
+        return [{"q": f"Explain {topic} in 3 bullet points.", "ideal": "Definition + why it matters + example", "tags": ["fallback"]}]
+
+    prompt = _quiz_prompt(topic, n)
+
+    text = await _respond("You generate quizzes and must output strict JSON only.", prompt)
+    obj = json.loads(text)
+    return obj["items"]
+
+_ITEMS_START = re.compile(r'"items"\s*:\s*\[')
+
+class _ItemStream:
+    """
+    Incremental parser for a streamed {"items": [{...}, {...}]} document.
+    feed() takes raw text deltas and returns the item objects completed so far.
+    """
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.in_items = False
+        self.done = False
+        self.depth = 0
+        self.start = 0
+        self.in_str = False
+        self.esc = False
+
+    def feed(self, chunk: str) -> list[dict]:
+        out = []
+        self.buf += chunk
+        if not self.in_items:
+            m = _ITEMS_START.search(self.buf)
+            if not m:
+                return out
+            self.in_items, self.buf, self.pos = True, self.buf[m.end():], 0
+        while not self.done and self.pos < len(self.buf):
+            ch = self.buf[self.pos]
+            if self.in_str:
+                if self.esc:
+                    self.esc = False
+                elif ch == "\\":
+                    self.esc = True
+                elif ch == '"':
+                    self.in_str = False
+            elif ch == '"':
+                self.in_str = True
+            elif ch == "{":
+                if self.depth == 0:
+                    self.start = self.pos
+                self.depth += 1
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    out.append(json.loads(self.buf[self.start:self.pos + 1]))
+                    self.buf, self.pos = self.buf[self.pos + 1:], -1
+            elif ch == "]" and self.depth == 0:
+                self.done = True
+            self.pos += 1
+        return out
+
+async def llm_stream_quiz(topic: str, n: int = 5):
+    """
+    Streaming variant of llm_generate_quiz: an async generator that yields each
+    {"q", "ideal", "tags"} item as soon as its JSON object is complete in the
+    server-sent event stream, instead of waiting for the whole quiz.
+    """
+    if not OPENAI_API_KEY:
+        for item in await llm_generate_quiz(topic, n):
+            yield item
+        return
+
     payload = {
         "model": OPENAI_MODEL,
+        "stream": True,
         "input": [
             {"role": "system", "content": "You generate quizzes and must output strict JSON only."},
-            {"role": "user", "content": prompt.strip()},
+            {"role": "user", "content": _quiz_prompt(topic, n).strip()},
         ],
     }
 
-    async with httpx.AsyncClient(timeout=25) as client:
-        r = await client.post(API_URL, headers=_headers(), json=payload)
-        r.raise_for_status()
-        data = r.json()
+    parser = _ItemStream()
+    started, first = time.perf_counter(), True
+    await asyncio.wait_for(_sem.acquire(), LLM_TIMEOUT_SEC)
+    try:
+        async with _get_client().stream("POST", API_URL, headers=_headers(), json=payload) as r:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                # SSE: we only need the data lines; each carries a typed JSON event
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if not data or data == "[DONE]":
+                    continue
+                event = json.loads(data)
+                kind = event.get("type", "")
+                if kind == "response.output_text.delta":
+                    for item in parser.feed(event.get("delta", "")):
+                        if first:
+                            # what the user waits on before question 1
+                            metrics.llm_seconds.observe(time.perf_counter() - started, "stream_quiz_first_item")
+                            first = False
+                        yield item
+                elif kind in ("error", "response.failed"):
+                    raise RuntimeError(f"quiz stream failed: {event}")
+                elif kind == "response.completed":
+                    break
+    except Exception:
+        metrics.llm_errors.inc("stream_quiz")
+        raise
+    finally:
+        _sem.release()
+        metrics.llm_seconds.observe(time.perf_counter() - started, "stream_quiz")
 
-    # Responses API returns content in output items; we’ll extract the first text block.
-    text = ""
-    for item in data.get("output", []):
-        for c in item.get("content", []):
-            if c.get("type") in ("output_text", "text"):
-                text += c.get("text", "")
+def _checked_grade(raw) -> dict:
+    """A grade from the model with "score" as an int 0-10; ValueError if it isn't one."""
+    if not isinstance(raw, dict):
+        raise ValueError("grade is not an object")
+    score = raw.get("score")
+    # JSON numbers like 7.0 are fine; bools, strings and fractions are not
+    if isinstance(score, bool) or not isinstance(score, (int, float)) or score != int(score) or not 0 <= score <= 10:
+        raise ValueError(f"bad score: {score!r}")
+    return {**raw, "score": int(score)}
 
-    text = text.strip()
-    obj = json.loads(text)
-    return obj["items"]
+def _ungraded(ideal: str) -> dict:
+    # stands in for an answer that couldn't be graded; score None means "don't record a grade"
+    return {
+        "score": None,
+        "verdict": "Couldn't grade this answer right now.",
+        "what_was_good": [],
+        "what_to_improve": [],
+        "model_answer": ideal,
+    }
 
+@metrics.timed(metrics.llm_seconds, metrics.llm_errors, "grade_answer")
 async def llm_grade_answer(topic: str, question: str, ideal: str, user_answer: str) -> dict:
     """
     Returns:
@@ -102,23 +266,70 @@ Return ONLY valid JSON with exactly:
 }}
 """
 
-    payload = {
-        "model": OPENAI_MODEL,
-        "input": [
-            {"role": "system", "content": "You are a strict evaluator. Output strict JSON only."},
-            {"role": "user", "content": prompt.strip()},
-        ],
-    }
+    text = await _respond("You are a strict evaluator. Output strict JSON only.", prompt)
+    return _checked_grade(json.loads(text))
 
-    async with httpx.AsyncClient(timeout=25) as client:
-        r = await client.post(API_URL, headers=_headers(), json=payload)
-        r.raise_for_status()
-        data = r.json()
+@metrics.timed(metrics.llm_seconds, metrics.llm_errors, "grade_answers")
+async def llm_grade_answers(topic: str, items: list[dict]) -> list[dict]:
+    """
+    Grades a whole quiz in one call.
+    items: [{"question": ..., "ideal": ..., "user_answer": ...}]
+    Returns one llm_grade_answer-shaped dict per item, in the same order.
+    Items the batch reply doesn't cover or scores out of range (or a failed
+    call, or an unparseable reply) fall back to per-item grading; an item
+    that fails that too comes back with score None.
+    """
+    if not items:
+        return []
+    if not OPENAI_API_KEY:
+        return [await llm_grade_answer(topic, it["question"], it["ideal"], it["user_answer"]) for it in items]
 
-    text = ""
-    for item in data.get("output", []):
-        for c in item.get("content", []):
-            if c.get("type") in ("output_text", "text"):
-                text += c.get("text", "")
+    batch = [{"idx": i, "question": it["question"], "ideal": it["ideal"], "user_answer": it["user_answer"]}
+             for i, it in enumerate(items)]
+    prompt = f"""
+Topic: {topic}
+
+Below is a JSON list of quiz questions, each with an ideal answer outline and the user's answer:
+{json.dumps(batch, ensure_ascii=False, indent=1)}
+
+Grade each user answer strictly vs its ideal outline.
+Return ONLY valid JSON with exactly:
+{{
+  "results": [
+    {{
+      "idx": <idx from the input>,
+      "score": 0-10,
+      "verdict": "one sentence",
+      "what_was_good": ["..."],
+      "what_to_improve": ["..."],
+      "model_answer": "a short corrected answer (max 6 lines)"
+    }}
+  ]
+}}
+"""
+
+    graded: dict[int, dict] = {}
+    try:
+        text = await _respond("You are a strict evaluator grading a batch of answers. Output strict JSON only.", prompt)
+        for r in json.loads(text).get("results", []):
+            if isinstance(r, dict) and isinstance(r.get("idx"), int) and 0 <= r["idx"] < len(items):
+                try:
+                    graded[r["idx"]] = _checked_grade({k: v for k, v in r.items() if k != "idx"})
+                except ValueError:
+                    pass
+    except (ValueError, AttributeError, TypeError) as e:
+        print("Batch grading parse error, grading per item:", repr(e))
+    except (httpx.HTTPError, asyncio.TimeoutError) as e:
+        print("Batch grading call failed, grading per item:", repr(e))
 
-    return json.loads(text.strip())
+    missing = [i for i in range(len(items)) if i not in graded]
+    if missing:
+        singles = await asyncio.gather(*[
+            llm_grade_answer(topic, items[i]["question"], items[i]["ideal"], items[i]["user_answer"]) for i in missing
+        ], return_exceptions=True)
+        for i, single in zip(missing, singles):
+            if isinstance(single, Exception):
+                print(f"Grading error for item {i}:", repr(single))
+                single = _ungraded(items[i]["ideal"])
+            graded[i] = single
+    return [graded[i] for i in range(len(items))]
@@ -0,0 +1,51 @@
+"""
+Diffs two benchmark result files written by bench/replay.py or bench/db_funcs.py.
+
+    python bench/compare.py OLD.json NEW.json [--metric p95_ms] [--threshold 10]
+
+Prints every entry present in both files with the old and new value of the
+metric and the relative change; changes beyond --threshold percent are
+flagged. Exits 1 if anything regressed by more than the threshold.
+"""
+import argparse
+import json
+import sys
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("old")
+    ap.add_argument("new")
+    ap.add_argument("--metric", default="p50_ms", help="p50_ms, p95_ms, p99_ms, mean_ms or per_sec")
+    ap.add_argument("--threshold", type=float, default=10, help="percent change worth flagging")
+    args = ap.parse_args()
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"old: {old['meta'].get('git_rev') or '?'} {old['meta'].get('time', '')}")
+    print(f"new: {new['meta'].get('git_rev') or '?'} {new['meta'].get('time', '')}")
+
+    # higher is better for throughput, lower for latencies
+    sign = -1 if args.metric == "per_sec" else 1
+    regressed = 0
+    for group, rows in new["results"].items():
+        before = old["results"].get(group, {})
+        shared = [k for k in rows if k in before]
+        if not shared:
+            continue
+        print(f"\n{group}")
+        print(f"  {'name':<34} {'old':>10} {'new':>10} {'change':>8}")
+        for name in sorted(shared):
+            a, b = before[name].get(args.metric, 0), rows[name].get(args.metric, 0)
+            change = (b - a) / a * 100 if a else 0.0
+            flag = ""
+            if abs(change) >= args.threshold:
+                worse = change * sign > 0
+                regressed += worse
+                flag = "  <- slower" if worse else "  <- faster"
+            print(f"  {name:<34} {a:>10.3f} {b:>10.3f} {change:>+7.1f}%{flag}")
+    sys.exit(1 if regressed else 0)
+
+if __name__ == "__main__":
+    main()
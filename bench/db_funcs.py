@@ -0,0 +1,150 @@
+"""
+Micro-benchmark of the db.py functions at several table sizes.
+
+    python bench/db_funcs.py [--sizes 1000,100000,1000000] [--calls 200]
+                             [--only search,get_mode] [--out bench/results/db_funcs.json]
+
+Each size is loaded into a throwaway database through append_study_bulk (10% of
+the rows in one "hot" chat, the rest over 1000 others, timestamps spread over
+the last 90 days so reviews are due, topics drawn from a fixed pool of
+TOPIC_POOL phrases the way a real learner revisits a few subjects often), plus
+a tenth as many resource links.
+Every function is then timed per call against the hot chat. Cached reads
+(get_mode, get_chat_version, quiz sessions/questions) measure the hit path,
+which is what the bot sees in steady state. Results go to JSON for
+bench/compare.py.
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.stubs import meta, print_table, summarize, write_results  # noqa: E402
+
+HOT = "hot"
+VOCAB = [f"w{i}" for i in range(5000)]
+CUM_WEIGHTS = list(itertools.accumulate(1 / (i + 1) for i in range(len(VOCAB))))
+TOPIC_POOL = 2000
+LOAD_CHUNK = 20000
+
+def load(db, size: int, seed: int = 7):
+    rng = random.Random(seed)
+    pool = [" ".join(rng.choices(VOCAB, cum_weights=CUM_WEIGHTS, k=3)) for _ in range(TOPIC_POOL)]
+    now = int(time.time())
+    for start in range(0, size, LOAD_CHUNK):
+        rows = []
+        for i in range(start, min(size, start + LOAD_CHUNK)):
+            chat = HOT if i % 10 == 0 else f"c{i % 1000:04d}"
+            ts, epoch = db.to_stamp(now - rng.randrange(90 * 86400))
+            topic = rng.choices(pool, cum_weights=CUM_WEIGHTS[:TOPIC_POOL])[0]
+            rows.append((chat, "u", "bench", topic, "I studied " + " ".join(rng.choices(VOCAB, cum_weights=CUM_WEIGHTS, k=12)), ts, epoch))
+        db.append_study_bulk(rows)
+    links = max(1, size // 10)
+    for start in range(0, links, LOAD_CHUNK):
+        ts, epoch = db.to_stamp(now)
+        db.append_resource_links_bulk([(HOT if i % 10 == 0 else f"c{i % 1000:04d}", "u", f"link {i}",
+                                        f"https://example.com/{i}", "", ts, epoch)
+                                       for i in range(start, min(links, start + LOAD_CHUNK))])
+
+def cases(db, calls: int) -> dict:
+    """name -> (callable, calls). Setup for the stateful ones happens here, untimed."""
+    conn = db._conn()
+    hot_ids = [r[0] for r in conn.execute("SELECT id FROM study_logs WHERE chat_id=? ORDER BY id", (HOT,))]
+    mid_id = hot_ids[len(hot_ids) // 2]
+    ids = itertools.cycle(random.Random(3).sample(hot_ids, min(len(hot_ids), calls)))
+    counter = itertools.count(1)
+    chats = itertools.cycle([f"c{i:04d}" for i in range(1000)])
+
+    mcq = {"question": "q?", "A": "a", "B": "b", "C": "c", "D": "d", "correct": "A", "explanation": "e"}
+    db.set_mode(HOT, "quiz_answering")
+    answer_session = db.create_quiz_session(HOT, "u", "w1 w2", [dict(mcq) for _ in range(calls)])
+    answer_idx = itertools.count()
+    stream_session = db.create_quiz_session(HOT, "u", "w1 w2", [dict(mcq)], total=calls + 1)
+    stream_idx = itertools.count(1)
+    read_session = db.create_quiz_session(HOT, "u", "w3", [dict(mcq) for _ in range(5)])
+    db.put_cached_quiz("bench-key", "w1", 5, "bench", [{"q": "x"}] * 5, 5000, 86400)
+    ts, epoch = db._now_stamp()
+    bulk = [(HOT, "u", "bench", "bulk topic", "I studied bulk topic", ts, epoch)] * 100
+
+    return {
+        # reads
+        "get_recent_study": (lambda: db.get_recent_study(HOT, 5), calls),
+        "get_study_page": (lambda: db.get_study_page(HOT, 21), calls),
+        "get_study_page(deep cursor)": (lambda: db.get_study_page(HOT, 21, mid_id), calls),
+        "get_resource_page": (lambda: db.get_resource_page(HOT, 21), calls),
+        "get_random_study": (lambda: db.get_random_study(HOT), calls),
+        "get_due_item": (lambda: db.get_due_item(HOT), calls),
+        "get_chats_with_pending_nudges": (lambda: db.get_chats_with_pending_nudges("", int(time.time()), 500), calls),
+        "search(rare)": (lambda: db.search(HOT, "w4321"), calls),
+        "search(common)": (lambda: db.search(HOT, "w1"), calls),
+        "get_mode": (lambda: db.get_mode(next(chats)), calls),
+        "get_chat_version": (lambda: db.get_chat_version(HOT), calls),
+        "get_active_quiz_session": (lambda: db.get_active_quiz_session(HOT), calls),
+        "get_quiz_question": (lambda: db.get_quiz_question(read_session, 2), calls),
+        "get_quiz_answers": (lambda: db.get_quiz_answers(read_session), calls),
+        "get_cached_quiz": (lambda: db.get_cached_quiz("bench-key", 86400), calls),
+        "get_state": (lambda: db.get_state(db.FTS_BACKFILL_KEY), calls),
+        "get_stats(30 days)": (lambda: db.get_stats(HOT, 30), calls),
+        "iter_export(study)": (lambda: sum(1 for _ in db.iter_export("study", HOT)), max(1, calls // 40)),
+        # writes
+        "mark_update_seen": (lambda: db.mark_update_seen(next(counter)), calls),
+        "set_mode": (lambda: db.set_mode(next(chats), "awaiting_study"), calls),
+        "append_study": (lambda: db.append_study(HOT, "u", "bench", "new topic", "I studied new topic"), calls),
+        "append_resource_link": (lambda: db.append_resource_link(HOT, "u", "link", "https://example.com/x", ""), calls),
+        "append_study_bulk(100)": (lambda: db.append_study_bulk(bulk), max(1, calls // 10)),
+        "record_review": (lambda: db.record_review(HOT, next(ids), 4), calls),
+        "claim_due_nudge": (lambda: db.claim_due_nudge(next(chats), int(time.time())), calls),
+        "create_quiz_session": (lambda: db.create_quiz_session(f"q{next(counter)}", "u", "w1", [dict(mcq)] * 5), calls),
+        "add_quiz_question": (lambda: db.add_quiz_question(stream_session, next(stream_idx), mcq), calls),
+        "answer_quiz_question": (lambda: db.answer_quiz_question(answer_session, next(answer_idx), "A"), calls),
+        "record_quiz_grades": (lambda: db.record_quiz_grades(read_session, {0: 8, 1: 5}), calls),
+        "put_cached_quiz": (lambda: db.put_cached_quiz(f"k{next(counter)}", "w1", 5, "bench", [{"q": "x"}] * 5, 5000, 86400), calls),
+        "touch_cached_quiz": (lambda: db.touch_cached_quiz("bench-key"), calls),
+        "set_state": (lambda: db.set_state("bench", {"n": next(counter)}), calls),
+    }
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="1000,100000,1000000")
+    ap.add_argument("--calls", type=int, default=200)
+    ap.add_argument("--only", default="", help="comma-separated function names to run")
+    ap.add_argument("--out", default=os.path.join(ROOT, "bench", "results", "db_funcs.json"))
+    args = ap.parse_args()
+    only = {s.strip() for s in args.only.split(",") if s.strip()}
+
+    results, loads = {}, {}
+    for size in [int(s) for s in args.sizes.split(",")]:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+            sys.modules.pop("db", None)
+            import db
+            db.init_db()
+            t = time.perf_counter()
+            load(db, size)
+            loads[f"rows={size}"] = round(time.perf_counter() - t, 2)
+            print(f"\nloaded {size} rows in {loads[f'rows={size}']}s")
+
+            table = {}
+            for name, (fn, n) in cases(db, args.calls).items():
+                if only and name.split("(")[0] not in only:
+                    continue
+                samples = []
+                for _ in range(n):
+                    t = time.perf_counter()
+                    fn()
+                    samples.append(time.perf_counter() - t)
+                table[name] = summarize(samples)
+            results[f"rows={size}"] = table
+            print_table(f"rows={size}", table)
+            db.close_db()
+
+    write_results(args.out, {"meta": {**meta(args), "load_sec": loads}, "results": results})
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark: rows/sec through POST /api/study (one row per request) vs
+/api/study/bulk with a JSON array and with streamed NDJSON.
+
+    python bench/ingest.py [--rows 2000] [--bulk-rows 50000]
+
+Runs the FastAPI app in-process (TestClient) against a throwaway database,
+so the numbers include request parsing, validation and commits, not network.
+Afterwards both bulk formats are sent rows with out-of-range and non-finite
+timestamps and with chat/user ids that are neither strings nor integers,
+which must come back as per-row errors while the rest go in.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def rows(n: int, prefix: str) -> list[dict]:
+    return [{"topic": f"{prefix} topic {i}", "raw_text": f"I studied {prefix} topic {i}"} for i in range(n)]
+
+def ndjson(items: list[dict], chunk: int = 64 * 1024):
+    body = "\n".join(json.dumps(it) for it in items).encode()
+    for i in range(0, len(body), chunk):
+        yield body[i:i + chunk]
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=2000, help="rows for the single-row endpoint")
+    ap.add_argument("--bulk-rows", type=int, default=50000, help="rows for each bulk run")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+        os.environ.setdefault("TELEGRAM_BOT_TOKEN", "")
+        from fastapi.testclient import TestClient
+        import main as app_main
+
+        results = []
+        with TestClient(app_main.app) as client:
+            t = time.perf_counter()
+            for it in rows(args.rows, "single"):
+                client.post("/api/study", json=it).raise_for_status()
+            results.append(("POST /api/study", args.rows, time.perf_counter() - t))
+
+            t = time.perf_counter()
+            r = client.post("/api/study/bulk", json=rows(args.bulk_rows, "array"))
+            assert r.json()["inserted"] == args.bulk_rows, r.text
+            results.append(("POST /api/study/bulk (JSON array)", args.bulk_rows, time.perf_counter() - t))
+
+            t = time.perf_counter()
+            r = client.post("/api/study/bulk", content=ndjson(rows(args.bulk_rows, "ndjson")),
+                            headers={"content-type": "application/x-ndjson"})
+            assert r.json()["inserted"] == args.bulk_rows, r.text
+            results.append(("POST /api/study/bulk (NDJSON)", args.bulk_rows, time.perf_counter() - t))
+
+            bad = [{"topic": "ok 0"}, {"topic": "bad", "ts": 1e20}, {"topic": "bad", "ts": -1e18},
+                   {"topic": "bad", "ts": float("inf")}, {"topic": "bad", "ts": float("nan")},
+                   {"topic": "bad", "chat_id": {"id": 1}}, {"topic": "bad", "user_id": [1]}, {"topic": "bad", "chat_id": True},
+                   {"topic": "ok 1", "chat_id": -100123}, {"topic": "ok 2"}]
+            for r in (client.post("/api/study/bulk", content=json.dumps(bad), headers={"content-type": "application/json"}),
+                      client.post("/api/study/bulk", content=ndjson(bad), headers={"content-type": "application/x-ndjson"})):
+                r.raise_for_status()
+                got = r.json()
+                assert (got["inserted"], got["failed"]) == (3, 7), r.text
+                assert [e["index"] for e in got["errors"]] == [1, 2, 3, 4, 5, 6, 7], r.text
+
+        base = results[0][1] / results[0][2]
+        print(f"{'endpoint':<36} {'rows':>8} {'sec':>8} {'rows/sec':>10} {'vs single':>10}")
+        for name, n, sec in results:
+            print(f"{name:<36} {n:>8} {sec:>8.2f} {n / sec:>10.0f} {n / sec / base:>9.0f}x")
+
+if __name__ == "__main__":
+    main()
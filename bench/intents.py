@@ -0,0 +1,114 @@
+"""
+Benchmark: agent.route() vs the old chain of is_*/extract_* predicates.
+
+    python bench/intents.py [--messages 200000]
+
+The corpus mixes commands, "I studied ..." notes, searches, links and plain
+chatter in roughly the proportions a study bot sees. Both sides must agree on
+every message before anything is timed.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import agent  # noqa: E402
+
+TOPICS = ["EOQ", "safety stock", "Little's law", "bayes theorem", "B-trees", "the CAP theorem",
+          "gradient descent", "chapter 4 of DDIA", "reorder point and lead time", "TCP congestion control"]
+
+def corpus(n: int, seed: int = 1) -> list[str]:
+    rng = random.Random(seed)
+    makers = [
+        (30, lambda: f"I studied {rng.choice(TOPICS)}"),
+        (10, lambda: f"i learned {rng.choice(TOPICS)} today"),
+        (10, lambda: rng.choice(["help", "menu", "/help", "cancel", "/cancel", "  Recent ", "random", "/recollect"])),
+        (8, lambda: rng.choice(["what did I study recently?", "give me a random note please"])),
+        (10, lambda: f"search {rng.choice(TOPICS)}"),
+        (5, lambda: f"add resource https://example.com/{rng.randrange(10**6)}"),
+        (27, lambda: rng.choice(["B", "a", "ok", "thanks!", "next", "The answer is the square root of 2DS/H",
+                                 "hmm not sure, maybe holding cost?", "lol"])),
+    ]
+    weights = [w for w, _ in makers]
+    return [rng.choices(makers, weights)[0][1]() for _ in range(n)]
+
+# --- the pre-router predicates, verbatim ---
+def _is_help(text):
+    t = text.lower().strip()
+    return t in {"help", "/help", "menu"}
+
+def _is_cancel(text):
+    return text.lower().strip() in {"cancel", "/cancel"}
+
+def _is_recent(text):
+    t = text.lower()
+    return t in {"recent", "/recent"} or "what did i study recently" in t
+
+def _is_recollect(text):
+    t = text.lower().strip()
+    return t in {"recollect", "/recollect", "random"} or "random note" in t
+
+def _is_add_resource(text):
+    t = text.lower().strip()
+    return t == "add resource" or t.startswith("add resource")
+
+def _extract_search_query(text):
+    m = re.match(r"^/?(search|find)\s+(.+)$", text.strip(), flags=re.I)
+    return m.group(2).strip() if m else None
+
+def _extract_study_topic(text):
+    m = re.match(r"^i\s+(studied|learned)\s+(.+)$", text, flags=re.I)
+    return m.group(2).strip() if m else None
+
+# intents added after the router; the old chain reads them as chatter
+NEW_INTENTS = {"next"}
+
+def legacy(text: str):
+    t = text.strip()
+    if _is_help(t):
+        return "help"
+    if _is_cancel(t):
+        return "cancel"
+    if _is_recent(t):
+        return "recent"
+    if _is_recollect(t):
+        return "recollect"
+    if _is_add_resource(t):
+        return "add_resource"
+    if _extract_search_query(t):
+        return "search"
+    if _extract_study_topic(t):
+        return "study"
+    return "none"
+
+def timed(fn, msgs, repeat: int = 5) -> float:
+    # best of a few runs, to keep scheduler noise out of a sub-microsecond number
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for m in msgs:
+            fn(m)
+        best = min(best, time.perf_counter() - t)
+    return best / len(msgs) * 1e9
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--messages", type=int, default=200000)
+    args = ap.parse_args()
+
+    msgs = corpus(args.messages)
+    mismatches = [m for m in set(msgs) if legacy(m) != ("none" if (name := agent.route(m).name) in NEW_INTENTS else name)]
+    assert not mismatches, mismatches[:5]
+
+    old_ns = timed(legacy, msgs)
+    new_ns = timed(agent.route, msgs)
+    print(f"{'messages':>10} {'predicate chain ns':>20} {'router ns':>10} {'speedup':>8}")
+    print(f"{len(msgs):>10} {old_ns:>20.0f} {new_ns:>10.0f} {old_ns / new_ns:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Benchmark: draining a backlog of Telegram updates with the getUpdates poller
+vs the same updates POSTed to the webhook.
+
+    python bench/poll.py [--chats 300] [--steps 20] [--webhook-concurrency 40]
+                         [--tg-latency-ms 20] [--llm-latency-ms 300]
+
+The backlog is the bot traffic from bench/replay.py scripts (dashboard calls
+left out), numbered as Telegram would. For the poller it is queued on the
+fake Bot API up front, as after an outage. The webhook side replays it the way
+Telegram delivers: one chat's updates in order, up to --webhook-concurrency
+requests in flight. Each mode runs in a fresh process against its own
+throwaway database. Afterwards the saved study rows are checked against
+the number of study messages sent, so any update lost or handled twice shows up.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.replay import WEBHOOK, Script, free_port, serve  # noqa: E402
+from bench.stubs import OpenAIStub, TelegramStub, meta, write_results  # noqa: E402
+
+SAVES = {"study", "mode:awaiting_study"}
+
+def backlog(args, quiz_questions: int) -> tuple[list[list[dict]], int]:
+    """Per-chat update lists (numbered in interleaved arrival order), and how many should save a study row."""
+    rng = random.Random(args.seed)
+    chats, saves = [], 0
+    for i in range(args.chats):
+        steps = Script(200000 + i, random.Random(rng.random()), quiz_questions).build(args.steps)
+        chats.append([req["json"] for route, label, req in steps if route == WEBHOOK])
+        saves += sum(1 for route, label, _ in steps if label in SAVES)
+    # arrival order: chats interleaved, each chat's own order kept
+    update_id, cursors = 1, [0] * len(chats)
+    live = list(range(len(chats)))
+    while live:
+        for i in list(live):
+            chats[i][cursors[i]]["update_id"] = update_id
+            update_id += 1
+            cursors[i] += 1
+            if cursors[i] == len(chats[i]):
+                live.remove(i)
+    return chats, saves
+
+async def drain_poll(app_main, tg, updates: list[dict]):
+    import poller
+    tg.push_updates(sorted(updates, key=lambda u: u["update_id"]))
+    async with app_main.lifespan(app_main.app):
+        t = time.perf_counter()
+        while tg.updates or poller.pending() or await app_main.db_async.get_inbox():
+            await asyncio.sleep(0.01)
+        return time.perf_counter() - t
+
+async def drain_webhook(base_url: str, chats: list[list[dict]], concurrency: int):
+    import httpx
+    queue = asyncio.Queue()
+    for c in chats:
+        queue.put_nowait(c)
+
+    async def worker(client):
+        while not queue.empty():
+            for update in queue.get_nowait():
+                (await client.post("/telegram/webhook", json=update)).raise_for_status()
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        t = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        return time.perf_counter() - t
+
+def run_mode(args) -> dict:
+    tg = TelegramStub(args.tg_latency_ms).start()
+    llm = OpenAIStub(args.llm_latency_ms).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update({
+            "DB_PATH": os.path.join(tmp, "bench.db"),
+            "TELEGRAM_BOT_TOKEN": "bench",
+            "TELEGRAM_API_BASE": tg.url,
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_API_URL": llm.url + "/v1/responses",
+            "TELEGRAM_POLLING": "1" if args.mode == "poll" else "0",
+            "POLL_TIMEOUT_SEC": "1",
+            "NUDGE_BROADCAST": "0",
+            "ALLOWED_USER_ID": "",
+            "TG_GLOBAL_RATE": "0",
+            "TG_CHAT_RATE": "0",
+        })
+        import main as app_main
+        import quiz_cache
+
+        chats, saves = backlog(args, quiz_cache.QUIZ_QUESTIONS)
+        updates = [u for c in chats for u in c]
+        if args.mode == "poll":
+            wall = asyncio.run(drain_poll(app_main, tg, updates))
+        else:
+            port = free_port()
+            server, thread = serve(app_main.app, port)
+            try:
+                wall = asyncio.run(drain_webhook(f"http://127.0.0.1:{port}", chats, args.webhook_concurrency))
+            finally:
+                server.should_exit = True
+                thread.join(30)
+        saved = app_main.db._conn().execute("SELECT COUNT(*) FROM study_logs").fetchone()[0]
+    tg.stop()
+    llm.stop()
+    return {"updates": len(updates), "sec": round(wall, 3), "per_sec": round(len(updates) / wall, 1),
+            "study_rows": saved, "study_expected": saves}
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chats", type=int, default=300)
+    ap.add_argument("--steps", type=int, default=20)
+    ap.add_argument("--webhook-concurrency", type=int, default=40, help="Telegram's default max_connections")
+    ap.add_argument("--tg-latency-ms", type=float, default=20)
+    ap.add_argument("--llm-latency-ms", type=float, default=300)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--mode", choices=["both", "poll", "webhook"], default="both")
+    ap.add_argument("--out", default=os.path.join(ROOT, "bench", "results", "poll.json"))
+    args = ap.parse_args()
+
+    if args.mode != "both":
+        print(json.dumps(run_mode(args)))
+        return
+
+    results = {}
+    for mode in ("webhook", "poll"):
+        cmd = [sys.executable, os.path.abspath(__file__), "--mode", mode] + \
+              [f"--{k.replace('_', '-')}={v}" for k, v in vars(args).items() if k not in {"mode", "out"}]
+        out = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+        results[mode] = json.loads(out.strip().splitlines()[-1])
+
+    print(f"{'mode':<10} {'updates':>8} {'sec':>8} {'updates/sec':>12} {'study rows':>11} {'expected':>9}")
+    for mode, r in results.items():
+        print(f"{mode:<10} {r['updates']:>8} {r['sec']:>8.2f} {r['per_sec']:>12} {r['study_rows']:>11} {r['study_expected']:>9}")
+    write_results(args.out, {"meta": meta(args), "results": {"drain": results}})
+
+if __name__ == "__main__":
+    main()
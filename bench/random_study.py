@@ -0,0 +1,66 @@
+"""
+Benchmark: get_random_study (seq seek) vs the old ORDER BY RANDOM() query.
+
+    python bench/random_study.py [--sizes 1000,10000,100000] [--calls 200]
+
+Each size is loaded into a throwaway database for one chat, alongside the same
+number of rows spread over other chats, and both queries are timed.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def load(db, chat_id: str, n: int):
+    conn = db._conn()
+    ts, epoch = db._now_stamp()
+    rows = []
+    for i in range(n):
+        rows.append((chat_id, "u", "bench", f"topic {i}", f"I studied topic {i}", ts, epoch, i + 1))
+        rows.append((f"other-{i % 97}", "u", "bench", f"noise {i}", "noise", ts, epoch, i // 97 + 1))
+    with db.write_batch():
+        conn.executemany(
+            "INSERT INTO study_logs (chat_id, user_id, username, topic, raw_text, ts, ts_epoch, seq) VALUES (?,?,?,?,?,?,?,?)",
+            rows,
+        )
+        conn.execute("DELETE FROM study_counts")
+        conn.execute("INSERT INTO study_counts (chat_id, n) SELECT chat_id, COUNT(*) FROM study_logs GROUP BY chat_id")
+
+def timed(fn, calls: int) -> float:
+    t = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - t) / calls * 1e6
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="1000,10000,100000")
+    ap.add_argument("--calls", type=int, default=200)
+    args = ap.parse_args()
+
+    print(f"{'rows':>10} {'ORDER BY RANDOM() us':>22} {'seq seek us':>12} {'speedup':>8}")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+            sys.modules.pop("db", None)
+            import db
+            db.init_db()
+            load(db, "bench", size)
+            conn = db._conn()
+
+            def old():
+                conn.execute("SELECT topic, ts FROM study_logs WHERE chat_id=? ORDER BY RANDOM() LIMIT 1", ("bench",)).fetchone()
+
+            def new():
+                db.get_random_study("bench")
+
+            old_us, new_us = timed(old, args.calls), timed(new, args.calls)
+            print(f"{size:>10} {old_us:>22.1f} {new_us:>12.1f} {old_us / new_us:>7.0f}x")
+            db.close_db()
+
+if __name__ == "__main__":
+    main()
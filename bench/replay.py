@@ -0,0 +1,233 @@
+"""
+Load replay: synthetic Telegram traffic and dashboard calls against the real
+app, with Telegram and OpenAI swapped for local stubs (bench/stubs.py).
+
+    python bench/replay.py [--chats 200] [--steps 40] [--concurrency 32]
+                           [--webhook-async] [--tg-latency-ms 20] [--llm-latency-ms 300]
+                           [--out bench/results/replay.json]
+
+Each chat gets a seeded script: "I studied ..." notes, menu callbacks, the
+awaiting_study / awaiting_resource / quiz flows, search, recent and /api/*
+reads and writes. A chat's steps run in order; --concurrency chats run at
+once. The app is served by uvicorn on a loopback port against a throwaway
+database. Reports throughput and p50/p95/p99 per route and per intent, and
+writes the same numbers as JSON (diff two runs with bench/compare.py).
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx  # noqa: E402
+
+from bench.stubs import OpenAIStub, TelegramStub, meta, print_table, summarize, write_results  # noqa: E402
+
+TOPICS = ["EOQ", "safety stock", "Little's law", "bayes theorem", "B-trees", "the CAP theorem",
+          "gradient descent", "chapter 4 of DDIA", "reorder point and lead time", "TCP congestion control",
+          "economic order quantity", "vector clocks", "raft leader election", "bloom filters"]
+
+WEBHOOK = "POST /telegram/webhook"
+
+class Script:
+    """Builds one chat's steps: (route, intent label, request kwargs)."""
+    def __init__(self, chat_id: int, rng: random.Random, quiz_questions: int):
+        self.chat_id = chat_id
+        self.rng = rng
+        self.quiz_questions = quiz_questions
+        self.steps: list[tuple[str, str, dict]] = []
+
+    def message(self, label: str, text: str):
+        update = {"message": {"message_id": len(self.steps) + 1, "chat": {"id": self.chat_id, "type": "private"},
+                              "from": {"id": self.chat_id, "username": f"u{self.chat_id}"}, "text": text}}
+        self.steps.append((WEBHOOK, label, {"method": "POST", "url": "/telegram/webhook", "json": update}))
+
+    def callback(self, data: str):
+        update = {"callback_query": {"id": f"cb{self.chat_id}-{len(self.steps)}", "data": data,
+                                     "from": {"id": self.chat_id},
+                                     "message": {"message_id": 1, "chat": {"id": self.chat_id}}}}
+        self.steps.append((WEBHOOK, f"cb:{data}", {"method": "POST", "url": "/telegram/webhook", "json": update}))
+
+    def api(self, method: str, path: str, **kwargs):
+        route = f"{method} {path}"
+        self.steps.append((route, f"api:{route}", {"method": method, "url": path, **kwargs}))
+
+    # --- flows ---
+    def study(self):
+        self.message("study", f"I studied {self.rng.choice(TOPICS)}")
+
+    def record_flow(self):
+        self.callback("menu_record")
+        self.message("mode:awaiting_study", self.rng.choice(TOPICS))
+
+    def resource_flow(self):
+        self.callback("menu_add_resource")
+        self.message("mode:awaiting_resource", f"https://example.com/{self.rng.randrange(10**6)}")
+
+    def quiz_flow(self):
+        self.callback("menu_quiz")
+        self.message("mode:awaiting_quiz_topic", self.rng.choice(TOPICS))
+        for i in range(self.quiz_questions):
+            self.message("mode:quiz_answering", f"my answer {i}")
+
+    def chatter(self):
+        kind = self.rng.choice(["search", "recent", "recollect", "help", "none", "add_resource"])
+        text = {"search": f"search {self.rng.choice(TOPICS).split()[-1]}", "recent": "recent",
+                "recollect": "random", "help": "help", "none": "thanks!",
+                "add_resource": f"add resource https://example.com/r{self.rng.randrange(10**6)}"}[kind]
+        self.message(kind, text)
+
+    def menu(self):
+        self.callback(self.rng.choice(["menu_recent", "menu_recollect", "menu_nudge"]))
+
+    def dashboard(self):
+        chat = str(self.chat_id)
+        pick = self.rng.randrange(5)
+        if pick == 0:
+            self.api("GET", "/api/study/recent", params={"chat_id": chat, "n": 20})
+        elif pick == 1:
+            self.api("GET", "/api/search", params={"chat_id": chat, "q": self.rng.choice(TOPICS).split()[-1]})
+        elif pick == 2:
+            self.api("GET", "/api/nudge/next", params={"chat_id": chat})
+        elif pick == 3:
+            self.api("GET", "/api/resources", params={"chat_id": chat, "n": 20})
+        else:
+            self.api("POST", "/api/study", json={"chat_id": chat, "user_id": chat, "topic": self.rng.choice(TOPICS)})
+
+    def build(self, steps: int):
+        flows = [(30, self.study), (10, self.record_flow), (8, self.resource_flow), (3, self.quiz_flow),
+                 (20, self.chatter), (12, self.menu), (17, self.dashboard)]
+        weights = [w for w, _ in flows]
+        while len(self.steps) < steps:
+            self.rng.choices(flows, weights)[0][1]()
+        return self.steps
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def serve(app, port: int):
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise SystemExit("uvicorn failed to start")
+        time.sleep(0.05)
+    return server, thread
+
+async def replay(base_url: str, scripts: list[list], concurrency: int):
+    samples: dict[tuple[str, str], list[float]] = defaultdict(list)
+    errors: dict[tuple[str, str], int] = defaultdict(int)
+    queue: asyncio.Queue = asyncio.Queue()
+    for s in scripts:
+        queue.put_nowait(s)
+
+    async def worker(client: httpx.AsyncClient):
+        while not queue.empty():
+            etags: dict[str, str] = {}
+            for route, label, req in queue.get_nowait():
+                headers = {}
+                # the dashboard revalidates what it already has, so reads can come back 304
+                if req["method"] == "GET" and req["url"] in etags:
+                    headers["if-none-match"] = etags[req["url"]]
+                t = time.perf_counter()
+                try:
+                    r = await client.request(headers=headers, **req)
+                    ok = r.status_code < 400
+                    if "etag" in r.headers:
+                        etags[req["url"]] = r.headers["etag"]
+                except httpx.HTTPError:
+                    ok = False
+                samples[(route, label)].append(time.perf_counter() - t)
+                if not ok:
+                    errors[(route, label)] += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        t = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        wall = time.perf_counter() - t
+    return samples, errors, wall
+
+def group(samples, errors, wall, key_idx: int) -> dict:
+    merged, errs = defaultdict(list), defaultdict(int)
+    for key, values in samples.items():
+        merged[key[key_idx]] += values
+        errs[key[key_idx]] += errors.get(key, 0)
+    return {k: summarize(v, errs[k], wall) for k, v in merged.items()}
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chats", type=int, default=200)
+    ap.add_argument("--steps", type=int, default=40, help="requests per chat (flows are not cut short)")
+    ap.add_argument("--concurrency", type=int, default=32, help="chats replayed at once")
+    ap.add_argument("--webhook-async", action="store_true", help="ack the webhook first, handle on the lanes")
+    ap.add_argument("--tg-latency-ms", type=float, default=20)
+    ap.add_argument("--llm-latency-ms", type=float, default=300)
+    ap.add_argument("--real-rate-limits", action="store_true", help="keep the outbox's Telegram rate limits on")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default=os.path.join(ROOT, "bench", "results", "replay.json"))
+    args = ap.parse_args()
+
+    tg = TelegramStub(args.tg_latency_ms).start()
+    llm = OpenAIStub(args.llm_latency_ms).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update({
+            "DB_PATH": os.path.join(tmp, "bench.db"),
+            "TELEGRAM_BOT_TOKEN": "bench",
+            "TELEGRAM_API_BASE": tg.url,
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_API_URL": llm.url + "/v1/responses",
+            "WEBHOOK_ASYNC": "1" if args.webhook_async else "0",
+            "NUDGE_BROADCAST": "0",
+            "DASHBOARD_TOKEN": "",
+            "ALLOWED_USER_ID": "",
+        })
+        if not args.real_rate_limits:
+            os.environ.update({"TG_GLOBAL_RATE": "0", "TG_CHAT_RATE": "0"})
+        import main as app_main
+        import quiz_cache
+
+        rng = random.Random(args.seed)
+        scripts = [Script(100000 + i, random.Random(rng.random()), quiz_cache.QUIZ_QUESTIONS).build(args.steps)
+                   for i in range(args.chats)]
+        total = sum(len(s) for s in scripts)
+        print(f"replaying {total} requests from {args.chats} chats, concurrency {args.concurrency}, "
+              f"webhook {'async' if args.webhook_async else 'sync'}")
+
+        port = free_port()
+        server, thread = serve(app_main.app, port)
+        try:
+            samples, errors, wall = asyncio.run(replay(f"http://127.0.0.1:{port}", scripts, args.concurrency))
+        finally:
+            server.should_exit = True
+            thread.join(30)
+        tg.stop()
+        llm.stop()
+
+    routes = group(samples, errors, wall, 0)
+    intents = group(samples, errors, wall, 1)
+    overall = summarize([v for vs in samples.values() for v in vs], sum(errors.values()), wall)
+    print_table("per route", routes)
+    print_table("per intent", intents)
+    print(f"\n{overall['count']} requests in {wall:.2f}s: {overall['per_sec']}/s, "
+          f"p50 {overall['p50_ms']:.2f} ms, p99 {overall['p99_ms']:.2f} ms, {overall['errors']} errors; "
+          f"{tg.calls} Telegram calls, {llm.calls} LLM calls")
+    write_results(args.out, {
+        "meta": meta(args),
+        "results": {"overall": {"all": overall}, "routes": routes, "intents": intents},
+    })
+
+if __name__ == "__main__":
+    main()
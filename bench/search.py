@@ -0,0 +1,76 @@
+"""
+Benchmark: FTS5 search() vs a LIKE '%term%' scan over study_logs.
+
+    python bench/search.py [--sizes 10000,100000,300000] [--calls 100]
+
+Each size is loaded into a throwaway database (half the rows in the searched
+chat, half spread over other chats); the FTS index is built by the triggers.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Zipf-ish vocabulary: a few very common words and a long tail, like real notes
+VOCAB = [f"w{i}" for i in range(5000)]
+WEIGHTS = [1 / (i + 1) for i in range(len(VOCAB))]
+
+def load(db, chat_id: str, n: int):
+    conn = db._conn()
+    ts, epoch = db._now_stamp()
+    rng = random.Random(7)
+    rows = []
+    for i in range(n):
+        chat = chat_id if i % 2 == 0 else f"other-{i % 97}"
+        topic = " ".join(rng.choices(VOCAB, WEIGHTS, k=3))
+        body = "I studied " + " ".join(rng.choices(VOCAB, WEIGHTS, k=12))
+        rows.append((chat, "u", "bench", topic, body, ts, epoch, i + 1))
+    with db.write_batch():
+        conn.executemany(
+            "INSERT INTO study_logs (chat_id, user_id, username, topic, raw_text, ts, ts_epoch, seq) VALUES (?,?,?,?,?,?,?,?)",
+            rows,
+        )
+
+def timed(fn, calls: int) -> float:
+    t = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - t) / calls * 1e3
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="10000,100000,300000")
+    ap.add_argument("--calls", type=int, default=50)
+    args = ap.parse_args()
+
+    print(f"{'rows':>10} {'LIKE ms':>10} {'FTS rare ms':>12} {'FTS common ms':>14} {'FTS 2-term ms':>14}")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+            sys.modules.pop("db", None)
+            import db
+            db.init_db()
+            load(db, "bench", size)
+            conn = db._conn()
+
+            def like():
+                # unranked substring scan for a rare word
+                conn.execute(
+                    "SELECT id, topic FROM study_logs WHERE chat_id=? AND (topic LIKE ? OR raw_text LIKE ?) ORDER BY id DESC LIMIT 10",
+                    ("bench", "%w4321%", "%w4321%"),
+                ).fetchall()
+
+            like_ms = timed(like, args.calls)
+            rare_ms = timed(lambda: db.search("bench", "w4321", kind="study"), args.calls)
+            common_ms = timed(lambda: db.search("bench", "w1", kind="study"), args.calls)
+            two_ms = timed(lambda: db.search("bench", "w2 w3", kind="study"), args.calls)
+            print(f"{size:>10} {like_ms:>10.2f} {rare_ms:>12.2f} {common_ms:>14.2f} {two_ms:>14.2f}")
+            db.close_db()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Local stand-ins for the Telegram Bot API and the OpenAI Responses API, plus
+result helpers shared by the benchmark scripts.
+
+Both stubs are stdlib ThreadingHTTPServers on 127.0.0.1 with an optional fixed
+latency, so a benchmark exercises the real HTTP clients without leaving the
+machine. Point the app at them with TELEGRAM_API_BASE / OPENAI_API_URL.
+"""
+import json
+import os
+import platform
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients going away mid-response (timeouts, killed processes) are routine here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class _Server:
+    def __init__(self, handler_cls, latency_ms: float = 0.0):
+        self.latency = latency_ms / 1000
+        handler = type(handler_cls.__name__, (handler_cls,), {"stub": self})
+        self.httpd = _HTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self):
+        with self._lock:
+            self.calls += 1
+
+class _Handler(BaseHTTPRequestHandler):
+    stub = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self) -> dict:
+        n = int(self.headers.get("content-length") or 0)
+        try:
+            return json.loads(self.rfile.read(n) or b"{}")
+        except ValueError:
+            return {}
+
+    def _json(self, obj, status: int = 200):
+        raw = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+class _TelegramHandler(_Handler):
+    def do_POST(self):
+        stub = self.stub
+        stub.count()
+        method = self.path.rsplit("/", 1)[-1]
+        body = self._body()
+        if method == "getUpdates":
+            self._json({"ok": True, "result": stub.take_updates(body)})
+            return
+        if stub.latency:
+            time.sleep(stub.latency)
+        with stub._lock:
+            stub.sent.append((method, body))
+        self._json({"ok": True, "result": {"message_id": stub.calls, "chat": {"id": body.get("chat_id")}}})
+
+class TelegramStub(_Server):
+    """
+    Accepts any Bot API call and answers ok. Sent payloads are kept in .sent.
+    getUpdates serves whatever was queued with push_updates(), honouring
+    offset/limit/timeout like the real API (long-poll included).
+    """
+    def __init__(self, latency_ms: float = 0.0):
+        super().__init__(_TelegramHandler, latency_ms)
+        self.sent: deque = deque(maxlen=100000)
+        self.updates: list[dict] = []
+        self._cond = threading.Condition(self._lock)
+        self.next_update_id = 1
+
+    def push_updates(self, updates: list[dict]):
+        """Queues updates for getUpdates, numbering any without an update_id."""
+        with self._cond:
+            for u in updates:
+                if "update_id" not in u:
+                    u = {"update_id": self.next_update_id, **u}
+                self.next_update_id = max(self.next_update_id, u["update_id"] + 1)
+                self.updates.append(u)
+            self._cond.notify_all()
+
+    def take_updates(self, body: dict) -> list[dict]:
+        offset = int(body.get("offset") or 0)
+        limit = max(1, min(100, int(body.get("limit") or 100)))
+        deadline = time.monotonic() + float(body.get("timeout") or 0)
+        with self._cond:
+            # confirming an offset forgets everything before it, as Telegram does
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return self.updates[:limit]
+
+class _OpenAIHandler(_Handler):
+    def do_POST(self):
+        stub = self.stub
+        stub.count()
+        body = self._body()
+        if stub.latency:
+            time.sleep(stub.latency)
+        messages = body.get("input") or [{}]
+        system, prompt = messages[0].get("content", ""), messages[-1].get("content", "")
+        if "quiz" in system:
+            n = int((re.search(r"Make (\d+) questions", prompt) or [0, 5])[1])
+            text = json.dumps({"items": [{"q": f"Stub question {i + 1}?", "ideal": "- point A\n- point B", "tags": ["stub"]}
+                                         for i in range(n)]})
+        elif "batch" in system:
+            idxs = [int(i) for i in re.findall(r'"idx": (\d+)', prompt)]
+            text = json.dumps({"results": [dict(_GRADE, idx=i) for i in idxs]})
+        else:
+            text = json.dumps(_GRADE)
+        if body.get("stream"):
+            self._stream(text)
+        else:
+            self._json({"output": [{"content": [{"type": "output_text", "text": text}]}]})
+
+    def _stream(self, text: str):
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("connection", "close")
+        self.end_headers()
+        for i in range(0, len(text), 40):
+            event = {"type": "response.output_text.delta", "delta": text[i:i + 40]}
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+        self.wfile.write(b'data: {"type": "response.completed"}\n\n')
+        self.close_connection = True
+
+_GRADE = {"score": 7, "verdict": "Stub grade.", "what_was_good": ["structure"],
+          "what_to_improve": ["an example"], "model_answer": "Stub model answer."}
+
+class OpenAIStub(_Server):
+    """Answers quiz generation (plain or streamed) and grading calls with canned JSON."""
+    def __init__(self, latency_ms: float = 0.0):
+        super().__init__(_OpenAIHandler, latency_ms)
+
+# --- Results ---
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+def summarize(samples: list[float], errors: int = 0, wall_sec: float | None = None) -> dict:
+    """samples in seconds -> count/rate/latency percentiles in ms."""
+    s = sorted(samples)
+    out = {
+        "count": len(s),
+        "errors": errors,
+        "mean_ms": round(sum(s) / len(s) * 1e3, 3) if s else 0.0,
+        "p50_ms": round(percentile(s, 50) * 1e3, 3),
+        "p95_ms": round(percentile(s, 95) * 1e3, 3),
+        "p99_ms": round(percentile(s, 99) * 1e3, 3),
+        "max_ms": round(s[-1] * 1e3, 3) if s else 0.0,
+    }
+    if wall_sec:
+        out["per_sec"] = round(len(s) / wall_sec, 1)
+    return out
+
+def meta(args) -> dict:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        rev = subprocess.run(["git", "-C", root, "rev-parse", "--short", "HEAD"],
+                             capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        rev = ""
+    return {
+        "git_rev": rev,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "args": vars(args),
+    }
+
+def write_results(path: str, data: dict):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    print(f"results written to {path}")
+
+def print_table(title: str, rows: dict):
+    print(f"\n{title}")
+    print(f"  {'name':<34} {'count':>7} {'err':>5} {'/sec':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, r in sorted(rows.items()):
+        print(f"  {name:<34} {r['count']:>7} {r['errors']:>5} {r.get('per_sec', 0):>8} "
+              f"{r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} {r['p99_ms']:>9.2f}")
@@ -1,20 +1,235 @@
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timezone
+import itertools
 import json
 import os
+import random
+import re
+import time
+
+import topics
+from cache import LRUCache, MISSING
 
 DB_PATH = os.getenv("DB_PATH", "anamnesis.db")
 
+# Connection tuning (see PRAGMA docs); defaults favour a single-host bot on WAL
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL").strip()
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL").strip()
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "128"))
+# How many recent Telegram update_ids to remember for redelivery dedup
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "10000"))
+# >1 skews random recollection towards older study items (1 = uniform)
+RECOLLECT_OLDER_BIAS = float(os.getenv("RECOLLECT_OLDER_BIAS", "1.0"))
+# Recollect picks a topic cluster first, so a subject logged often isn't drawn more often
+RECOLLECT_BY_CLUSTER = os.getenv("RECOLLECT_BY_CLUSTER", "1").strip().lower() in {"1", "true", "yes"}
+# Write-through cache for user_modes; optional expiry of idle conversational modes
+MODE_CACHE_SIZE = int(os.getenv("MODE_CACHE_SIZE", "10000"))
+MODE_CACHE_TTL_SEC = float(os.getenv("MODE_CACHE_TTL_SEC", "900"))
+MODE_IDLE_EXPIRE_SEC = int(os.getenv("MODE_IDLE_EXPIRE_SEC", "0"))
+MODE_EXPIRING = {m.strip() for m in os.getenv("MODE_EXPIRING", "awaiting_quiz_topic,awaiting_study,awaiting_resource").split(",") if m.strip()}
+# Per-chat data versions; a short TTL bounds staleness when several processes share the DB
+CHAT_VERSION_CACHE_SIZE = int(os.getenv("CHAT_VERSION_CACHE_SIZE", "10000"))
+CHAT_VERSION_CACHE_TTL_SEC = float(os.getenv("CHAT_VERSION_CACHE_TTL_SEC", "5"))
+# Active quiz session / question cache
+QUIZ_SESSION_CACHE_SIZE = int(os.getenv("QUIZ_SESSION_CACHE_SIZE", "5000"))
+QUIZ_SESSION_CACHE_TTL_SEC = float(os.getenv("QUIZ_SESSION_CACHE_TTL_SEC", "3600"))
+# Open-ended quiz answers graded at or above this (0-10) count as correct
+QUIZ_PASS_GRADE = int(os.getenv("QUIZ_PASS_GRADE", "7"))
+# Spaced repetition: delay before a new item's first review
+SRS_FIRST_REVIEW_HOURS = float(os.getenv("SRS_FIRST_REVIEW_HOURS", "24"))
+# Rows indexed per transaction when backfilling full-text search on an existing database
+FTS_BACKFILL_CHUNK = int(os.getenv("FTS_BACKFILL_CHUNK", "5000"))
+# Study rows filed under topic clusters per transaction when clustering an existing database
+TOPIC_BACKFILL_CHUNK = int(os.getenv("TOPIC_BACKFILL_CHUNK", "2000"))
+# Search ranks at most this many of the newest matches per table
+FTS_RANK_WINDOW = int(os.getenv("FTS_RANK_WINDOW", "2000"))
+# Stats day buckets (and so streaks) roll over at midnight this many minutes east of UTC
+STATS_DAY_OFFSET_MIN = int(os.getenv("STATS_DAY_OFFSET_MIN", "0"))
+
+_local = threading.local()
+_open_conns: list[sqlite3.Connection] = []
+_open_lock = threading.Lock()
+_generation = 0
+
+def _open(path: str | None = None):
+    conn = sqlite3.connect(
+        path or DB_PATH,
+        check_same_thread=False,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=DB_STATEMENT_CACHE,
+    )
+    conn.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    # negative cache_size is in KiB rather than pages
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
 def _conn():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+    """
+    Long-lived connection for the calling thread.
+    Opened lazily and reused, so sqlite3's statement cache stays warm across calls.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.generation != _generation:
+        conn = _open()
+        _local.conn, _local.generation = conn, _generation
+        with _open_lock:
+            _open_conns.append(conn)
+    return conn
+
+def _pending_hooks() -> list:
+    hooks = getattr(_local, "after_commit", None)
+    if hooks is None:
+        hooks = _local.after_commit = []
+    return hooks
+
+def _after_commit(fn):
+    """Runs fn once the enclosing write transaction commits; dropped on rollback."""
+    _pending_hooks().append(fn)
+
+@contextmanager
+def _transaction(conn):
+    hooks = _pending_hooks()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        hooks.clear()
+        raise
+    conn.commit()
+    ready = list(hooks)
+    hooks.clear()
+    for fn in ready:
+        fn()
+
+@contextmanager
+def _write():
+    """
+    Yields a cursor inside a write transaction.
+    Nested use (or a caller-managed transaction) becomes a savepoint instead.
+    """
+    conn = _conn()
+    if conn.in_transaction:
+        hooks = _pending_hooks()
+        mark = len(hooks)
+        conn.execute("SAVEPOINT w")
+        try:
+            yield conn.cursor()
+        except BaseException:
+            conn.execute("ROLLBACK TO w")
+            conn.execute("RELEASE w")
+            del hooks[mark:]
+            raise
+        conn.execute("RELEASE w")
+        return
+    with _transaction(conn):
+        yield conn.cursor()
+
+@contextmanager
+def write_batch():
+    """
+    Group-commits everything run through the yielded runner in one transaction.
+    Each run() call gets its own savepoint, so a failing one only undoes itself.
+    """
+    def run(fn, *args, **kwargs):
+        with _write():
+            return fn(*args, **kwargs)
+
+    with _transaction(_conn()):
+        yield run
+
+def close_thread_conn():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        return
+    _local.conn = None
+    with _open_lock:
+        if conn in _open_conns:
+            _open_conns.remove(conn)
+    conn.close()
+
+def close_db():
+    """Closes every pooled connection; threads reopen lazily if used again."""
+    global _generation
+    with _open_lock:
+        conns = list(_open_conns)
+        _open_conns.clear()
+        _generation += 1
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
 
 def _now_iso():
     return datetime.now(timezone.utc).isoformat()
 
-def init_db():
-    conn = _conn()
-    cur = conn.cursor()
+def _now_stamp():
+    """(iso, epoch seconds) for the same instant."""
+    now = datetime.now(timezone.utc)
+    return now.isoformat(), int(now.timestamp())
+
+def to_stamp(value) -> tuple[str, int]:
+    """
+    (iso, epoch) for an imported timestamp: epoch seconds or an ISO 8601 string
+    (naive means UTC). None means now. Raises ValueError on anything else.
+    """
+    if value is None or value == "":
+        return _now_stamp()
+    if isinstance(value, bool):
+        raise ValueError("invalid ts")
+    if isinstance(value, (int, float)):
+        try:
+            dt = datetime.fromtimestamp(value, timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            # inf, nan, or outside what datetime/the platform can represent
+            raise ValueError("ts out of range") from None
+    elif isinstance(value, str):
+        dt = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+    else:
+        raise ValueError("invalid ts")
+    return dt.isoformat(), int(dt.timestamp())
+
+# --- Schema Migrations ---
+# Numbered, append-only. PRAGMA user_version records the last one applied, so
+# startup does no DDL at all once the schema is current.
+
+# (content table, fts table, indexed columns). chat_key is not a real column: it is
+# indexed from 'c' || hex(chat_id), one token per chat, so MATCH scopes to exactly one
+# chat ("dashboard" never matches "dashboard-x", nor "100" match "-100")
+FTS_TABLES = [
+    ("study_logs", "study_fts", ("chat_key", "topic", "raw_text")),
+    ("resource_links", "resource_fts", ("chat_key", "title", "url", "raw_text")),
+]
+FTS_BACKFILL_KEY = "fts_backfill"
+# kv_state key holding the next getUpdates offset (long-polling mode)
+POLL_OFFSET_KEY = "poll_offset"
+# kv_state key holding how far topic_backfill_step() has got
+TOPIC_BACKFILL_KEY = "topic_backfill"
 
+def _fts_sources(cols) -> list[str]:
+    """The content-table columns behind FTS_TABLES columns."""
+    return ["chat_id" if c == "chat_key" else c for c in cols]
+
+def _fts_values(cols, row: str) -> str:
+    """SQL for the values cols are indexed from, read off row ("new", "old" or a table name)."""
+    return ", ".join(f"'c' || hex({row}.chat_id)" if c == "chat_key" else f"{row}.{c}" for c in cols)
+
+def _fts_chat_key(chat_id) -> str:
+    # what the FTS5 tokenizer makes of 'c' || hex(chat_id): hex of the UTF-8 text, folded to lower case
+    return "c" + str(chat_id).encode().hex()
+
+def _m001_base(cur):
     # Core Study Tables
     cur.execute("""
     CREATE TABLE IF NOT EXISTS study_logs (
@@ -74,122 +289,1364 @@ def init_db():
       FOREIGN KEY(session_id) REFERENCES quiz_sessions(id)
     )""")
 
-    conn.commit()
-    conn.close()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS processed_updates (
+      update_id INTEGER PRIMARY KEY,
+      ts TEXT NOT NULL
+    )""")
+
+def _m002_indexes_and_epochs(cur):
+    # chat-scoped lookups; rowid is implicitly the trailing key, so ORDER BY id is covered
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_study_logs_chat ON study_logs(chat_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_resource_links_chat ON resource_links(chat_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_quiz_sessions_chat_status ON quiz_sessions(chat_id, status)")
+
+    # keep the first copy of any duplicated question before enforcing uniqueness
+    cur.execute("""
+    DELETE FROM quiz_questions WHERE id NOT IN (
+      SELECT MIN(id) FROM quiz_questions GROUP BY session_id, q_idx
+    )""")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_quiz_questions_session_idx ON quiz_questions(session_id, q_idx)")
+
+    # integer unix-epoch copies of the ISO timestamps, for range queries
+    cur.execute("ALTER TABLE study_logs ADD COLUMN ts_epoch INTEGER")
+    cur.execute("UPDATE study_logs SET ts_epoch = CAST(strftime('%s', ts) AS INTEGER)")
+    cur.execute("ALTER TABLE resource_links ADD COLUMN ts_epoch INTEGER")
+    cur.execute("UPDATE resource_links SET ts_epoch = CAST(strftime('%s', ts) AS INTEGER)")
+    cur.execute("ALTER TABLE quiz_sessions ADD COLUMN created_epoch INTEGER")
+    cur.execute("UPDATE quiz_sessions SET created_epoch = CAST(strftime('%s', created_ts) AS INTEGER)")
+
+def _m003_study_seq(cur):
+    # per-chat 1..n numbering so a random pick is one index seek, not ORDER BY RANDOM()
+    cur.execute("ALTER TABLE study_logs ADD COLUMN seq INTEGER")
+    cur.execute("""
+    UPDATE study_logs SET seq = x.rn FROM (
+      SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id) AS rn FROM study_logs
+    ) AS x WHERE x.id = study_logs.id""")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_study_logs_chat_seq ON study_logs(chat_id, seq)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS study_counts (
+      chat_id TEXT PRIMARY KEY,
+      n INTEGER NOT NULL
+    )""")
+    cur.execute("INSERT INTO study_counts (chat_id, n) SELECT chat_id, COUNT(*) FROM study_logs GROUP BY chat_id")
+
+def _m004_review_schedule(cur):
+    # SM-2 state per study item; (chat_id, due_at) makes "next due" an index seek
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS review_schedule (
+      study_id INTEGER PRIMARY KEY,
+      chat_id TEXT NOT NULL,
+      due_at INTEGER NOT NULL,
+      interval_days REAL NOT NULL DEFAULT 0,
+      ease REAL NOT NULL DEFAULT 2.5,
+      reps INTEGER NOT NULL DEFAULT 0,
+      lapses INTEGER NOT NULL DEFAULT 0,
+      last_review INTEGER,
+      FOREIGN KEY(study_id) REFERENCES study_logs(id)
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_review_schedule_chat_due ON review_schedule(chat_id, due_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_study_logs_chat_topic ON study_logs(chat_id, topic)")
+    cur.execute("""
+    INSERT OR IGNORE INTO review_schedule (study_id, chat_id, due_at)
+    SELECT id, chat_id, COALESCE(ts_epoch, CAST(strftime('%s', 'now') AS INTEGER)) + ? FROM study_logs
+    """, (int(SRS_FIRST_REVIEW_HOURS * 3600),))
+
+def _m005_nudge_state(cur):
+    # nudged_at < due_at means "due but not yet pushed to the user"
+    cur.execute("ALTER TABLE review_schedule ADD COLUMN nudged_at INTEGER")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_review_schedule_chat_due_nudged ON review_schedule(chat_id, due_at, nudged_at)")
+    cur.execute("DROP INDEX IF EXISTS idx_review_schedule_chat_due")
+    # small key/value store for background job checkpoints
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS kv_state (
+      key TEXT PRIMARY KEY,
+      value TEXT NOT NULL
+    )""")
+
+def _m006_mode_updated(cur):
+    cur.execute("ALTER TABLE user_modes ADD COLUMN updated_epoch INTEGER")
+
+def _m007_quiz_cache_and_grades(cur):
+    # generated quiz sets, reused across sessions on the same topic
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS quiz_cache (
+      cache_key TEXT PRIMARY KEY,
+      topic TEXT NOT NULL,
+      n INTEGER NOT NULL,
+      model TEXT NOT NULL,
+      items_json TEXT NOT NULL,
+      created_epoch INTEGER NOT NULL,
+      last_used_epoch INTEGER NOT NULL
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_quiz_cache_last_used ON quiz_cache(last_used_epoch)")
+    # 0-10 LLM grade for open-ended answers
+    cur.execute("ALTER TABLE quiz_questions ADD COLUMN grade INTEGER")
+
+def _m008_fts(cur):
+    # external-content FTS5 indexes; chat_id is indexed too so MATCH can scope to one chat
+    cur.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS study_fts USING fts5(
+      chat_id, topic, raw_text, content='study_logs', content_rowid='id', prefix='2 3'
+    )""")
+    cur.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS resource_fts USING fts5(
+      chat_id, title, url, raw_text, content='resource_links', content_rowid='id', prefix='2 3'
+    )""")
+    for table, fts, cols in (("study_logs", "study_fts", ("chat_id", "topic", "raw_text")),
+                             ("resource_links", "resource_fts", ("chat_id", "title", "url", "raw_text"))):
+        new = ", ".join(f"new.{c}" for c in cols)
+        old = ", ".join(f"old.{c}" for c in cols)
+        names = ", ".join(cols)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+          INSERT INTO {fts} (rowid, {names}) VALUES (new.id, {new});
+        END""")
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+          INSERT INTO {fts} ({fts}, rowid, {names}) VALUES ('delete', old.id, {old});
+        END""")
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {names} ON {table} BEGIN
+          INSERT INTO {fts} ({fts}, rowid, {names}) VALUES ('delete', old.id, {old});
+          INSERT INTO {fts} (rowid, {names}) VALUES (new.id, {new});
+        END""")
+    # rows that predate the triggers are indexed later by fts_backfill_step(), a chunk at a time
+    _queue_fts_backfill(cur)
+
+def _queue_fts_backfill(cur):
+    pending = {}
+    for table, _, _ in FTS_TABLES:
+        upto = cur.execute(f"SELECT MAX(id) FROM {table}").fetchone()[0]
+        if upto:
+            pending[table] = {"cursor": 0, "upto": upto}
+    if pending:
+        cur.execute("INSERT OR REPLACE INTO kv_state (key, value) VALUES (?, ?)", (FTS_BACKFILL_KEY, json.dumps(pending)))
+    else:
+        cur.execute("DELETE FROM kv_state WHERE key=?", (FTS_BACKFILL_KEY,))
+
+def _m009_chat_versions(cur):
+    # bumped by every write a dashboard read depends on; drives ETags and the response cache
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS chat_versions (
+      chat_id TEXT PRIMARY KEY,
+      version INTEGER NOT NULL
+    )""")
+
+def _m010_update_inbox(cur):
+    # polled updates land here before Telegram is told to forget them; deleted once handled
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS update_inbox (
+      update_id INTEGER PRIMARY KEY,
+      body TEXT NOT NULL
+    )""")
+
+def _m011_stats_rollups(cur):
+    # running totals and per-day buckets, updated by the writes themselves so stats never scan the logs
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS chat_stats (
+      chat_id TEXT PRIMARY KEY,
+      studies INTEGER NOT NULL DEFAULT 0,
+      resources INTEGER NOT NULL DEFAULT 0,
+      quiz_answered INTEGER NOT NULL DEFAULT 0,
+      quiz_graded INTEGER NOT NULL DEFAULT 0,
+      quiz_correct INTEGER NOT NULL DEFAULT 0,
+      first_day INTEGER,
+      last_day INTEGER,
+      streak_days INTEGER NOT NULL DEFAULT 0,
+      best_streak INTEGER NOT NULL DEFAULT 0
+    )""")
+    # day = days since the epoch (shifted by STATS_DAY_OFFSET_MIN); new_topics counts
+    # topics seen for the first time that week, so a week's distinct topics is a SUM
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS chat_daily_stats (
+      chat_id TEXT NOT NULL,
+      day INTEGER NOT NULL,
+      studies INTEGER NOT NULL DEFAULT 0,
+      resources INTEGER NOT NULL DEFAULT 0,
+      quiz_answered INTEGER NOT NULL DEFAULT 0,
+      quiz_graded INTEGER NOT NULL DEFAULT 0,
+      quiz_correct INTEGER NOT NULL DEFAULT 0,
+      new_topics INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (chat_id, day)
+    ) WITHOUT ROWID""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS chat_topic_weeks (
+      chat_id TEXT NOT NULL,
+      week INTEGER NOT NULL,
+      topic TEXT NOT NULL,
+      PRIMARY KEY (chat_id, week, topic)
+    ) WITHOUT ROWID""")
+    if cur.execute("SELECT 1 FROM study_logs LIMIT 1").fetchone():
+        print("Stats rollups start empty; fill them in from existing rows with: python manage.py rebuild-stats")
+
+def _m012_topic_clusters(cur):
+    # near-duplicate wordings of a topic share a cluster (see topics.py); cluster is the
+    # normalized form of its first wording, label that wording as typed
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS topic_clusters (
+      chat_id TEXT NOT NULL,
+      cluster TEXT NOT NULL,
+      label TEXT NOT NULL,
+      seq INTEGER NOT NULL,
+      size INTEGER NOT NULL DEFAULT 0,
+      sig BLOB NOT NULL,
+      PRIMARY KEY (chat_id, cluster)
+    ) WITHOUT ROWID""")
+    # per-chat 1..n numbering, so recollect can pick a random cluster with one seek
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_topic_clusters_chat_seq ON topic_clusters(chat_id, seq)")
+    # every normalized wording (and acronym key) seen, for exact lookups
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS topic_aliases (
+      chat_id TEXT NOT NULL,
+      alias TEXT NOT NULL,
+      cluster TEXT NOT NULL,
+      PRIMARY KEY (chat_id, alias)
+    ) WITHOUT ROWID""")
+    # LSH band buckets of each cluster's signature
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS topic_lsh (
+      chat_id TEXT NOT NULL,
+      band INTEGER NOT NULL,
+      bucket INTEGER NOT NULL,
+      cluster TEXT NOT NULL,
+      PRIMARY KEY (chat_id, band, bucket, cluster)
+    ) WITHOUT ROWID""")
+    cur.execute("ALTER TABLE study_logs ADD COLUMN cluster TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_study_logs_chat_cluster ON study_logs(chat_id, cluster)")
+    # rows from before clustering are filed later by topic_backfill_step(), a chunk at a time
+    if cur.execute("SELECT 1 FROM study_logs LIMIT 1").fetchone():
+        cur.execute("INSERT OR REPLACE INTO kv_state (key, value) VALUES (?, ?)", (TOPIC_BACKFILL_KEY, json.dumps({"cursor": 0})))
+
+def _m013_fts_chat_key(cur):
+    # scope MATCH by a per-chat token (FTS_TABLES) instead of the tokenized chat_id, which
+    # let one chat's search reach another's rows whenever their ids shared words
+    for _, fts, _ in FTS_TABLES:
+        for suffix in ("ai", "ad", "au"):
+            cur.execute(f"DROP TRIGGER IF EXISTS {fts}_{suffix}")
+        cur.execute(f"DROP TABLE IF EXISTS {fts}")
+    for table, fts, cols in FTS_TABLES:
+        names = ", ".join(cols)
+        new, old = _fts_values(cols, "new"), _fts_values(cols, "old")
+        cur.execute(f"""
+        CREATE VIRTUAL TABLE {fts} USING fts5(
+          {names}, content='{table}', content_rowid='id', prefix='2 3'
+        )""")
+        cur.execute(f"""
+        CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN
+          INSERT INTO {fts} (rowid, {names}) VALUES (new.id, {new});
+        END""")
+        cur.execute(f"""
+        CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN
+          INSERT INTO {fts} ({fts}, rowid, {names}) VALUES ('delete', old.id, {old});
+        END""")
+        cur.execute(f"""
+        CREATE TRIGGER {fts}_au AFTER UPDATE OF {", ".join(_fts_sources(cols))} ON {table} BEGIN
+          INSERT INTO {fts} ({fts}, rowid, {names}) VALUES ('delete', old.id, {old});
+          INSERT INTO {fts} (rowid, {names}) VALUES (new.id, {new});
+        END""")
+    # the new indexes start empty; existing rows are reindexed in the background
+    _queue_fts_backfill(cur)
+
+def _m014_quiz_question_kind(cur):
+    # an explicit question kind instead of reading correct = '' as "open-ended"; open
+    # questions keep NULL options and answer key. SQLite can't relax NOT NULL in place,
+    # so the table is rebuilt (nothing references it)
+    seq = cur.execute("SELECT seq FROM sqlite_sequence WHERE name='quiz_questions'").fetchone()
+    cur.execute("""
+    CREATE TABLE quiz_questions_new (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      session_id INTEGER NOT NULL,
+      q_idx INTEGER NOT NULL,
+      kind TEXT NOT NULL CHECK (kind IN ('mcq', 'open')),
+      question TEXT NOT NULL,
+      a TEXT,
+      b TEXT,
+      c TEXT,
+      d TEXT,
+      correct TEXT,
+      explanation TEXT NOT NULL,
+      user_answer TEXT,
+      grade INTEGER,
+      CHECK (kind = 'open' OR (a IS NOT NULL AND b IS NOT NULL AND c IS NOT NULL AND d IS NOT NULL AND correct IS NOT NULL)),
+      FOREIGN KEY(session_id) REFERENCES quiz_sessions(id)
+    )""")
+    cur.execute("""
+    INSERT INTO quiz_questions_new (id, session_id, q_idx, kind, question, a, b, c, d, correct, explanation, user_answer, grade)
+    SELECT id, session_id, q_idx, CASE WHEN correct = '' THEN 'open' ELSE 'mcq' END, question,
+      NULLIF(a, ''), NULLIF(b, ''), NULLIF(c, ''), NULLIF(d, ''), NULLIF(correct, ''), explanation, user_answer, grade
+    FROM quiz_questions""")
+    cur.execute("DROP TABLE quiz_questions")
+    cur.execute("ALTER TABLE quiz_questions_new RENAME TO quiz_questions")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_quiz_questions_session_idx ON quiz_questions(session_id, q_idx)")
+    if seq:
+        # keep ids from being reused (rebuild_stats_chunk and exports walk them in order)
+        cur.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name='quiz_questions'", (seq[0],))
+
+MIGRATIONS = [
+    _m001_base,
+    _m002_indexes_and_epochs,
+    _m003_study_seq,
+    _m004_review_schedule,
+    _m005_nudge_state,
+    _m006_mode_updated,
+    _m007_quiz_cache_and_grades,
+    _m008_fts,
+    _m009_chat_versions,
+    _m010_update_inbox,
+    _m011_stats_rollups,
+    _m012_topic_clusters,
+    _m013_fts_chat_key,
+    _m014_quiz_question_kind,
+]
+
+def schema_version() -> int:
+    return _conn().execute("PRAGMA user_version").fetchone()[0]
+
+def init_db():
+    if schema_version() < len(MIGRATIONS):
+        for version, migrate in enumerate(MIGRATIONS, start=1):
+            with _write() as cur:
+                # re-check under the write lock in case another process got here first
+                if cur.execute("PRAGMA user_version").fetchone()[0] >= version:
+                    continue
+                migrate(cur)
+                cur.execute(f"PRAGMA user_version={version}")
+    # an earlier build could spread chats over several files; this one reads only DB_PATH
+    layout = get_state("shard_layout")
+    if layout and (layout.get("shards", 1) != 1 or layout.get("resharding_to") is not None):
+        raise RuntimeError(f"{DB_PATH} is laid out for {layout.get('resharding_to') or layout['shards']} shard files, "
+                           "which this version no longer supports")
+
+# --- Update Dedup ---
+def mark_update_seen(update_id: int) -> bool:
+    """
+    Records a Telegram update_id. Returns False if it was already seen
+    (i.e. a redelivery that should be skipped).
+    """
+    update_id = int(update_id)
+    with _write() as cur:
+        cur.execute("INSERT OR IGNORE INTO processed_updates (update_id, ts) VALUES (?, ?)", (update_id, _now_iso()))
+        fresh = cur.rowcount == 1
+        if fresh and update_id % 100 == 0:
+            # update_ids increase monotonically, so trim everything below the window
+            cur.execute("DELETE FROM processed_updates WHERE update_id <= ?", (update_id - UPDATE_DEDUP_WINDOW,))
+    return fresh
+
+# --- Polled Update Inbox ---
+def inbox_updates(updates: list[dict], next_offset: int):
+    """
+    Stores a getUpdates batch together with the offset that will confirm it,
+    in one transaction: by the time Telegram drops the batch it is durable here.
+    """
+    with _write() as cur:
+        cur.executemany("INSERT OR IGNORE INTO update_inbox (update_id, body) VALUES (?, ?)",
+                        [(int(u["update_id"]), json.dumps(u)) for u in updates])
+        cur.execute("INSERT OR REPLACE INTO kv_state (key, value) VALUES (?, ?)", (POLL_OFFSET_KEY, json.dumps(next_offset)))
+
+def get_inbox() -> list[dict]:
+    """Polled updates not yet handled (left over from a crash or shutdown), oldest first."""
+    cur = _conn().cursor()
+    cur.execute("SELECT body FROM update_inbox ORDER BY update_id")
+    return [json.loads(r[0]) for r in cur.fetchall()]
+
+def ack_inbox(update_id: int):
+    with _write() as cur:
+        cur.execute("DELETE FROM update_inbox WHERE update_id=?", (int(update_id),))
 
 # --- Mode Management ---
+_mode_cache = LRUCache(MODE_CACHE_SIZE, ttl=MODE_CACHE_TTL_SEC, name="modes")
+
 def set_mode(chat_id, mode):
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("INSERT OR REPLACE INTO user_modes (chat_id, mode) VALUES (?, ?)", (str(chat_id), mode))
-    conn.commit()
-    conn.close()
+    chat_id, now = str(chat_id), int(time.time())
+    with _write() as cur:
+        cur.execute("INSERT OR REPLACE INTO user_modes (chat_id, mode, updated_epoch) VALUES (?, ?, ?)", (chat_id, mode, now))
+        # only cache once it's durable, so a rolled-back batch can't leave a phantom mode
+        _after_commit(lambda: _mode_cache.put(chat_id, (mode, now)))
 
 def get_mode(chat_id):
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("SELECT mode FROM user_modes WHERE chat_id=?", (str(chat_id),))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else ""
+    chat_id = str(chat_id)
+    entry = _mode_cache.get(chat_id)
+    if entry is MISSING:
+        cur = _conn().cursor()
+        cur.execute("SELECT mode, updated_epoch FROM user_modes WHERE chat_id=?", (chat_id,))
+        row = cur.fetchone()
+        entry = (row[0] or "", row[1]) if row else ("", None)
+        _mode_cache.add(chat_id, entry)
+    mode, updated = entry
+    if (MODE_IDLE_EXPIRE_SEC and mode in MODE_EXPIRING
+            and updated is not None and time.time() - updated > MODE_IDLE_EXPIRE_SEC):
+        return ""
+    return mode
+
+def mode_cache_stats() -> dict:
+    return _mode_cache.stats()
+
+def quiz_session_cache_stats() -> dict:
+    return {"sessions": _session_cache.stats(), "questions": _question_cache.stats()}
+
+# --- Chat Versions ---
+_version_cache = LRUCache(CHAT_VERSION_CACHE_SIZE, ttl=CHAT_VERSION_CACHE_TTL_SEC, name="chat_versions")
+
+def _bump_version(cur, chat_id) -> int:
+    chat_id = str(chat_id)
+    cur.execute("""
+      INSERT INTO chat_versions (chat_id, version) VALUES (?, 1)
+      ON CONFLICT(chat_id) DO UPDATE SET version = version + 1
+      RETURNING version
+    """, (chat_id,))
+    version = cur.fetchone()[0]
+    _after_commit(lambda: _version_cache.put(chat_id, version))
+    return version
+
+def get_chat_version(chat_id) -> int:
+    """Monotonic counter of writes to a chat's data; 0 if it has none yet."""
+    chat_id = str(chat_id)
+    version = _version_cache.get(chat_id)
+    if version is MISSING:
+        row = _conn().execute("SELECT version FROM chat_versions WHERE chat_id=?", (chat_id,)).fetchone()
+        version = row[0] if row else 0
+        _version_cache.add(chat_id, version)
+    return version
+
+def chat_version_cache_stats() -> dict:
+    return _version_cache.stats()
 
 # --- Study & Resource Functions ---
-def append_study(chat_id, user_id, username, topic, raw_text):
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO study_logs (chat_id, user_id, username, topic, raw_text, ts) VALUES (?,?,?,?,?,?)",
-                (str(chat_id), str(user_id), username, topic, raw_text, _now_iso()))
-    conn.commit()
-    conn.close()
+def append_study(chat_id, user_id, username, topic, raw_text) -> str:
+    """Saves a study item; returns the label of the topic cluster it was filed under."""
+    ts, epoch = _now_stamp()
+    with _write() as cur:
+        seq = _next_study_seq(cur, chat_id)
+        clustered = _assign_cluster(cur, chat_id, topic)
+        cur.execute("INSERT INTO study_logs (chat_id, user_id, username, topic, raw_text, ts, ts_epoch, seq, cluster) VALUES (?,?,?,?,?,?,?,?,?)",
+                    (str(chat_id), str(user_id), username, topic, raw_text, ts, epoch, seq, clustered and clustered["cluster"]))
+        cur.execute("INSERT INTO review_schedule (study_id, chat_id, due_at) VALUES (?, ?, ?)",
+                    (cur.lastrowid, str(chat_id), epoch + int(SRS_FIRST_REVIEW_HOURS * 3600)))
+        _add_stats(cur, [(chat_id, epoch, _STUDIED, topic)])
+        _bump_version(cur, chat_id)
+    return clustered["label"] if clustered else topic
 
 def get_recent_study(chat_id, n=5):
-    conn = _conn()
-    cur = conn.cursor()
+    cur = _conn().cursor()
     cur.execute("SELECT topic, ts FROM study_logs WHERE chat_id=? ORDER BY id DESC LIMIT ?", (str(chat_id), n))
     rows = cur.fetchall()
-    conn.close()
     return [{"topic": r[0], "ts": r[1]} for r in rows]
 
-def get_random_study(chat_id):
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("SELECT topic, ts FROM study_logs WHERE chat_id=? ORDER BY RANDOM() LIMIT 1", (str(chat_id),))
+def get_study_page(chat_id, limit: int = 20, before_id: int | None = None) -> list[dict]:
+    """Newest-first keyset page: rows with id < before_id, walked down idx_study_logs_chat."""
+    cur = _conn().cursor()
+    cur.execute("SELECT id, topic, raw_text, ts FROM study_logs WHERE chat_id=? AND id<? ORDER BY id DESC LIMIT ?",
+                (str(chat_id), before_id if before_id is not None else 2**63 - 1, limit))
+    return [{"id": r[0], "topic": r[1], "raw_text": r[2], "ts": r[3]} for r in cur.fetchall()]
+
+def get_resource_page(chat_id, limit: int = 20, before_id: int | None = None) -> list[dict]:
+    cur = _conn().cursor()
+    cur.execute("SELECT id, title, url, raw_text, ts FROM resource_links WHERE chat_id=? AND id<? ORDER BY id DESC LIMIT ?",
+                (str(chat_id), before_id if before_id is not None else 2**63 - 1, limit))
+    return [{"id": r[0], "title": r[1], "url": r[2], "raw_text": r[3], "ts": r[4]} for r in cur.fetchall()]
+
+def _next_study_seq(cur, chat_id) -> int:
+    cur.execute("""
+      INSERT INTO study_counts (chat_id, n) VALUES (?, 1)
+      ON CONFLICT(chat_id) DO UPDATE SET n = n + 1
+      RETURNING n
+    """, (str(chat_id),))
+    return cur.fetchone()[0]
+
+def get_random_study(chat_id, older_bias: float | None = None):
+    """
+    Random study item for a chat in O(log n): pick a seq in 1..count, then seek.
+    older_bias > 1 favours older items (seq drawn as count * u**bias). With
+    RECOLLECT_BY_CLUSTER the draw is over topic clusters instead of items.
+    """
+    cur = _conn().cursor()
+    bias = RECOLLECT_OLDER_BIAS if older_bias is None else older_bias
+    if RECOLLECT_BY_CLUSTER:
+        # same draw over clusters, then the cluster's latest item
+        cur.execute("SELECT MAX(seq) FROM topic_clusters WHERE chat_id=?", (str(chat_id),))
+        n = cur.fetchone()[0]
+        if n:
+            seq = 1 + min(n - 1, int(n * random.random() ** bias))
+            cur.execute("""
+              SELECT s.id, s.topic, s.ts FROM study_logs s
+              WHERE s.chat_id=? AND s.cluster=(SELECT cluster FROM topic_clusters WHERE chat_id=? AND seq>=? ORDER BY seq LIMIT 1)
+              ORDER BY s.id DESC LIMIT 1
+            """, (str(chat_id), str(chat_id), seq))
+            row = cur.fetchone()
+            if row:
+                return {"id": row[0], "topic": row[1], "ts": row[2]}
+    cur.execute("SELECT n FROM study_counts WHERE chat_id=?", (str(chat_id),))
     row = cur.fetchone()
-    conn.close()
-    return {"topic": row[0], "ts": row[1]} if row else None
+    if not row or not row[0]:
+        return None
+    seq = 1 + min(row[0] - 1, int(row[0] * random.random() ** bias))
+    # >= rather than = so a gap in seq (e.g. a deleted row) still lands on something
+    cur.execute("SELECT id, topic, ts FROM study_logs WHERE chat_id=? AND seq>=? ORDER BY seq LIMIT 1", (str(chat_id), seq))
+    row = cur.fetchone()
+    return {"id": row[0], "topic": row[1], "ts": row[2]} if row else None
 
 def append_resource_link(chat_id, user_id, title, url, raw_text):
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO resource_links (chat_id, user_id, title, url, raw_text, ts) VALUES (?,?,?,?,?,?)",
-                (str(chat_id), str(user_id), title, url, raw_text, _now_iso()))
-    conn.commit()
-    conn.close()
+    ts, epoch = _now_stamp()
+    with _write() as cur:
+        cur.execute("INSERT INTO resource_links (chat_id, user_id, title, url, raw_text, ts, ts_epoch) VALUES (?,?,?,?,?,?,?)",
+                    (str(chat_id), str(user_id), title, url, raw_text, ts, epoch))
+        _add_stats(cur, [(chat_id, epoch, _SAVED_RESOURCE, None)])
+        _bump_version(cur, chat_id)
+
+def append_study_bulk(rows: list[tuple]) -> int:
+    """
+    Inserts many study rows in one transaction with executemany.
+    rows: (chat_id, user_id, username, topic, raw_text, ts, ts_epoch), already validated.
+    """
+    with _write() as cur:
+        counts = {}
+        for r in rows:
+            counts[str(r[0])] = counts.get(str(r[0]), 0) + 1
+        # reserve a block of seq numbers per chat with one upsert each
+        next_seq = {}
+        for chat_id, k in counts.items():
+            cur.execute("""
+              INSERT INTO study_counts (chat_id, n) VALUES (?, ?)
+              ON CONFLICT(chat_id) DO UPDATE SET n = n + excluded.n
+              RETURNING n
+            """, (chat_id, k))
+            next_seq[chat_id] = cur.fetchone()[0] - k + 1
+        # one cluster lookup per distinct (chat, topic), however often it repeats
+        clusters = {}
+        for r in rows:
+            key = (str(r[0]), r[3])
+            clusters[key] = clusters.get(key, 0) + 1
+        for (chat_id, topic), k in clusters.items():
+            clustered = _assign_cluster(cur, chat_id, topic, k)
+            clusters[(chat_id, topic)] = clustered and clustered["cluster"]
+        params = []
+        for chat_id, user_id, username, topic, raw_text, ts, epoch in rows:
+            chat_id = str(chat_id)
+            params.append((chat_id, str(user_id), username, topic, raw_text, ts, epoch, next_seq[chat_id], clusters[(chat_id, topic)]))
+            next_seq[chat_id] += 1
+        last_id = cur.execute("SELECT COALESCE(MAX(id), 0) FROM study_logs").fetchone()[0]
+        cur.executemany("INSERT INTO study_logs (chat_id, user_id, username, topic, raw_text, ts, ts_epoch, seq, cluster) VALUES (?,?,?,?,?,?,?,?,?)",
+                        params)
+        cur.execute("INSERT INTO review_schedule (study_id, chat_id, due_at) SELECT id, chat_id, ts_epoch + ? FROM study_logs WHERE id > ?",
+                    (int(SRS_FIRST_REVIEW_HOURS * 3600), last_id))
+        _add_stats(cur, [(r[0], r[6], _STUDIED, r[3]) for r in rows])
+        for chat_id in counts:
+            _bump_version(cur, chat_id)
+    return len(rows)
+
+def append_resource_links_bulk(rows: list[tuple]) -> int:
+    """rows: (chat_id, user_id, title, url, raw_text, ts, ts_epoch), already validated."""
+    with _write() as cur:
+        cur.executemany("INSERT INTO resource_links (chat_id, user_id, title, url, raw_text, ts, ts_epoch) VALUES (?,?,?,?,?,?,?)",
+                        [(str(r[0]), str(r[1]), *r[2:]) for r in rows])
+        _add_stats(cur, [(r[0], r[6], _SAVED_RESOURCE, None) for r in rows])
+        for chat_id in {str(r[0]) for r in rows}:
+            _bump_version(cur, chat_id)
+    return len(rows)
+
+# --- Topic Clusters ---
+def _lsh_candidates(cur, chat_id: str, sig: tuple) -> list[dict]:
+    """Clusters sharing an LSH band with sig, at TOPIC_RELATED_THRESHOLD or closer, most similar first."""
+    keys = topics.band_keys(sig)
+    # one statement, one primary-key seek per band
+    cur.execute(f"""
+      SELECT DISTINCT l.cluster FROM (VALUES {", ".join("(?, ?)" for _ in keys)}) v
+      JOIN topic_lsh l ON l.chat_id=? AND l.band=v.column1 AND l.bucket=v.column2
+    """, (*(v for band, bucket in enumerate(keys) for v in (band, bucket)), chat_id))
+    scored = []
+    for (cluster,) in cur.fetchall():
+        cur.execute("SELECT label, size, sig FROM topic_clusters WHERE chat_id=? AND cluster=?", (chat_id, cluster))
+        label, size, blob = cur.fetchone()
+        similarity = topics.similarity(sig, topics.unpack(blob))
+        if similarity >= topics.TOPIC_RELATED_THRESHOLD:
+            scored.append({"cluster": cluster, "label": label, "size": size, "similarity": round(similarity, 3)})
+    scored.sort(key=lambda c: (-c["similarity"], -c["size"]))
+    return scored
+
+def _alias_cluster(cur, chat_id: str, norm: str) -> str | None:
+    cur.execute("SELECT cluster FROM topic_aliases WHERE chat_id=? AND alias=?", (chat_id, norm))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def _match_cluster(cur, chat_id: str, norm: str) -> tuple[str | None, tuple | None]:
+    """
+    (cluster, signature) for a wording that isn't a known alias: an acronym
+    match, else the most similar LSH candidate if it reaches
+    TOPIC_MATCH_THRESHOLD. The signature is None when it wasn't needed.
+    """
+    lookup, _ = topics.acronym_keys(norm)
+    if lookup:
+        cur.execute("SELECT cluster FROM topic_aliases WHERE chat_id=? AND alias=?", (chat_id, lookup))
+        row = cur.fetchone()
+        if row:
+            return row[0], None
+    sig = topics.signature(norm)
+    candidates = _lsh_candidates(cur, chat_id, sig)
+    if candidates and candidates[0]["similarity"] >= topics.TOPIC_MATCH_THRESHOLD:
+        return candidates[0]["cluster"], sig
+    return None, sig
+
+def _assign_cluster(cur, chat_id, topic: str, count: int = 1) -> dict | None:
+    """
+    Files `count` study rows on topic under its cluster, learning a new wording
+    as an alias or starting a new cluster. Only a cluster's first wording goes
+    into the LSH index; later ones are reached through their alias.
+    Returns {"cluster", "label"}, or None for a topic without any words.
+    """
+    chat_id = str(chat_id)
+    norm = topics.normalize(topic)
+    if not norm:
+        return None
+    cluster = _alias_cluster(cur, chat_id, norm)
+    if cluster is None:
+        cluster, sig = _match_cluster(cur, chat_id, norm)
+        if cluster is None:
+            cluster = norm
+            cur.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM topic_clusters WHERE chat_id=?", (chat_id,))
+            cur.execute("INSERT INTO topic_clusters (chat_id, cluster, label, seq, sig) VALUES (?, ?, ?, ?, ?)",
+                        (chat_id, cluster, topic.strip(), cur.fetchone()[0], topics.pack(sig)))
+            cur.executemany("INSERT OR IGNORE INTO topic_lsh (chat_id, band, bucket, cluster) VALUES (?, ?, ?, ?)",
+                            [(chat_id, band, bucket, cluster) for band, bucket in enumerate(topics.band_keys(sig))])
+        _, acronym = topics.acronym_keys(norm)
+        cur.executemany("INSERT OR IGNORE INTO topic_aliases (chat_id, alias, cluster) VALUES (?, ?, ?)",
+                        [(chat_id, alias, cluster) for alias in (norm, acronym) if alias])
+    cur.execute("UPDATE topic_clusters SET size = size + ? WHERE chat_id=? AND cluster=? RETURNING label", (count, chat_id, cluster))
+    return {"cluster": cluster, "label": cur.fetchone()[0]}
+
+def canonical_topic(chat_id, topic: str) -> dict | None:
+    """The cluster topic would be filed under, as {"cluster", "label", "size"}; None if it would start a new one."""
+    chat_id = str(chat_id)
+    norm = topics.normalize(topic)
+    if not norm:
+        return None
+    cur = _conn().cursor()
+    cluster = _alias_cluster(cur, chat_id, norm) or _match_cluster(cur, chat_id, norm)[0]
+    if cluster is None:
+        return None
+    cur.execute("SELECT label, size FROM topic_clusters WHERE chat_id=? AND cluster=?", (chat_id, cluster))
+    label, size = cur.fetchone()
+    return {"cluster": cluster, "label": label, "size": size}
+
+def related_topics(chat_id, topic: str, limit: int = 5) -> list[dict]:
+    """Other clusters close to topic, most similar first: {"cluster", "label", "size", "similarity"}."""
+    chat_id = str(chat_id)
+    norm = topics.normalize(topic)
+    if not norm:
+        return []
+    cur = _conn().cursor()
+    own = _alias_cluster(cur, chat_id, norm) or _match_cluster(cur, chat_id, norm)[0]
+    return [c for c in _lsh_candidates(cur, chat_id, topics.signature(norm)) if c["cluster"] != own][:limit]
+
+def topic_backfill_step(limit: int = TOPIC_BACKFILL_CHUNK) -> int:
+    """
+    Files the next chunk of pre-clustering study rows under their
+    topic clusters, in one short transaction. Returns how many rows it looked
+    at; 0 once the backfill is finished.
+    """
+    with _write() as cur:
+        row = cur.execute("SELECT value FROM kv_state WHERE key=?", (TOPIC_BACKFILL_KEY,)).fetchone()
+        if not row:
+            return 0
+        cursor = json.loads(row[0])["cursor"]
+        rows = cur.execute("SELECT id, chat_id, topic FROM study_logs WHERE id > ? AND cluster IS NULL ORDER BY id LIMIT ?",
+                           (cursor, limit)).fetchall()
+        if not rows:
+            cur.execute("DELETE FROM kv_state WHERE key=?", (TOPIC_BACKFILL_KEY,))
+            return 0
+        clusters = {}
+        for _, chat_id, topic in rows:
+            clusters[(chat_id, topic)] = clusters.get((chat_id, topic), 0) + 1
+        for (chat_id, topic), k in clusters.items():
+            clustered = _assign_cluster(cur, chat_id, topic, k)
+            clusters[(chat_id, topic)] = clustered and clustered["cluster"]
+        cur.executemany("UPDATE study_logs SET cluster=? WHERE id=?", [(clusters[(c, t)], i) for i, c, t in rows])
+        # topic and related-topic reads are cached per chat version
+        for chat_id in {c for _, c, _ in rows}:
+            _bump_version(cur, chat_id)
+        cur.execute("UPDATE kv_state SET value=? WHERE key=?", (json.dumps({"cursor": rows[-1][0]}), TOPIC_BACKFILL_KEY))
+    return len(rows)
 
 # --- Quiz Session Logic ---
-def create_quiz_session(chat_id: str, user_id: str, topic: str, questions: list[dict]) -> int:
-    conn = _conn()
-    cur = conn.cursor()
+# chat_id -> active session dict (or None); (session_id, q_idx) -> question dict
+_session_cache = LRUCache(QUIZ_SESSION_CACHE_SIZE, ttl=QUIZ_SESSION_CACHE_TTL_SEC, name="quiz_sessions")
+_question_cache = LRUCache(QUIZ_SESSION_CACHE_SIZE * 5, ttl=QUIZ_SESSION_CACHE_TTL_SEC, name="quiz_questions")
+
+def _insert_quiz_question(cur, session_id: int, q_idx: int, q: dict):
+    kind = q.get("kind", "mcq")
+    if kind == "open":
+        options = (None, None, None, None, None)
+    else:
+        options = (q["A"], q["B"], q["C"], q["D"], q["correct"])
     cur.execute("""
-      INSERT INTO quiz_sessions (chat_id, user_id, topic, created_ts, status, current_idx, score, total)
-      VALUES (?, ?, ?, ?, 'active', 0, 0, ?)
-    """, (str(chat_id), str(user_id), topic, _now_iso(), len(questions)))
-    session_id = cur.lastrowid
-    for i, q in enumerate(questions):
+      INSERT INTO quiz_questions (session_id, q_idx, kind, question, a, b, c, d, correct, explanation)
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (session_id, q_idx, kind, q["question"], *options, q.get("explanation", "")))
+
+def create_quiz_session(chat_id: str, user_id: str, topic: str, questions: list[dict], total: int | None = None) -> int:
+    """
+    questions: [{"question", "kind", "A".."D", "correct", "explanation"}]. kind
+    is "mcq" (the default) or "open"; an open-ended question has no options or
+    correct letter and is graded later by the LLM.
+    total: expected question count when the rest arrive later via add_quiz_question.
+    """
+    ts, epoch = _now_stamp()
+    with _write() as cur:
         cur.execute("""
-          INSERT INTO quiz_questions (session_id, q_idx, question, a, b, c, d, correct, explanation)
-          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (session_id, i, q["question"], q["A"], q["B"], q["C"], q["D"], q["correct"], q.get("explanation", "")))
-    conn.commit()
-    conn.close()
+          INSERT INTO quiz_sessions (chat_id, user_id, topic, created_ts, created_epoch, status, current_idx, score, total)
+          VALUES (?, ?, ?, ?, ?, 'active', 0, 0, ?)
+        """, (str(chat_id), str(user_id), topic, ts, epoch, total or len(questions)))
+        session_id = cur.lastrowid
+        for i, q in enumerate(questions):
+            _insert_quiz_question(cur, session_id, i, q)
+        session = {"id": session_id, "topic": topic, "current_idx": 0, "score": 0, "total": total or len(questions)}
+        _after_commit(lambda: _session_cache.put(str(chat_id), session))
+        _bump_version(cur, chat_id)
     return session_id
 
+def add_quiz_question(session_id: int, q_idx: int, q: dict) -> dict:
+    """Appends a late-arriving question; returns the session's current_idx/status."""
+    with _write() as cur:
+        _insert_quiz_question(cur, session_id, q_idx, q)
+        cur.execute("SELECT current_idx, status FROM quiz_sessions WHERE id=?", (session_id,))
+        current_idx, status = cur.fetchone()
+    return {"current_idx": current_idx, "status": status}
+
+def set_quiz_total(session_id: int, total: int) -> dict:
+    """
+    Fixes the question count once generation is over (it may fall short of the
+    planned total). Closes the session if the user already answered them all;
+    "closed" says whether this call did so.
+    """
+    with _write() as cur:
+        cur.execute("SELECT current_idx, status FROM quiz_sessions WHERE id=?", (session_id,))
+        current_idx, status = cur.fetchone()
+        closed = status == "active" and current_idx >= total
+        cur.execute("""
+          UPDATE quiz_sessions SET total=?, status=? WHERE id=?
+          RETURNING id, topic, current_idx, score, total, status, chat_id
+        """, (total, "done" if closed else status, session_id))
+        row = cur.fetchone()
+        _bump_version(cur, row[6])
+        if row[5] == "active":
+            _after_commit(lambda: _session_cache.put(str(row[6]), _session_dict(row)))
+        elif closed:
+            _after_commit(lambda: _session_cache.put(str(row[6]), None))
+    return {"current_idx": current_idx, "closed": closed}
+
+def _session_dict(row):
+    return {"id": row[0], "topic": row[1], "current_idx": row[2], "score": row[3], "total": row[4]}
+
 def get_active_quiz_session(chat_id: str):
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, topic, current_idx, score, total FROM quiz_sessions WHERE chat_id=? AND status='active' ORDER BY id DESC LIMIT 1", (str(chat_id),))
-    row = cur.fetchone()
-    conn.close()
-    return {"id": row[0], "topic": row[1], "current_idx": row[2], "score": row[3], "total": row[4]} if row else None
+    chat_id = str(chat_id)
+    session = _session_cache.get(chat_id)
+    if session is MISSING:
+        cur = _conn().cursor()
+        cur.execute("SELECT id, topic, current_idx, score, total FROM quiz_sessions WHERE chat_id=? AND status='active' ORDER BY id DESC LIMIT 1", (chat_id,))
+        row = cur.fetchone()
+        session = _session_dict(row) if row else None
+        _session_cache.add(chat_id, session)
+    return dict(session) if session else None
 
 def get_quiz_question(session_id: int, q_idx: int):
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("SELECT question, a, b, c, d, correct, explanation, user_answer FROM quiz_questions WHERE session_id=? AND q_idx=? LIMIT 1", (session_id, q_idx))
-    row = cur.fetchone()
-    conn.close()
-    return {"question": row[0], "A": row[1], "B": row[2], "C": row[3], "D": row[4], "correct": row[5], "explanation": row[6], "user_answer": row[7]} if row else None
+    key = (session_id, q_idx)
+    q = _question_cache.get(key)
+    if q is MISSING:
+        cur = _conn().cursor()
+        cur.execute("SELECT question, a, b, c, d, correct, explanation, user_answer, kind FROM quiz_questions WHERE session_id=? AND q_idx=? LIMIT 1", (session_id, q_idx))
+        row = cur.fetchone()
+        if not row:
+            # not cached: a streamed quiz may still be about to insert it
+            return None
+        q = {"question": row[0], "kind": row[8], "A": row[1], "B": row[2], "C": row[3], "D": row[4], "correct": row[5], "explanation": row[6], "user_answer": row[7]}
+        _question_cache.add(key, q)
+    return dict(q)
 
 def answer_quiz_question(session_id: int, q_idx: int, answer: str) -> dict:
-    answer = (answer or "").strip().upper()
-    if answer not in ["A", "B", "C", "D"]: return {"error": "Invalid answer."}
-    q = get_quiz_question(session_id, q_idx)
-    if not q: return {"error": "Question not found."}
-    if q["user_answer"]: return {"error": "Already answered."}
-    
-    conn = _conn()
-    cur = conn.cursor()
-    is_correct = (answer == q["correct"])
-    cur.execute("UPDATE quiz_questions SET user_answer=? WHERE session_id=? AND q_idx=?", (answer, session_id, q_idx))
-    cur.execute("SELECT score, total, current_idx FROM quiz_sessions WHERE id=?", (session_id,))
-    score, total, current_idx = cur.fetchone()
-    
-    if is_correct: score += 1
-    next_idx = current_idx + 1
-    done = (next_idx >= total)
-    
-    status = 'done' if done else 'active'
-    cur.execute("UPDATE quiz_sessions SET score=?, current_idx=?, status=? WHERE id=?", (score, next_idx, status, session_id))
-    
-    conn.commit()
-    conn.close()
-    return {"is_correct": is_correct, "correct": q["correct"], "explanation": q["explanation"], "new_score": score, "done": done, "next_idx": next_idx, "total": total}
+    """
+    Records the answer and advances the session in one transaction.
+    The UPDATE only matches an unanswered question, so a double tap can't
+    score the same question twice.
+    """
+    raw = (answer or "").strip()
+    letter = raw.upper()
+    with _write() as cur:
+        # open-ended questions keep the text; MCQ takes one of A-D
+        cur.execute("""
+          UPDATE quiz_questions SET user_answer = CASE WHEN kind = 'open' THEN ? ELSE ? END
+          WHERE session_id=? AND q_idx=? AND user_answer IS NULL
+            AND CASE WHEN kind = 'open' THEN ? != '' ELSE ? IN ('A', 'B', 'C', 'D') END
+          RETURNING kind, correct, explanation, user_answer
+        """, (raw, letter, session_id, q_idx, raw, letter))
+        row = cur.fetchone()
+        if not row:
+            return {"error": _answer_error(cur, session_id, q_idx)}
+        kind, correct, explanation, stored = row
+        open_ended = kind == "open"
+        # open-ended answers are scored later by record_quiz_grades
+        is_correct = None if open_ended else (stored == correct)
+
+        cur.execute("""
+          UPDATE quiz_sessions SET score = score + ?, current_idx = current_idx + 1,
+            status = CASE WHEN current_idx + 1 >= total THEN 'done' ELSE status END
+          WHERE id=? RETURNING id, topic, current_idx, score, total, status, chat_id, created_epoch
+        """, (1 if is_correct else 0, session_id))
+        srow = cur.fetchone()
+        score, total, next_idx, status, chat_id, topic = srow[3], srow[4], srow[2], srow[5], srow[6], srow[1]
+        if not open_ended:
+            _review_topic(cur, chat_id, topic, 5 if is_correct else 2)
+        # open-ended answers count as graded once record_quiz_grades scores them; quiz stats
+        # land on the session's day, as rebuild_stats_chunk puts them
+        _add_stats(cur, [(chat_id, srow[7] or 0, (0, 0, 1, 0, 0) if open_ended else (0, 0, 1, 1, int(is_correct)), None)])
+        _bump_version(cur, chat_id)
 
-def create_quiz_session(chat_id: str, topic: str):
-    # placeholder for future quiz-session persistence
-    return {"chat_id": chat_id, "topic": topic}
+        done = status == "done"
+        session = None if done else _session_dict(srow)
+        _after_commit(lambda: _session_cache.put(str(chat_id), session))
+        _after_commit(lambda: _question_cache.pop((session_id, q_idx)))
 
+    return {"is_correct": is_correct, "correct": correct, "explanation": explanation, "new_score": score, "done": done, "next_idx": next_idx, "total": total}
+
+def _answer_error(cur, session_id: int, q_idx: int) -> str:
+    cur.execute("SELECT kind, user_answer FROM quiz_questions WHERE session_id=? AND q_idx=?", (session_id, q_idx))
+    row = cur.fetchone()
+    if not row:
+        return "Question not found."
+    if row[1] is not None:
+        return "Already answered."
+    return "Empty answer." if row[0] == "open" else "Invalid answer."
+
+def get_quiz_answers(session_id: int) -> list[dict]:
+    cur = _conn().cursor()
+    cur.execute("SELECT q_idx, kind, question, explanation, user_answer FROM quiz_questions WHERE session_id=? ORDER BY q_idx", (session_id,))
+    return [{"q_idx": r[0], "kind": r[1], "question": r[2], "ideal": r[3], "user_answer": r[4]} for r in cur.fetchall()]
+
+def record_quiz_grades(session_id: int, grades: dict[int, int]):
+    """
+    Stores 0-10 grades for open-ended answers (q_idx -> grade); other
+    questions are left alone. A grade of QUIZ_PASS_GRADE or more counts
+    towards the session score, and the average grade feeds the topic's
+    review schedule.
+    """
+    with _write() as cur:
+        # a regrade only moves the stats by the difference
+        graded = correct = 0
+        kept = {}
+        for q_idx, grade in grades.items():
+            cur.execute("SELECT grade FROM quiz_questions WHERE session_id=? AND q_idx=? AND kind='open'", (session_id, q_idx))
+            old = cur.fetchone()
+            if old is None:
+                continue
+            cur.execute("UPDATE quiz_questions SET grade=? WHERE session_id=? AND q_idx=?", (int(grade), session_id, q_idx))
+            kept[q_idx] = grade
+            graded += old[0] is None
+            correct += (grade >= QUIZ_PASS_GRADE) - (old[0] is not None and old[0] >= QUIZ_PASS_GRADE)
+        grades = kept
+        # multiple-choice answers in the same session keep the point they scored when answered
+        passed = sum(1 for g in grades.values() if g >= QUIZ_PASS_GRADE) + cur.execute(
+            "SELECT COUNT(*) FROM quiz_questions WHERE session_id=? AND kind='mcq' AND user_answer = correct", (session_id,)
+        ).fetchone()[0]
+        cur.execute("UPDATE quiz_sessions SET score=? WHERE id=? RETURNING chat_id, topic, total, created_epoch", (passed, session_id))
+        row = cur.fetchone()
+        if row and grades:
+            avg = sum(grades.values()) / len(grades)
+            _review_topic(cur, row[0], row[1], round(avg / 2))
+        if row:
+            if graded or correct:
+                _add_stats(cur, [(row[0], row[3] or 0, (0, 0, 0, graded, correct), None)])
+            _bump_version(cur, row[0])
+    return {"score": passed, "total": row[2] if row else len(grades)}
+
+# --- Quiz Cache ---
+def get_cached_quiz(cache_key: str, max_age_sec: int):
+    cur = _conn().cursor()
+    cur.execute("SELECT items_json, created_epoch FROM quiz_cache WHERE cache_key=?", (cache_key,))
+    row = cur.fetchone()
+    if not row or time.time() - row[1] > max_age_sec:
+        return None
+    return json.loads(row[0])
+
+def put_cached_quiz(cache_key: str, topic: str, n: int, model: str, items: list[dict], max_rows: int, max_age_sec: int):
+    now = int(time.time())
+    with _write() as cur:
+        cur.execute("""
+          INSERT OR REPLACE INTO quiz_cache (cache_key, topic, n, model, items_json, created_epoch, last_used_epoch)
+          VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (cache_key, topic, n, model, json.dumps(items), now, now))
+        cur.execute("DELETE FROM quiz_cache WHERE created_epoch < ?", (now - max_age_sec,))
+        cur.execute("SELECT COUNT(*) FROM quiz_cache")
+        excess = cur.fetchone()[0] - max_rows
+        if excess > 0:
+            cur.execute("""
+              DELETE FROM quiz_cache WHERE cache_key IN (
+                SELECT cache_key FROM quiz_cache ORDER BY last_used_epoch LIMIT ?
+              )""", (excess,))
+
+def touch_cached_quiz(cache_key: str):
+    with _write() as cur:
+        cur.execute("UPDATE quiz_cache SET last_used_epoch=? WHERE cache_key=?", (int(time.time()), cache_key))
+
+# --- Spaced Repetition (SM-2) ---
+def _sm2(interval_days: float, ease: float, reps: int, lapses: int, quality: int):
+    """One SM-2 step. quality: 0-5 (>=3 counts as recalled)."""
+    if quality < 3:
+        reps, lapses, interval_days = 0, lapses + 1, 1.0
+    else:
+        reps += 1
+        interval_days = 1.0 if reps == 1 else 6.0 if reps == 2 else round(interval_days * ease, 1)
+    ease = max(1.3, ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    return interval_days, ease, reps, lapses
+
+def _apply_review(cur, study_id: int, quality: int, now: int):
+    cur.execute("SELECT interval_days, ease, reps, lapses FROM review_schedule WHERE study_id=?", (study_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    interval_days, ease, reps, lapses = _sm2(*row, quality)
+    due_at = now + int(interval_days * 86400)
+    cur.execute("""
+      UPDATE review_schedule SET due_at=?, interval_days=?, ease=?, reps=?, lapses=?, last_review=?
+      WHERE study_id=?
+    """, (due_at, interval_days, ease, reps, lapses, now, study_id))
+    return {"study_id": study_id, "due_at": due_at, "interval_days": interval_days, "ease": round(ease, 2), "reps": reps}
+
+def _review_topic(cur, chat_id, topic: str, quality: int):
+    # a quiz on a topic counts as a review of the latest study item in its cluster (or with that exact topic)
+    cluster = _alias_cluster(cur, str(chat_id), topics.normalize(topic))
+    if cluster:
+        cur.execute("SELECT id FROM study_logs WHERE chat_id=? AND cluster=? ORDER BY id DESC LIMIT 1", (str(chat_id), cluster))
+    else:
+        cur.execute("SELECT id FROM study_logs WHERE chat_id=? AND topic=? ORDER BY id DESC LIMIT 1", (str(chat_id), topic))
+    row = cur.fetchone()
+    if row:
+        _apply_review(cur, row[0], quality, int(datetime.now(timezone.utc).timestamp()))
+
+def record_review(chat_id, study_id: int, quality: int):
+    """
+    Updates an item's schedule after the user reviewed it. Items of the same
+    topic cluster that are also due count as reviewed too, since it was one
+    subject. Returns the item's new schedule or None.
+    """
+    quality = max(0, min(5, int(quality)))
+    now = int(datetime.now(timezone.utc).timestamp())
+    with _write() as cur:
+        cur.execute("SELECT 1 FROM review_schedule WHERE study_id=? AND chat_id=?", (int(study_id), str(chat_id)))
+        if not cur.fetchone():
+            return None
+        _bump_version(cur, chat_id)
+        cur.execute("""
+          SELECT r.study_id FROM review_schedule r JOIN study_logs s ON s.id = r.study_id
+          WHERE s.chat_id=? AND s.cluster=(SELECT cluster FROM study_logs WHERE id=?) AND r.due_at<=? AND r.study_id!=?
+        """, (str(chat_id), int(study_id), now, int(study_id)))
+        for (sibling,) in cur.fetchall():
+            _apply_review(cur, sibling, quality, now)
+        return _apply_review(cur, int(study_id), quality, now)
+
+def get_due_item(chat_id, now: int | None = None):
+    """Most overdue study item for the chat, or None if nothing is due yet."""
+    now = int(datetime.now(timezone.utc).timestamp()) if now is None else now
+    cur = _conn().cursor()
+    cur.execute("""
+      SELECT s.id, s.topic, s.ts, r.due_at FROM review_schedule r
+      JOIN study_logs s ON s.id = r.study_id
+      WHERE r.chat_id=? AND r.due_at<=?
+      ORDER BY r.due_at LIMIT 1
+    """, (str(chat_id), now))
+    row = cur.fetchone()
+    return {"id": row[0], "topic": row[1], "ts": row[2], "due_at": row[3]} if row else None
 
-# Placeholder for nudge logic
-def get_due_item(chat_id): return None
 def get_next_item_anytime(chat_id): return get_random_study(chat_id)
+
+# --- Nudge Broadcast ---
+def get_chats_with_pending_nudges(after_chat_id: str, now: int, limit: int = 500) -> list[str]:
+    """Keyset page of chats (ordered by chat_id, > after_chat_id) with a due, un-nudged item."""
+    cur = _conn().cursor()
+    cur.execute("""
+      SELECT chat_id FROM review_schedule
+      WHERE chat_id > ? AND due_at <= ? AND (nudged_at IS NULL OR nudged_at < due_at)
+      GROUP BY chat_id ORDER BY chat_id LIMIT ?
+    """, (after_chat_id, now, limit))
+    return [r[0] for r in cur.fetchall()]
+
+def claim_due_nudge(chat_id, now: int):
+    """
+    Atomically picks the chat's most overdue un-nudged item and marks it
+    nudged, along with the other due items of its topic cluster: one nudge per subject.
+    The returned item's "nudged" lists every id marked, for release_nudge().
+    """
+    with _write() as cur:
+        cur.execute("""
+          SELECT s.id, s.topic, s.ts, r.due_at, s.cluster FROM review_schedule r
+          JOIN study_logs s ON s.id = r.study_id
+          WHERE r.chat_id=? AND r.due_at<=? AND (r.nudged_at IS NULL OR r.nudged_at < r.due_at)
+          ORDER BY r.due_at LIMIT 1
+        """, (str(chat_id), now))
+        row = cur.fetchone()
+        if not row:
+            return None
+        cur.execute("UPDATE review_schedule SET nudged_at=? WHERE study_id=?", (now, row[0]))
+        nudged = [row[0]]
+        if row[4] is not None:
+            cur.execute("""
+              UPDATE review_schedule SET nudged_at=?
+              WHERE chat_id=? AND due_at<=? AND (nudged_at IS NULL OR nudged_at < due_at)
+                AND study_id IN (SELECT id FROM study_logs WHERE chat_id=? AND cluster=?)
+              RETURNING study_id
+            """, (now, str(chat_id), now, str(chat_id), row[4]))
+            nudged += [r[0] for r in cur.fetchall()]
+    return {"id": row[0], "topic": row[1], "ts": row[2], "due_at": row[3], "nudged": nudged}
+
+def release_nudge(chat_id, study_ids: list[int], now: int):
+    """Undoes claim_due_nudge(chat_id, now) for a prompt that never went out, so a later sweep retries it."""
+    if not study_ids:
+        return
+    with _write() as cur:
+        cur.execute(f"""
+          UPDATE review_schedule SET nudged_at=NULL
+          WHERE chat_id=? AND nudged_at=? AND study_id IN ({",".join("?" * len(study_ids))})
+        """, (str(chat_id), now, *study_ids))
+
+# --- Stats Rollups ---
+# per-event deltas: (studies, resources, quiz_answered, quiz_graded, quiz_correct)
+_STUDIED = (1, 0, 0, 0, 0)
+_SAVED_RESOURCE = (0, 1, 0, 0, 0)
+_STAT_COLUMNS = ("studies", "resources", "quiz_answered", "quiz_graded", "quiz_correct")
+# a bucket that counts towards streaks (quiz_correct alone can be a correction)
+_ACTIVE_DAY = "(studies > 0 OR resources > 0 OR quiz_answered > 0 OR quiz_graded > 0)"
+
+def stats_day(epoch: float) -> int:
+    """Day bucket for a unix time: days since the epoch at STATS_DAY_OFFSET_MIN."""
+    return int(epoch + STATS_DAY_OFFSET_MIN * 60) // 86400
+
+def _day_date(day: int | None) -> str | None:
+    return None if day is None else datetime.fromtimestamp(day * 86400, tz=timezone.utc).date().isoformat()
+
+def _week_of(day: int) -> int:
+    # weeks start on Monday; day 0 (1970-01-01) was a Thursday
+    return (day + 3) // 7
+
+def _add_stats(cur, events, streaks: bool = True):
+    """
+    Folds events into the rollups inside the caller's transaction.
+    events: (chat_id, epoch, deltas, topic or None), deltas as in _STUDIED.
+    A day new to the chat extends the streak in O(1) when it is the chat's
+    latest; a backdated one (bulk import) recounts it from the day buckets.
+    A day whose deltas are only corrections (a regrade lowering quiz_correct)
+    adjusts an existing bucket but never creates one or counts as active.
+    streaks=False leaves streaks to a later recount_streaks().
+    """
+    days, topics = {}, {}
+    for chat_id, epoch, deltas, topic in events:
+        chat_id, day = str(chat_id), stats_day(epoch)
+        bucket = days.setdefault((chat_id, day), [0] * 6)
+        for i, d in enumerate(deltas):
+            bucket[i] += d
+        if topic:
+            key = (chat_id, _week_of(day), " ".join(topic.lower().split()))
+            topics[key] = min(day, topics.get(key, day))
+    for (chat_id, week, topic), day in topics.items():
+        cur.execute("INSERT OR IGNORE INTO chat_topic_weeks (chat_id, week, topic) VALUES (?, ?, ?)", (chat_id, week, topic))
+        days[(chat_id, day)][5] += cur.rowcount
+
+    chats = {}
+    for (chat_id, day), bucket in sorted(days.items()):
+        # days come in ascending order per chat, so the first active one is the earliest
+        totals, span, new_days = chats.setdefault(chat_id, ([0] * 5, [None, None], []))
+        for i in range(5):
+            totals[i] += bucket[i]
+        if not any(n > 0 for n in bucket[:4]):
+            cur.execute("""
+              UPDATE chat_daily_stats SET studies = studies + ?, resources = resources + ?,
+                quiz_answered = quiz_answered + ?, quiz_graded = quiz_graded + ?, quiz_correct = quiz_correct + ?,
+                new_topics = new_topics + ?
+              WHERE chat_id=? AND day=?
+            """, (*bucket, chat_id, day))
+            continue
+        cur.execute("""
+          INSERT INTO chat_daily_stats (chat_id, day, studies, resources, quiz_answered, quiz_graded, quiz_correct, new_topics)
+          VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+          ON CONFLICT(chat_id, day) DO UPDATE SET
+            studies = studies + excluded.studies, resources = resources + excluded.resources,
+            quiz_answered = quiz_answered + excluded.quiz_answered, quiz_graded = quiz_graded + excluded.quiz_graded,
+            quiz_correct = quiz_correct + excluded.quiz_correct, new_topics = new_topics + excluded.new_topics
+          RETURNING studies + resources + quiz_answered + quiz_graded
+        """, (chat_id, day, *bucket))
+        # activity counts only grow, so the row is new iff it holds exactly this batch's
+        if cur.fetchone()[0] == sum(bucket[:4]):
+            new_days.append(day)
+        span[0] = day if span[0] is None else span[0]
+        span[1] = day
+
+    for chat_id, (totals, span, new_days) in chats.items():
+        if span[0] is None:
+            # corrections only: the chat's active days are unchanged
+            cur.execute("""
+              UPDATE chat_stats SET studies = studies + ?, resources = resources + ?, quiz_answered = quiz_answered + ?,
+                quiz_graded = quiz_graded + ?, quiz_correct = quiz_correct + ?
+              WHERE chat_id=?
+            """, (*totals, chat_id))
+            continue
+        cur.execute("""
+          INSERT INTO chat_stats (chat_id, studies, resources, quiz_answered, quiz_graded, quiz_correct, first_day, last_day)
+          VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+          ON CONFLICT(chat_id) DO UPDATE SET
+            studies = studies + excluded.studies, resources = resources + excluded.resources,
+            quiz_answered = quiz_answered + excluded.quiz_answered, quiz_graded = quiz_graded + excluded.quiz_graded,
+            quiz_correct = quiz_correct + excluded.quiz_correct,
+            first_day = MIN(first_day, excluded.first_day), last_day = MAX(last_day, excluded.last_day)
+          RETURNING last_day
+        """, (chat_id, *totals, *span))
+        last_day = cur.fetchone()[0]
+        if not new_days or not streaks:
+            continue
+        if new_days == [last_day]:
+            cur.execute(f"SELECT MAX(day) FROM chat_daily_stats WHERE chat_id=? AND day<? AND {_ACTIVE_DAY}", (chat_id, last_day))
+            extends = cur.fetchone()[0] == last_day - 1
+            cur.execute("""
+              UPDATE chat_stats SET streak_days = CASE WHEN ? THEN streak_days + 1 ELSE 1 END,
+                best_streak = MAX(best_streak, CASE WHEN ? THEN streak_days + 1 ELSE 1 END)
+              WHERE chat_id=?
+            """, (extends, extends, chat_id))
+        else:
+            _recount_streaks(cur, chat_id)
+
+def _streaks(days) -> tuple[int, int]:
+    """(run ending at the last day, longest run) over ascending day numbers."""
+    run = best = 0
+    prev = None
+    for day in days:
+        run = run + 1 if prev == day - 1 else 1
+        best = run if run > best else best
+        prev = day
+    return run, best
+
+def _recount_streaks(cur, chat_id: str):
+    cur.execute(f"SELECT day FROM chat_daily_stats WHERE chat_id=? AND {_ACTIVE_DAY} ORDER BY day", (chat_id,))
+    run, best = _streaks(r[0] for r in cur.fetchall())
+    cur.execute("UPDATE chat_stats SET streak_days=?, best_streak=? WHERE chat_id=?", (run, best, chat_id))
+
+def recount_streaks(conn) -> int:
+    """Recomputes every chat's streaks in one pass over the day buckets."""
+    updates = [(run, best, chat_id) for chat_id, group in itertools.groupby(
+        conn.execute(f"SELECT chat_id, day FROM chat_daily_stats WHERE {_ACTIVE_DAY} ORDER BY chat_id, day"), key=lambda r: r[0])
+        for run, best in [_streaks(r[1] for r in group)]]
+    with _transaction(conn):
+        conn.executemany("UPDATE chat_stats SET streak_days=?, best_streak=? WHERE chat_id=?", updates)
+    return len(updates)
+
+def get_stats(chat_id, days: int = 30, now: float | None = None) -> dict:
+    """
+    Totals, streaks, daily buckets and per-week topic counts for a chat.
+    Reads one chat_stats row plus at most days + 6 bucket rows, however long
+    the history; the window starts on a Monday so every week in it is whole.
+    """
+    chat_id = str(chat_id)
+    conn = _conn()
+    today = stats_day(time.time() if now is None else now)
+    start = _week_of(today - days + 1) * 7 - 3
+    row = conn.execute("""
+      SELECT studies, resources, quiz_answered, quiz_graded, quiz_correct, first_day, last_day, streak_days, best_streak
+      FROM chat_stats WHERE chat_id=?
+    """, (chat_id,)).fetchone() or (0, 0, 0, 0, 0, None, None, 0, 0)
+    buckets = {r[0]: r[1:] for r in conn.execute("""
+      SELECT day, studies, resources, quiz_answered, quiz_graded, quiz_correct, new_topics
+      FROM chat_daily_stats WHERE chat_id=? AND day BETWEEN ? AND ?
+    """, (chat_id, start, today))}
+
+    daily, weekly = [], []
+    for day in range(start, today + 1):
+        counts = buckets.get(day, (0,) * 6)
+        daily.append({"date": _day_date(day), **dict(zip(_STAT_COLUMNS, counts[:5]))})
+        if day == start or _week_of(day) != _week_of(day - 1):
+            weekly.append({"week_start": _day_date(day), "topics": 0, **dict.fromkeys(_STAT_COLUMNS, 0)})
+        week = weekly[-1]
+        week["topics"] += counts[5]
+        for col, n in zip(_STAT_COLUMNS, counts[:5]):
+            week[col] += n
+
+    totals = dict(zip(_STAT_COLUMNS, row[:5]))
+    totals["quiz_accuracy"] = round(row[4] / row[3], 3) if row[3] else None
+    last_day = row[6]
+    return {
+        "totals": totals,
+        # a streak stays current through the day after its last active day
+        "streak": {"current": row[7] if last_day is not None and today - last_day <= 1 else 0, "best": row[8],
+                   "first_active": _day_date(row[5]), "last_active": _day_date(last_day)},
+        "daily": daily,
+        "weekly": weekly,
+    }
+
+# Sources the rollups are rebuilt from (manage.py rebuild-stats): rows after an
+# id, in id order, as (id, chat_id, epoch, *deltas, topic). Quiz answers have no
+# timestamp of their own, so they land on the day their session started.
+STATS_SOURCES = {
+    "study_logs": ("SELECT id, chat_id, ts_epoch, 1, 0, 0, 0, 0, topic FROM study_logs WHERE id > ? ORDER BY id LIMIT ?", ()),
+    "resource_links": ("SELECT id, chat_id, ts_epoch, 0, 1, 0, 0, 0, NULL FROM resource_links WHERE id > ? ORDER BY id LIMIT ?", ()),
+    "quiz_questions": ("""
+      SELECT q.id, s.chat_id, s.created_epoch, 0, 0, 1,
+        q.kind = 'mcq' OR q.grade IS NOT NULL,
+        CASE WHEN q.kind = 'mcq' THEN q.user_answer = q.correct ELSE COALESCE(q.grade >= ?, 0) END,
+        NULL
+      FROM quiz_questions q JOIN quiz_sessions s ON s.id = q.session_id
+      WHERE q.id > ? AND q.user_answer IS NOT NULL ORDER BY q.id LIMIT ?
+    """, (QUIZ_PASS_GRADE,)),
+}
+
+def rebuild_stats_chunk(conn, source: str, after_id: int, limit: int) -> int | None:
+    """
+    Rolls up the next `limit` rows of a STATS_SOURCES table in one transaction,
+    streaks aside (recount_streaks() once every source is in).
+    Returns the id to continue after, or None once the table is done.
+    """
+    sql, params = STATS_SOURCES[source]
+    rows = conn.execute(sql, (*params, after_id, limit)).fetchall()
+    with _transaction(conn):
+        _add_stats(conn.cursor(), [(r[1], r[2] or 0, r[3:8], r[8]) for r in rows], streaks=False)
+    return rows[-1][0] if len(rows) == limit else None
+
+# --- Job State ---
+def get_state(key: str, default=None):
+    cur = _conn().cursor()
+    cur.execute("SELECT value FROM kv_state WHERE key=?", (key,))
+    row = cur.fetchone()
+    return json.loads(row[0]) if row else default
+
+def set_state(key: str, value):
+    with _write() as cur:
+        cur.execute("INSERT OR REPLACE INTO kv_state (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+# --- Full-text Search ---
+def fts_backfill_step(limit: int = FTS_BACKFILL_CHUNK) -> int:
+    """
+    Indexes the next chunk of pre-FTS rows in one short transaction.
+    Returns how many rows it indexed; 0 once the backfill is finished.
+    Chats whose rows it indexes get a new version, so cached search results
+    (ETags, the response cache) from before their rows were searchable go stale.
+    """
+    with _write() as cur:
+        row = cur.execute("SELECT value FROM kv_state WHERE key=?", (FTS_BACKFILL_KEY,)).fetchone()
+        pending = json.loads(row[0]) if row else {}
+        done, chats = 0, set()
+        for table, fts, cols in FTS_TABLES:
+            state = pending.get(table)
+            if not state:
+                continue
+            names = ", ".join(cols)
+            last, n = cur.execute(f"""
+              SELECT MAX(id), COUNT(*) FROM (SELECT id FROM {table} WHERE id > ? AND id <= ? ORDER BY id LIMIT ?)
+            """, (state["cursor"], state["upto"], limit - done)).fetchone()
+            if n:
+                cur.execute(f"INSERT INTO {fts} (rowid, {names}) SELECT id, {_fts_values(cols, table)} FROM {table} "
+                            "WHERE id > ? AND id <= ?", (state["cursor"], last))
+                chats.update(r[0] for r in cur.execute(f"SELECT DISTINCT chat_id FROM {table} WHERE id > ? AND id <= ?",
+                                                       (state["cursor"], last)))
+            done += n
+            if n and last < state["upto"]:
+                state["cursor"] = last
+            else:
+                del pending[table]
+            if done >= limit:
+                break
+        if pending:
+            cur.execute("UPDATE kv_state SET value=? WHERE key=?", (json.dumps(pending), FTS_BACKFILL_KEY))
+        else:
+            cur.execute("DELETE FROM kv_state WHERE key=?", (FTS_BACKFILL_KEY,))
+        for chat_id in chats:
+            _bump_version(cur, chat_id)
+    return done
+
+def _fts_query(chat_id, text: str) -> str | None:
+    """
+    Turns free text into a safe FTS5 query: every word must match (the last one
+    as a prefix, for search-as-you-type) outside chat_key, scoped to the chat's rows.
+    """
+    words = re.findall(r"\w+", text or "")[:16]
+    if not words:
+        return None
+    terms = " ".join(f'"{w}"' for w in words)
+    # a 1-2 letter prefix expands to half the vocabulary; only longer ones are worth it
+    if len(words[-1]) >= 3:
+        terms += "*"
+    return f'chat_key : "{_fts_chat_key(chat_id)}" AND - chat_key : ({terms})'
+
+def _snippet(text: str, words: list[str], width: int = 80) -> str:
+    """A window of text around the first matched word, with matches in [brackets]."""
+    text = " ".join((text or "").split())
+    pattern = re.compile(r"\b(" + "|".join(re.escape(w) for w in words) + r")\w*", re.I)
+    m = pattern.search(text)
+    start = max(0, m.start() - width // 3) if m else 0
+    out = text[start:start + width]
+    out = pattern.sub(lambda x: f"[{x.group(0)}]", out)
+    return ("…" if start else "") + out + ("…" if start + width < len(text) else "")
+
+def search(chat_id, query: str, kind: str = "all", limit: int = 10, offset: int = 0) -> list[dict]:
+    """
+    Ranked (bm25) full-text search over a chat's study logs and/or Learning Bag.
+    kind: "all", "study" or "resources". Titles and topics weigh more than bodies.
+    Only the newest FTS_RANK_WINDOW matches per table are ranked, so a very
+    common word costs about the same as a rare one.
+    """
+    match = _fts_query(chat_id, query)
+    if not match:
+        return []
+    parts, params = [], []
+    if kind in ("all", "study"):
+        parts.append("""
+          SELECT 'study', s.id, s.topic, NULL, s.raw_text, s.ts, m.score
+          FROM (SELECT rowid, bm25(study_fts, 0.0, 4.0, 1.0) AS score FROM study_fts
+                WHERE study_fts MATCH ? ORDER BY rowid DESC LIMIT ?) m
+          JOIN study_logs s ON s.id = m.rowid
+          WHERE s.chat_id = ?""")
+        params += [match, FTS_RANK_WINDOW, str(chat_id)]
+    if kind in ("all", "resources"):
+        parts.append("""
+          SELECT 'resource', r.id, r.title, r.url, r.raw_text, r.ts, m.score
+          FROM (SELECT rowid, bm25(resource_fts, 0.0, 4.0, 2.0, 1.0) AS score FROM resource_fts
+                WHERE resource_fts MATCH ? ORDER BY rowid DESC LIMIT ?) m
+          JOIN resource_links r ON r.id = m.rowid
+          WHERE r.chat_id = ?""")
+        params += [match, FTS_RANK_WINDOW, str(chat_id)]
+    if not parts:
+        return []
+    cur = _conn().cursor()
+    cur.execute(" UNION ALL ".join(parts) + " ORDER BY 7, 2 DESC LIMIT ? OFFSET ?", (*params, limit, offset))
+    # snippets are cut here, for the returned page only, rather than by FTS5 for every ranked row
+    words = re.findall(r"\w+", query)[:16]
+    return [{"kind": r[0], "id": r[1], "title": r[2], "url": r[3], "snippet": _snippet(r[4], words), "ts": r[5], "score": round(r[6], 4)}
+            for r in cur.fetchall()]
+
+# --- Export ---
+# kind -> (columns, query); each query takes chat_id and walks an index in id order
+EXPORTS = {
+    "study": (
+        ("id", "topic", "raw_text", "ts"),
+        "SELECT id, topic, raw_text, ts FROM study_logs WHERE chat_id=? ORDER BY id",
+    ),
+    "resources": (
+        ("id", "title", "url", "raw_text", "ts"),
+        "SELECT id, title, url, raw_text, ts FROM resource_links WHERE chat_id=? ORDER BY id",
+    ),
+    "quiz": (
+        ("session_id", "created_ts", "topic", "status", "score", "total", "q_idx", "kind", "question", "correct", "user_answer", "grade"),
+        """SELECT s.id, s.created_ts, s.topic, s.status, s.score, s.total, q.q_idx, q.kind, q.question, q.correct, q.user_answer, q.grade
+           FROM quiz_sessions s JOIN quiz_questions q ON q.session_id = s.id
+           WHERE s.chat_id=? ORDER BY s.id, q.q_idx""",
+    ),
+}
+
+def iter_export(kind: str, chat_id, batch: int = 500):
+    """
+    Yields rows (tuples, in EXPORTS[kind] column order) straight off a cursor.
+    Uses its own connection so a slow consumer never pins a pooled one; under
+    WAL the open read doesn't block writers.
+    """
+    conn = _open()
+    try:
+        cur = conn.execute(EXPORTS[kind][1], (str(chat_id),))
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
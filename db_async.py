@@ -0,0 +1,260 @@
+"""
+Async facade over db.py for the FastAPI handlers.
+
+Reads run on a small bounded thread pool so they don't block the event loop
+and can overlap. Writes are funnelled to a single writer thread which drains
+whatever is queued and group-commits it in one transaction (one fsync per
+batch instead of per call). Each write still runs in its own savepoint, so one
+failing call doesn't roll back its neighbours.
+
+Same function names as db.py; just await them.
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+
+import db
+import metrics
+
+DB_READ_WORKERS = int(os.getenv("DB_READ_WORKERS", "4"))
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "64"))
+
+_read_pool: ThreadPoolExecutor | None = None
+_write_q: "queue.Queue" = queue.Queue()
+_writer: threading.Thread | None = None
+_start_lock = threading.Lock()
+
+def start():
+    global _read_pool, _writer
+    with _start_lock:
+        if _read_pool is None:
+            _read_pool = ThreadPoolExecutor(max_workers=DB_READ_WORKERS, thread_name_prefix="db-read")
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=_writer_loop, name="db-write", daemon=True)
+            _writer.start()
+
+def shutdown():
+    """Flushes queued writes, then stops the writer thread and read pool."""
+    global _read_pool, _writer
+    with _start_lock:
+        if _writer is not None:
+            _write_q.put(None)
+            _writer.join()
+            _writer = None
+        if _read_pool is not None:
+            _read_pool.shutdown(wait=True)
+            _read_pool = None
+
+def _writer_loop():
+    stop = False
+    while not stop:
+        job = _write_q.get()
+        if job is None:
+            break
+        jobs = [job]
+        while len(jobs) < DB_WRITE_BATCH:
+            try:
+                job = _write_q.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                stop = True
+                break
+            jobs.append(job)
+        _run_batch(jobs)
+    db.close_thread_conn()
+
+def _run_batch(jobs):
+    metrics.db_write_batch.observe(len(jobs))
+    results = []
+    try:
+        with db.write_batch() as run:
+            for fn, args, kwargs, fut in jobs:
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                try:
+                    results.append((fut, run(fn, *args, **kwargs), None))
+                except Exception as e:
+                    results.append((fut, None, e))
+    except Exception as e:
+        # BEGIN/COMMIT itself failed: nothing in the batch is durable
+        for *_, fut in jobs:
+            if not fut.done() and (fut.running() or fut.set_running_or_notify_cancel()):
+                fut.set_exception(e)
+        return
+    for fut, res, err in results:
+        if err is not None:
+            fut.set_exception(err)
+        else:
+            fut.set_result(res)
+
+async def _read(fn, *args, **kwargs):
+    if _read_pool is None:
+        start()
+    loop = asyncio.get_running_loop()
+    if not metrics.METRICS_ENABLED:
+        return await loop.run_in_executor(_read_pool, partial(fn, *args, **kwargs))
+    t = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_read_pool, partial(fn, *args, **kwargs))
+    except Exception:
+        metrics.db_errors.inc(fn.__name__, "read")
+        raise
+    finally:
+        metrics.db_seconds.observe(time.perf_counter() - t, fn.__name__, "read")
+
+async def _write(fn, *args, **kwargs):
+    if _writer is None:
+        start()
+    fut = Future()
+    _write_q.put((fn, args, kwargs, fut))
+    if not metrics.METRICS_ENABLED:
+        return await asyncio.wrap_future(fut)
+    t = time.perf_counter()
+    try:
+        return await asyncio.wrap_future(fut)
+    except Exception:
+        metrics.db_errors.inc(fn.__name__, "write")
+        raise
+    finally:
+        metrics.db_seconds.observe(time.perf_counter() - t, fn.__name__, "write")
+
+def write_queue_depth() -> int:
+    return _write_q.qsize()
+
+# --- Update Dedup ---
+async def mark_update_seen(update_id: int) -> bool:
+    return await _write(db.mark_update_seen, update_id)
+
+# --- Polled Update Inbox ---
+async def inbox_updates(updates: list[dict], next_offset: int):
+    return await _write(db.inbox_updates, updates, next_offset)
+
+async def get_inbox() -> list[dict]:
+    return await _read(db.get_inbox)
+
+async def ack_inbox(update_id: int):
+    return await _write(db.ack_inbox, update_id)
+
+# --- Mode Management ---
+async def set_mode(chat_id, mode):
+    return await _write(db.set_mode, chat_id, mode)
+
+async def get_mode(chat_id):
+    return await _read(db.get_mode, chat_id)
+
+# --- Chat Versions ---
+async def get_chat_version(chat_id) -> int:
+    return await _read(db.get_chat_version, chat_id)
+
+# --- Study & Resource Functions ---
+async def append_study(chat_id, user_id, username, topic, raw_text):
+    return await _write(db.append_study, chat_id, user_id, username, topic, raw_text)
+
+async def get_recent_study(chat_id, n=5):
+    return await _read(db.get_recent_study, chat_id, n=n)
+
+async def get_study_page(chat_id, limit: int = 20, before_id: int | None = None) -> list[dict]:
+    return await _read(db.get_study_page, chat_id, limit, before_id)
+
+async def get_resource_page(chat_id, limit: int = 20, before_id: int | None = None) -> list[dict]:
+    return await _read(db.get_resource_page, chat_id, limit, before_id)
+
+async def get_random_study(chat_id):
+    return await _read(db.get_random_study, chat_id)
+
+async def append_resource_link(chat_id, user_id, title, url, raw_text):
+    return await _write(db.append_resource_link, chat_id, user_id, title, url, raw_text)
+
+async def append_study_bulk(rows: list[tuple]) -> int:
+    return await _write(db.append_study_bulk, rows)
+
+async def append_resource_links_bulk(rows: list[tuple]) -> int:
+    return await _write(db.append_resource_links_bulk, rows)
+
+# --- Quiz Session Logic ---
+async def create_quiz_session(chat_id: str, user_id: str, topic: str, questions: list[dict], total: int | None = None) -> int:
+    return await _write(db.create_quiz_session, chat_id, user_id, topic, questions, total)
+
+async def add_quiz_question(session_id: int, q_idx: int, q: dict) -> dict:
+    return await _write(db.add_quiz_question, session_id, q_idx, q)
+
+async def set_quiz_total(session_id: int, total: int) -> dict:
+    return await _write(db.set_quiz_total, session_id, total)
+
+async def get_active_quiz_session(chat_id: str):
+    return await _read(db.get_active_quiz_session, chat_id)
+
+async def get_quiz_question(session_id: int, q_idx: int):
+    return await _read(db.get_quiz_question, session_id, q_idx)
+
+async def answer_quiz_question(session_id: int, q_idx: int, answer: str) -> dict:
+    return await _write(db.answer_quiz_question, session_id, q_idx, answer)
+
+async def get_quiz_answers(session_id: int) -> list[dict]:
+    return await _read(db.get_quiz_answers, session_id)
+
+async def record_quiz_grades(session_id: int, grades: dict[int, int]):
+    return await _write(db.record_quiz_grades, session_id, grades)
+
+# --- Quiz Cache ---
+async def get_cached_quiz(cache_key: str, max_age_sec: int):
+    return await _read(db.get_cached_quiz, cache_key, max_age_sec)
+
+async def put_cached_quiz(cache_key: str, topic: str, n: int, model: str, items: list[dict], max_rows: int, max_age_sec: int):
+    return await _write(db.put_cached_quiz, cache_key, topic, n, model, items, max_rows, max_age_sec)
+
+async def touch_cached_quiz(cache_key: str):
+    return await _write(db.touch_cached_quiz, cache_key)
+
+# --- Spaced Repetition ---
+async def record_review(chat_id, study_id: int, quality: int):
+    return await _write(db.record_review, chat_id, study_id, quality)
+
+async def get_due_item(chat_id):
+    return await _read(db.get_due_item, chat_id)
+
+async def get_next_item_anytime(chat_id):
+    return await _read(db.get_next_item_anytime, chat_id)
+
+# --- Nudge Broadcast ---
+async def get_chats_with_pending_nudges(after_chat_id: str, now: int, limit: int = 500) -> list[str]:
+    return await _read(db.get_chats_with_pending_nudges, after_chat_id, now, limit)
+
+async def claim_due_nudge(chat_id, now: int):
+    return await _write(db.claim_due_nudge, chat_id, now)
+
+async def release_nudge(chat_id, study_ids: list[int], now: int):
+    return await _write(db.release_nudge, chat_id, study_ids, now)
+
+# --- Topic Clusters ---
+async def canonical_topic(chat_id, topic: str) -> dict | None:
+    return await _read(db.canonical_topic, chat_id, topic)
+
+async def related_topics(chat_id, topic: str, limit: int = 5) -> list[dict]:
+    return await _read(db.related_topics, chat_id, topic, limit)
+
+async def topic_backfill_step(limit: int = db.TOPIC_BACKFILL_CHUNK) -> int:
+    return await _write(db.topic_backfill_step, limit)
+
+# --- Stats Rollups ---
+async def get_stats(chat_id, days: int = 30) -> dict:
+    return await _read(db.get_stats, chat_id, days)
+
+# --- Job State ---
+async def get_state(key: str, default=None):
+    return await _read(db.get_state, key, default)
+
+async def set_state(key: str, value):
+    return await _write(db.set_state, key, value)
+
+# --- Full-text Search ---
+async def search(chat_id, query: str, kind: str = "all", limit: int = 10, offset: int = 0) -> list[dict]:
+    return await _read(db.search, chat_id, query, kind, limit, offset)
+
+async def fts_backfill_step(limit: int = db.FTS_BACKFILL_CHUNK) -> int:
+    return await _write(db.fts_backfill_step, limit)
@@ -0,0 +1,92 @@
+"""
+Per-key ordered work queue drained by N asyncio workers.
+
+Items with the same key (usually a chat_id) are handled one at a time, in
+submission order; different keys run in parallel. Used for outbound Telegram
+sends and for inbound update processing.
+"""
+import asyncio
+from collections import deque
+
+class Lanes:
+    def __init__(self, handler, workers: int = 8, max_pending: int = 10000, name: str = "lanes"):
+        self.handler = handler          # async def handler(key, item)
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.name = name
+        self._lanes: dict = {}          # key -> deque of pending items
+        self._ready: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._pending = 0
+        self._idle: asyncio.Event | None = None
+
+    @property
+    def depth(self) -> int:
+        return self._pending
+
+    def start(self):
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = [asyncio.create_task(self._worker(), name=f"{self.name}-{i}") for i in range(self.workers)]
+
+    def submit(self, key, item) -> bool:
+        """Queues item behind earlier items for key. Returns False when full."""
+        if not self._tasks:
+            self.start()
+        if self._pending >= self.max_pending:
+            return False
+        self._pending += 1
+        self._idle.clear()
+        lane = self._lanes.get(key)
+        if lane is None:
+            # new lane: nobody owns it yet, so schedule it
+            self._lanes[key] = deque([item])
+            self._ready.put_nowait(key)
+        else:
+            # lane is either queued in _ready or held by a worker that will requeue it
+            lane.append(item)
+        return True
+
+    async def join(self):
+        """Waits until everything submitted so far has been handled."""
+        if self._tasks:
+            await self._idle.wait()
+
+    async def stop(self, timeout: float = 10.0):
+        """Drains pending work (up to timeout), then cancels the workers."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"{self.name}: dropping {self._pending} pending items on shutdown")
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._lanes.clear()
+        self._pending = 0
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            lane = self._lanes[key]
+            item = lane.popleft()
+            try:
+                await self.handler(key, item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"{self.name} error:", repr(e))
+            finally:
+                self._pending -= 1
+                if lane:
+                    # back of the line so one busy key can't starve the others
+                    self._ready.put_nowait(key)
+                else:
+                    del self._lanes[key]
+                if self._pending == 0:
+                    self._idle.set()
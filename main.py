@@ -1,50 +1,151 @@
 import os
-import httpx
+import asyncio
+import base64
+import csv
+import hashlib
+import io
+import json
+import time
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
-from db import (
-    init_db,
+import db
+import metrics
+from db import init_db, close_db, mode_cache_stats, quiz_session_cache_stats, chat_version_cache_stats
+from cache import LRUCache, MISSING
+import db_async
+import tg_client
+import nudger
+import poller
+import quiz_cache
+import prefetch
+import topics
+import agent_llm
+from agent_llm import llm_grade_answers
+from db_async import (
     append_study,
+    get_chat_version,
     get_recent_study,
+    get_study_page,
+    get_resource_page,
     get_random_study,
     set_mode,
     get_mode,
     append_resource_link,
     get_due_item,
     get_next_item_anytime,
+    mark_update_seen,
+    record_review,
+    create_quiz_session,
+    get_active_quiz_session,
+    get_quiz_question,
+    answer_quiz_question,
+    get_quiz_answers,
+    record_quiz_grades,
+    add_quiz_question,
+    set_quiz_total,
+    search,
+    canonical_topic,
+    related_topics,
+    get_stats,
+    append_study_bulk,
+    append_resource_links_bulk,
 )
+from lanes import Lanes
 
 from agent import (
-    norm,
-    is_help,
-    is_recent,
-    is_recollect,
-    is_add_resource,
-    is_cancel,
-    extract_study_topic,
+    Intent,
+    route,
     extract_url,
     HELP_TEXT,
 )
 
 load_dotenv()
-app = FastAPI()
 init_db()
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "").strip()
 ALLOWED_USER_ID = os.getenv("ALLOWED_USER_ID", "").strip()
 DASHBOARD_TOKEN = os.getenv("DASHBOARD_TOKEN", "").strip()
 VERCEL_ORIGIN = os.getenv("VERCEL_ORIGIN", "*").strip()
+# Ack webhooks immediately and process updates on background workers
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "").strip().lower() in {"1", "true", "yes"}
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "10000"))
+# Send quiz question 1 while the rest are still being generated
+QUIZ_STREAMING = os.getenv("QUIZ_STREAMING", "1").strip().lower() in {"1", "true", "yes"}
+SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS", "5"))
+# Bulk import: rows per transaction, per request, and how many row errors to report
+BULK_CHUNK_ROWS = int(os.getenv("BULK_CHUNK_ROWS", "1000"))
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "200000"))
+BULK_MAX_ERRORS = int(os.getenv("BULK_MAX_ERRORS", "100"))
+# Largest page the history endpoints will return
+API_PAGE_MAX = int(os.getenv("API_PAGE_MAX", "100"))
+# Rendered dashboard responses, keyed by the chat's data version
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL_SEC = float(os.getenv("RESPONSE_CACHE_TTL_SEC", "300"))
+# /api/nudge/next also changes as items fall due, so its cache key rolls over this often
+NUDGE_CACHE_BUCKET_SEC = int(os.getenv("NUDGE_CACHE_BUCKET_SEC", "60"))
+# Longest window of daily buckets /api/stats returns
+STATS_MAX_DAYS = int(os.getenv("STATS_MAX_DAYS", "366"))
+
+_response_cache = LRUCache(RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL_SEC, name="responses")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    db_async.start()
+    await tg_client.start(TELEGRAM_BOT_TOKEN)
+    prefetch.start()
+    if TELEGRAM_BOT_TOKEN:
+        nudger.start(send_nudge)
+        if poller.TELEGRAM_POLLING:
+            poller.start(process_update, update_chat_key)
+    backfills = [asyncio.create_task(fts_backfill()), asyncio.create_task(topic_backfill())]
+    yield
+    for task in backfills:
+        task.cancel()
+    await asyncio.gather(*backfills, return_exceptions=True)
+    await poller.stop()
+    await nudger.stop()
+    await prefetch.stop()
+    await _update_lanes.stop()
+    await tg_client.stop()
+    await agent_llm.aclose()
+    db_async.shutdown()
+    close_db()
+
+async def fts_backfill():
+    # index rows saved before full-text search existed, a chunk per write transaction
+    try:
+        while await db_async.fts_backfill_step():
+            await asyncio.sleep(0)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print("FTS backfill error:", repr(e))
+
+async def topic_backfill():
+    # file study rows saved before topic clustering under their clusters
+    try:
+        while await db_async.topic_backfill_step():
+            await asyncio.sleep(0)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print("Topic backfill error:", repr(e))
 
-TELEGRAM_API = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[VERCEL_ORIGIN] if VERCEL_ORIGIN != "*" else ["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
 def allowed(user_id: str) -> bool:
@@ -62,20 +163,23 @@ def check_dashboard_auth(req: Request):
         raise HTTPException(status_code=403, detail="Invalid token")
 
 async def tg_send(chat_id: str, text: str):
+    # Queued on the shared outbox; delivery (pacing, retries) happens in the background
     if not TELEGRAM_BOT_TOKEN:
         return
-    async with httpx.AsyncClient(timeout=15) as client:
-        await client.post(
-            f"{TELEGRAM_API}/sendMessage",
-            json={"chat_id": chat_id, "text": text},
-        )
+    tg_client.enqueue("sendMessage", {"chat_id": chat_id, "text": text})
 
 async def tg_send_buttons(chat_id: str, text: str, buttons: list[list[dict]]):
     if not TELEGRAM_BOT_TOKEN:
         return
     payload = {"chat_id": chat_id, "text": text, "reply_markup": {"inline_keyboard": buttons}}
-    async with httpx.AsyncClient(timeout=15) as client:
-        await client.post(f"{TELEGRAM_API}/sendMessage", json=payload)
+    tg_client.enqueue("sendMessage", payload)
+
+async def send_nudge(chat_id: str, text: str, item: dict) -> bool:
+    # waits for Telegram, so the nudger can retry a prompt that never went out
+    if not TELEGRAM_BOT_TOKEN:
+        return False
+    payload = {"chat_id": chat_id, "text": text, "reply_markup": {"inline_keyboard": review_buttons(item["id"])}}
+    return await tg_client.deliver("sendMessage", payload)
 
 def main_menu_buttons():
     return [
@@ -88,6 +192,14 @@ def main_menu_buttons():
         [{"text": "❌ Cancel", "callback_data": "menu_cancel"}],
     ]
 
+def review_buttons(study_id: int):
+    # callback_data: review:<study_id>:<SM-2 quality 0-5>
+    return [
+        [{"text": "✅ Remembered", "callback_data": f"review:{study_id}:5"},
+         {"text": "🤔 Hard", "callback_data": f"review:{study_id}:3"},
+         {"text": "❌ Forgot", "callback_data": f"review:{study_id}:1"}],
+    ]
+
 # -----------------------
 # Health
 # -----------------------
@@ -105,32 +217,186 @@ class StudyIn(BaseModel):
     user_id: str | None = "dashboard"
     chat_id: str | None = "dashboard"
 
+@app.get("/metrics")
+async def prometheus_metrics(req: Request):
+    if not metrics.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="metrics disabled")
+    check_dashboard_auth(req)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/cache/stats")
+async def api_cache_stats(req: Request):
+    check_dashboard_auth(req)
+    return {
+        "ok": True,
+        "modes": mode_cache_stats(),
+        "quiz_sessions": quiz_session_cache_stats(),
+        "chat_versions": chat_version_cache_stats(),
+        "responses": _response_cache.stats(),
+        "quiz": {**quiz_cache.stats(), "prefetch_pending": prefetch.pending()},
+    }
+
 @app.post("/api/study")
 async def api_save_study(payload: StudyIn, req: Request):
     check_dashboard_auth(req)
     topic = (payload.topic or "").strip()
     if not topic:
         raise HTTPException(status_code=400, detail="topic is required")
-    append_study(payload.chat_id, payload.user_id, payload.username, topic, payload.raw_text or topic)
-    return {"ok": True, "topic": topic}
+    label = await append_study(payload.chat_id, payload.user_id, payload.username, topic, payload.raw_text or topic)
+    prefetch.schedule(label)
+    return {"ok": True, "topic": topic, "canonical": label}
+
+async def conditional_json(req: Request, chat_id: str, params: tuple, build, bucket_sec: int = 0):
+    """
+    Serves a dashboard read by the chat's data version: 304 when If-None-Match
+    still matches, the cached rendering when we've built it before, else build().
+    """
+    version = await get_chat_version(chat_id)
+    # version is read before build(), so a racing write can only make the cache newer, never staler
+    key = (req.url.path, chat_id, params, version, int(time.time() // bucket_sec) if bucket_sec else 0)
+    etag = 'W/"' + hashlib.blake2b(repr(key).encode(), digest_size=12).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = {t.strip() for t in req.headers.get("if-none-match", "").split(",")}
+    if etag in if_none_match or "*" in if_none_match:
+        return Response(status_code=304, headers=headers)
+    body = _response_cache.get(key)
+    if body is MISSING:
+        body = JSONResponse(await build()).body
+        _response_cache.put(key, body)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def encode_cursor(kind: str, chat_id: str, last_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{kind}:{last_id}:{chat_id}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str | None, kind: str, chat_id: str) -> int | None:
+    """id to continue below, or None for the first page. 400 on a foreign or garbled cursor."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        k, last_id, c = raw.split(":", 2)
+        if k == kind and c == chat_id:
+            return int(last_id)
+    except ValueError:
+        pass
+    raise HTTPException(status_code=400, detail="invalid cursor")
+
+async def keyset_page(kind: str, fetch, chat_id: str, n: int, cursor: str | None) -> dict:
+    limit = max(1, min(n, API_PAGE_MAX))
+    rows = await fetch(chat_id, limit + 1, decode_cursor(cursor, kind, chat_id))
+    more = len(rows) > limit
+    items = rows[:limit]
+    return {"ok": True, "items": items, "next_cursor": encode_cursor(kind, chat_id, items[-1]["id"]) if more else None}
 
 @app.get("/api/study/recent")
-async def api_recent(n: int = 20, chat_id: str = "dashboard", req: Request = None):
+async def api_recent(n: int = 20, chat_id: str = "dashboard", cursor: str | None = None, req: Request = None):
+    check_dashboard_auth(req)
+    return await conditional_json(req, chat_id, (n, cursor), lambda: keyset_page("study", get_study_page, chat_id, n, cursor))
+
+@app.get("/api/resources")
+async def api_resources(n: int = 20, chat_id: str = "dashboard", cursor: str | None = None, req: Request = None):
+    check_dashboard_auth(req)
+    return await conditional_json(req, chat_id, (n, cursor), lambda: keyset_page("resources", get_resource_page, chat_id, n, cursor))
+
+def export_lines(kind: str, chat_id: str, fmt: str):
+    # sync generator: Starlette iterates it on a worker thread, a batch of rows at a time
+    columns = db.EXPORTS[kind][0]
+    rows = db.iter_export(kind, chat_id)
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(columns)
+        for i, row in enumerate(rows, start=1):
+            writer.writerow(row)
+            if i % 500 == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+    else:
+        batch = []
+        for row in rows:
+            batch.append(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+            if len(batch) >= 500:
+                yield "\n".join(batch) + "\n"
+                batch = []
+        if batch:
+            yield "\n".join(batch) + "\n"
+
+@app.get("/api/export")
+async def api_export(kind: str = "study", format: str = "ndjson", chat_id: str = "dashboard", req: Request = None):
     check_dashboard_auth(req)
-    items = get_recent_study(chat_id, n=n)
-    return {"ok": True, "items": items}
+    if kind not in db.EXPORTS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(db.EXPORTS)}")
+    if format not in {"ndjson", "csv"}:
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    media = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(export_lines(kind, chat_id, format), media_type=media,
+                             headers={"Content-Disposition": f'attachment; filename="{kind}.{format}"'})
 
 @app.get("/api/recollect")
 async def api_recollect(chat_id: str = "dashboard", req: Request = None):
     check_dashboard_auth(req)
-    item = get_random_study(chat_id)
+    item = await get_random_study(chat_id)
     return {"ok": True, "item": item}
 
 @app.get("/api/nudge/next")
 async def api_nudge(chat_id: str = "dashboard", req: Request = None):
     check_dashboard_auth(req)
-    item = get_due_item(chat_id) or get_next_item_anytime(chat_id)
-    return {"ok": True, "item": item}
+
+    async def build():
+        item = await get_due_item(chat_id) or await get_next_item_anytime(chat_id)
+        return {"ok": True, "item": item}
+
+    return await conditional_json(req, chat_id, (), build, bucket_sec=NUDGE_CACHE_BUCKET_SEC)
+
+@app.get("/api/search")
+async def api_search(q: str, chat_id: str = "dashboard", kind: str = "all", limit: int = 20, offset: int = 0, req: Request = None):
+    check_dashboard_auth(req)
+    if kind not in {"all", "study", "resources"}:
+        raise HTTPException(status_code=400, detail="kind must be all, study or resources")
+    limit, offset = max(1, min(limit, 100)), max(0, offset)
+
+    async def build():
+        items = await search(chat_id, q, kind, limit, offset)
+        return {"ok": True, "items": items, "next_offset": offset + limit if len(items) == limit else None}
+
+    return await conditional_json(req, chat_id, (q, kind, limit, offset), build)
+
+@app.get("/api/topics/related")
+async def api_related_topics(topic: str, chat_id: str = "dashboard", limit: int = 5, req: Request = None):
+    check_dashboard_auth(req)
+    limit = max(1, min(limit, 50))
+
+    async def build():
+        canonical, related = await asyncio.gather(canonical_topic(chat_id, topic), related_topics(chat_id, topic, limit))
+        return {"ok": True, "canonical": canonical, "related": related}
+
+    return await conditional_json(req, chat_id, (topic, limit), build)
+
+@app.get("/api/stats")
+async def api_stats(chat_id: str = "dashboard", days: int = 30, req: Request = None):
+    check_dashboard_auth(req)
+    days = max(1, min(days, STATS_MAX_DAYS))
+
+    async def build():
+        return {"ok": True, **await get_stats(chat_id, days)}
+
+    # the current streak and the window move at midnight without any write, so the day is part of the key
+    return await conditional_json(req, chat_id, (days, db.stats_day(time.time())), build)
+
+class ReviewIn(BaseModel):
+    study_id: int
+    quality: int
+    chat_id: str | None = "dashboard"
+
+@app.post("/api/review")
+async def api_review(payload: ReviewIn, req: Request):
+    check_dashboard_auth(req)
+    sched = await record_review(payload.chat_id, payload.study_id, payload.quality)
+    if not sched:
+        raise HTTPException(status_code=404, detail="study item not found")
+    return {"ok": True, "schedule": sched}
 
 class ResourceLinkIn(BaseModel):
     url: str
@@ -145,12 +411,341 @@ async def api_save_link(payload: ResourceLinkIn, req: Request):
     url = (payload.url or "").strip()
     if not url:
         raise HTTPException(status_code=400, detail="url is required")
-    append_resource_link(payload.chat_id, payload.user_id, payload.title or "Saved link", url, payload.raw_text or url)
+    await append_resource_link(payload.chat_id, payload.user_id, payload.title or "Saved link", url, payload.raw_text or url)
     return {"ok": True, "url": url}
 
+# -----------------------
+# Bulk import (JSON array or streamed NDJSON)
+# -----------------------
+def _text_field(obj: dict, key: str, default=None):
+    v = obj.get(key, default)
+    if v is not None and not isinstance(v, str):
+        raise ValueError(f"{key} must be a string")
+    return v.strip() if v else default
+
+def _id_field(obj: dict, key: str, default: str) -> str:
+    # Telegram ids arrive as numbers as often as strings; anything else is a bad row
+    v = obj.get(key)
+    if v is None or v == "":
+        return default
+    if isinstance(v, bool) or not isinstance(v, (str, int)):
+        raise ValueError(f"{key} must be a string or an integer")
+    return str(v)
+
+def _study_row(obj: dict, chat_id: str, user_id: str) -> tuple:
+    topic = _text_field(obj, "topic")
+    if not topic:
+        raise ValueError("topic is required")
+    ts, epoch = db.to_stamp(obj.get("ts"))
+    return (_id_field(obj, "chat_id", chat_id), _id_field(obj, "user_id", user_id), _text_field(obj, "username", "dashboard"),
+            topic, _text_field(obj, "raw_text") or topic, ts, epoch)
+
+def _resource_row(obj: dict, chat_id: str, user_id: str) -> tuple:
+    url = _text_field(obj, "url")
+    if not url:
+        raise ValueError("url is required")
+    ts, epoch = db.to_stamp(obj.get("ts"))
+    return (_id_field(obj, "chat_id", chat_id), _id_field(obj, "user_id", user_id), _text_field(obj, "title") or "Saved link",
+            url, _text_field(obj, "raw_text") or url, ts, epoch)
+
+async def _bulk_items(req: Request):
+    """Yields (index, obj) from an NDJSON stream or a JSON array body; obj is an Exception for bad lines."""
+    ctype = req.headers.get("content-type", "")
+    if "ndjson" in ctype or "jsonl" in ctype:
+        buf, idx = b"", 0
+        async for chunk in req.stream():
+            buf += chunk
+            *lines, buf = buf.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    try:
+                        yield idx, json.loads(line)
+                    except ValueError as e:
+                        yield idx, e
+                    idx += 1
+        if buf.strip():
+            try:
+                yield idx, json.loads(buf)
+            except ValueError as e:
+                yield idx, e
+        return
+    try:
+        body = await req.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="body must be a JSON array or NDJSON")
+    if isinstance(body, dict):
+        body = body.get("items")
+    if not isinstance(body, list):
+        raise HTTPException(status_code=400, detail="body must be a JSON array or NDJSON")
+    for idx, obj in enumerate(body):
+        yield idx, obj
+
+async def _bulk_ingest(req: Request, to_row, insert, chat_id: str, user_id: str) -> dict:
+    """
+    Validates rows as they arrive and inserts them BULK_CHUNK_ROWS per transaction.
+    Bad rows are reported by index and skipped; the rest of the batch still goes in.
+    The next chunk is parsed while the previous one is being written.
+    """
+    inserted, failed, errors = 0, 0, []
+    chunk: list[tuple[int, tuple]] = []
+    pending: asyncio.Task | None = None
+
+    def fail(idx: int, msg: str):
+        nonlocal failed
+        failed += 1
+        if len(errors) < BULK_MAX_ERRORS:
+            errors.append({"index": idx, "error": msg})
+
+    async def write(rows: list[tuple[int, tuple]]) -> int:
+        try:
+            return await insert([r for _, r in rows])
+        except Exception:
+            # isolate the offending row(s) instead of losing the whole chunk
+            ok = 0
+            for idx, r in rows:
+                try:
+                    ok += await insert([r])
+                except Exception as e:
+                    fail(idx, repr(e))
+            return ok
+
+    async for idx, obj in _bulk_items(req):
+        if idx >= BULK_MAX_ROWS:
+            fail(idx, f"over the {BULK_MAX_ROWS} row limit")
+            break
+        try:
+            if isinstance(obj, Exception):
+                raise ValueError(f"invalid JSON: {obj}")
+            if not isinstance(obj, dict):
+                raise ValueError("row must be an object")
+            chunk.append((idx, to_row(obj, chat_id, user_id)))
+        except ValueError as e:
+            fail(idx, str(e))
+            continue
+        if len(chunk) >= BULK_CHUNK_ROWS:
+            if pending is not None:
+                inserted += await pending
+            pending, chunk = asyncio.create_task(write(chunk)), []
+    if pending is not None:
+        inserted += await pending
+    if chunk:
+        inserted += await write(chunk)
+    return {"ok": True, "inserted": inserted, "failed": failed, "errors": errors}
+
+@app.post("/api/study/bulk")
+async def api_study_bulk(req: Request, chat_id: str = "dashboard", user_id: str = "dashboard"):
+    check_dashboard_auth(req)
+    # no quiz prefetch here: an import of thousands of topics shouldn't fan out to the LLM
+    return await _bulk_ingest(req, _study_row, append_study_bulk, chat_id, user_id)
+
+@app.post("/api/resources/bulk")
+async def api_resources_bulk(req: Request, chat_id: str = "dashboard", user_id: str = "dashboard"):
+    check_dashboard_auth(req)
+    return await _bulk_ingest(req, _resource_row, append_resource_links_bulk, chat_id, user_id)
+
 # -----------------------
 # Telegram webhook
 # -----------------------
+def update_chat_key(update: dict) -> str:
+    """Chat an update belongs to; updates for one chat are processed in order."""
+    msg = (update.get("callback_query") or {}).get("message") or update.get("message") or update.get("edited_message") or {}
+    chat_id = (msg.get("chat") or {}).get("id")
+    return str(chat_id) if chat_id is not None else f"update:{update.get('update_id')}"
+
+async def process_update(update: dict):
+    """Dedups by update_id, then handles; never raises."""
+    t = time.perf_counter()
+    try:
+        update_id = update.get("update_id")
+        if update_id is not None and not await mark_update_seen(update_id):
+            metrics.updates.inc("duplicate")
+            return
+        await handle_update(update)
+        metrics.updates.inc("handled")
+    except Exception as e:
+        metrics.updates.inc("error")
+        print("Update error:", repr(e))
+    finally:
+        metrics.update_seconds.observe(time.perf_counter() - t)
+
+async def _lane_process(key, update):
+    await process_update(update)
+
+_update_lanes = Lanes(_lane_process, workers=UPDATE_WORKERS, max_pending=UPDATE_QUEUE_MAX, name="updates")
+
+metrics.queue_depth.track(lambda: _update_lanes.depth, "updates")
+metrics.queue_depth.track(tg_client.queue_depth, "telegram_outbox")
+metrics.queue_depth.track(db_async.write_queue_depth, "db_writes")
+metrics.queue_depth.track(prefetch.pending, "quiz_prefetch")
+metrics.queue_depth.track(lambda: len(_quiz_streams), "quiz_streams")
+
+# -----------------------
+# Quiz flow
+# -----------------------
+def quiz_question_text(q_idx: int, total: int, question: str) -> str:
+    return f"❓ Q{q_idx + 1}/{total}: {question}\n\nReply with your answer (or type cancel)."
+
+def quiz_row(item: dict) -> dict:
+    return {"question": item["q"], "kind": "open", "explanation": item.get("ideal", "")}
+
+# session_id -> {"lock", "sent"} while a streamed quiz is still arriving; the lock
+# serialises "is the next question here yet?" between the user and the stream
+_quiz_streams: dict[int, dict] = {}
+_quiz_tasks: set[asyncio.Task] = set()
+
+def same_topic_note(topic: str, label: str) -> str:
+    # tell the user when a new wording was filed with a subject they logged before
+    return "" if topics.normalize(topic) == topics.normalize(label) else f'\n(same topic as "{label}")'
+
+async def start_quiz(chat_id: str, user_id: str, topic: str):
+    # quiz the cluster's label, so every wording of a subject shares one cached quiz
+    canonical = await canonical_topic(chat_id, topic)
+    topic = canonical["label"] if canonical else topic
+    n = quiz_cache.QUIZ_QUESTIONS
+    # only a real model streams; the no-key fallback is one canned item, sent as a whole quiz below
+    if QUIZ_STREAMING and agent_llm.OPENAI_API_KEY and not await quiz_cache.has_fresh(topic, n):
+        claim = quiz_cache.claim(topic, n)
+        if claim is not None:
+            await start_streamed_quiz(chat_id, user_id, topic, n, claim)
+            return
+
+    try:
+        items = await quiz_cache.get_quiz(topic, n)
+    except Exception as e:
+        print("Quiz generation error:", repr(e))
+        items = []
+    if not items:
+        await tg_send(chat_id, "⚠️ Couldn't generate a quiz right now. Try again in a bit.")
+        return
+
+    questions = [quiz_row(it) for it in items]
+    await create_quiz_session(chat_id, user_id, topic, questions)
+    await set_mode(chat_id, "quiz_answering")
+    await tg_send(chat_id, f"🧠 Quiz on: {topic}")
+    await tg_send(chat_id, quiz_question_text(0, len(questions), questions[0]["question"]))
+
+async def start_streamed_quiz(chat_id: str, user_id: str, topic: str, n: int, claim: asyncio.Future):
+    # claim holds the quiz_cache singleflight slot for (topic, n); the drain task resolves it
+    stream = agent_llm.llm_stream_quiz(topic, n)
+    try:
+        first = await anext(stream)
+        session_id = await create_quiz_session(chat_id, user_id, topic, [quiz_row(first)], total=n)
+    except BaseException as e:
+        claim.set_result([])
+        await stream.aclose()
+        if not isinstance(e, Exception):
+            raise
+        print("Quiz generation error:", repr(e))
+        await tg_send(chat_id, "⚠️ Couldn't generate a quiz right now. Try again in a bit.")
+        return
+
+    state = _quiz_streams[session_id] = {"lock": asyncio.Lock(), "sent": {0}}
+    task = asyncio.create_task(_drain_quiz_stream(chat_id, session_id, topic, n, first, stream, state, claim))
+    _quiz_tasks.add(task)
+    task.add_done_callback(_quiz_tasks.discard)
+
+    await set_mode(chat_id, "quiz_answering")
+    await tg_send(chat_id, f"🧠 Quiz on: {topic}")
+    await tg_send(chat_id, quiz_question_text(0, n, first["q"]))
+
+async def _drain_quiz_stream(chat_id: str, session_id: int, topic: str, n: int, first: dict, stream, state: dict,
+                             claim: asyncio.Future):
+    items = [first]
+    try:
+        try:
+            async for item in stream:
+                if len(items) >= n:
+                    break
+                idx = len(items)
+                items.append(item)
+                async with state["lock"]:
+                    st = await add_quiz_question(session_id, idx, quiz_row(item))
+                    # user already answered up to here and is waiting for this one
+                    if st["status"] == "active" and st["current_idx"] == idx and idx not in state["sent"]:
+                        state["sent"].add(idx)
+                        await tg_send(chat_id, quiz_question_text(idx, n, item["q"]))
+        except Exception as e:
+            print("Quiz stream error:", repr(e))
+        finally:
+            await stream.aclose()
+            async with state["lock"]:
+                st = await set_quiz_total(session_id, len(items))
+                _quiz_streams.pop(session_id, None)
+        if len(items) == n:
+            await quiz_cache.store(topic, n, items)
+    finally:
+        # whoever asked for the same quiz meanwhile gets these items instead of a second generation
+        claim.set_result(items)
+
+    if st["closed"]:
+        # stream came up short and the user had already answered everything it produced
+        await set_mode(chat_id, "")
+        await tg_send(chat_id, "✅ Quiz done. Grading your answers…")
+        await finish_quiz(chat_id, session_id, topic)
+
+async def continue_quiz(chat_id: str, answer: str):
+    session = await get_active_quiz_session(chat_id)
+    if not session:
+        await set_mode(chat_id, "")
+        await tg_send_buttons(chat_id, "No active quiz. Main Menu:", main_menu_buttons())
+        return
+
+    res = await answer_quiz_question(session["id"], session["current_idx"], answer)
+    if "error" in res:
+        if session["id"] in _quiz_streams and res["error"] == "Question not found.":
+            await tg_send(chat_id, "⏳ Hang on, the next question is still being generated…")
+        else:
+            await tg_send(chat_id, f"⚠️ {res['error']}")
+        return
+    if not res["done"]:
+        state = _quiz_streams.get(session["id"])
+        if state is None:
+            q = await get_quiz_question(session["id"], res["next_idx"])
+            if q:
+                await tg_send(chat_id, quiz_question_text(res["next_idx"], res["total"], q["question"]))
+            return
+        async with state["lock"]:
+            if session["id"] not in _quiz_streams:
+                q = await get_quiz_question(session["id"], res["next_idx"])
+                if q:
+                    await tg_send(chat_id, quiz_question_text(res["next_idx"], res["total"], q["question"]))
+                # else: the stream fell short and its finaliser wraps up the quiz
+                return
+            q = await get_quiz_question(session["id"], res["next_idx"])
+            if q is None:
+                await tg_send(chat_id, "⏳ Next question is still being generated…")
+            elif res["next_idx"] not in state["sent"]:
+                state["sent"].add(res["next_idx"])
+                await tg_send(chat_id, quiz_question_text(res["next_idx"], res["total"], q["question"]))
+        return
+
+    await set_mode(chat_id, "")
+    await tg_send(chat_id, "✅ Quiz done. Grading your answers…")
+    await finish_quiz(chat_id, session["id"], session["topic"])
+
+async def finish_quiz(chat_id: str, session_id: int, topic: str):
+    # only open-ended answers need the LLM; multiple-choice ones were scored when answered
+    answers = [a for a in await get_quiz_answers(session_id) if a["kind"] == "open"]
+    try:
+        results = await llm_grade_answers(topic, [
+            {"question": a["question"], "ideal": a["ideal"], "user_answer": a["user_answer"] or ""} for a in answers
+        ])
+    except Exception as e:
+        print("Grading error:", repr(e))
+        results = []
+
+    grades, lines = {}, []
+    for a, g in zip(answers, results):
+        # score is an int 0-10, or None for an answer that couldn't be graded (left ungraded)
+        if g.get("score") is not None:
+            grades[a["q_idx"]] = g["score"]
+        lines.append(f"Q{a['q_idx'] + 1}: {g.get('score') if g.get('score') is not None else '–'}/10 – {g.get('verdict', '')}"
+                     f"\n💡 {g.get('model_answer', '')}")
+
+    result = await record_quiz_grades(session_id, grades)
+    await tg_send(chat_id, "\n\n".join(lines) or "⚠️ Couldn't grade your answers right now.")
+    await tg_send_buttons(chat_id, f"🏁 Score: {result['score']}/{result['total']}", main_menu_buttons())
+
 @app.post("/telegram/webhook")
 async def telegram_webhook(req: Request):
     try:
@@ -158,155 +753,228 @@ async def telegram_webhook(req: Request):
     except Exception:
         return {"ok": True}
 
-    try:
-        # 1) CALLBACKS (buttons)
-        cb = update.get("callback_query")
-        if cb:
-            msg = cb.get("message") or {}
-            chat_id = str((msg.get("chat") or {}).get("id", ""))
-            user = cb.get("from") or {}
-            user_id = str(user.get("id", ""))
-            data = cb.get("data", "")
-
-            if not chat_id or not allowed(user_id):
-                return {"ok": True}
-
-            if data == "menu_recent":
-                items = get_recent_study(chat_id, n=5)
-                out = "No study items yet. Try: I studied EOQ" if not items else \
-                      "📌 Recent study:\n" + "\n".join([f"{i+1}) {it['topic']} ({it['ts']})" for i, it in enumerate(items)])
-                await tg_send(chat_id, out)
-
-            elif data == "menu_recollect":
-                item = get_random_study(chat_id)
-                out = 'No study items yet. Try: "I studied EOQ"' if not item else f"🧠 Recollect:\n{item['topic']}\n({item['ts']})"
-                await tg_send(chat_id, out)
-
-            elif data == "menu_nudge":
-                item = get_due_item(chat_id) or get_next_item_anytime(chat_id)
-                if not item:
-                    await tg_send(chat_id, "No recall items yet. Save something with: I studied ...")
-                else:
-                    await tg_send(chat_id, f"🔁 Nudge:\n{item.get('topic')}\n({item.get('ts')})")
-
-            elif data == "menu_add_resource":
-                set_mode(chat_id, "awaiting_resource")
-                await tg_send(chat_id, "🎒 Paste a link to save (or type cancel).")
-
-            elif data == "menu_record":
-                set_mode(chat_id, "awaiting_study")
-                await tg_send(chat_id, '📝 Send: "I studied ..." or just type the topic.')
-
-            elif data == "menu_quiz":
-                # Placeholder until we implement full quiz agent
-                set_mode(chat_id, "awaiting_quiz_topic")
-                await tg_send(chat_id, "❓ What topic should I quiz you on?\nType a topic OR send: quiz recent")
-
-            elif data == "menu_cancel":
-                set_mode(chat_id, "")
-                await tg_send(chat_id, "✅ Cancelled.")
-
-            # Always acknowledge callback to stop Telegram loading spinner
-            async with httpx.AsyncClient(timeout=10) as client:
-                await client.post(
-                    f"{TELEGRAM_API}/answerCallbackQuery",
-                    json={"callback_query_id": cb.get("id")},
-                )
-            return {"ok": True}
-
-        # 2) MESSAGES
-        msg = update.get("message") or update.get("edited_message")
-        if not msg:
-            return {"ok": True}
+    if WEBHOOK_ASYNC:
+        # Ack now; workers handle it (in order per chat) after we return
+        if not _update_lanes.submit(update_chat_key(update), update):
+            metrics.updates.inc("dropped")
+            print("Update queue full, dropping update", update.get("update_id"))
+        return {"ok": True}
+
+    # Never let Telegram see a 500; process_update logs and swallows errors
+    await process_update(update)
+    return {"ok": True}
 
+async def handle_update(update: dict):
+    # 1) CALLBACKS (buttons)
+    cb = update.get("callback_query")
+    if cb:
+        msg = cb.get("message") or {}
         chat_id = str((msg.get("chat") or {}).get("id", ""))
-        user = msg.get("from") or {}
+        user = cb.get("from") or {}
         user_id = str(user.get("id", ""))
-        username = user.get("username", "") or ""
-        text_raw = msg.get("text", "") or ""
-        text = text_raw.strip()
+        data = cb.get("data", "")
 
         if not chat_id or not allowed(user_id):
-            return {"ok": True}
+            return
+
+        # action only ("review", not "review:42:5"), to keep label cardinality fixed
+        metrics.callbacks.inc(data.split(":", 1)[0])
+        if data == "menu_recent":
+            items = await get_recent_study(chat_id, n=5)
+            out = "No study items yet. Try: I studied EOQ" if not items else \
+                  "📌 Recent study:\n" + "\n".join([f"{i+1}) {it['topic']} ({it['ts']})" for i, it in enumerate(items)])
+            await tg_send(chat_id, out)
+
+        elif data == "menu_recollect":
+            item = await get_random_study(chat_id)
+            out = 'No study items yet. Try: "I studied EOQ"' if not item else f"🧠 Recollect:\n{item['topic']}\n({item['ts']})"
+            await tg_send(chat_id, out)
+
+        elif data == "menu_nudge":
+            await send_next_item(chat_id)
+
+        elif data.startswith("review:"):
+            try:
+                _, study_id, quality = data.split(":")
+                sched = await record_review(chat_id, int(study_id), int(quality))
+            except ValueError:
+                sched = None
+            if sched:
+                days = sched["interval_days"]
+                await tg_send(chat_id, f"📅 Got it. Next review in {days:g} day{'s' if days != 1 else ''}.")
+
+        elif data == "menu_add_resource":
+            await set_mode(chat_id, "awaiting_resource")
+            await tg_send(chat_id, "🎒 Paste a link to save (or type cancel).")
+
+        elif data == "menu_record":
+            await set_mode(chat_id, "awaiting_study")
+            await tg_send(chat_id, '📝 Send: "I studied ..." or just type the topic.')
+
+        elif data == "menu_quiz":
+            # Placeholder until we implement full quiz agent
+            await set_mode(chat_id, "awaiting_quiz_topic")
+            await tg_send(chat_id, "❓ What topic should I quiz you on?\nType a topic OR send: quiz recent")
+
+        elif data == "menu_cancel":
+            await set_mode(chat_id, "")
+            await tg_send(chat_id, "✅ Cancelled.")
 
-        # help/menu
-        if is_help(norm(text)):
-            await tg_send_buttons(chat_id, "Main Menu:", main_menu_buttons())
-            return {"ok": True}
+        # Always acknowledge callback to stop Telegram loading spinner
+        if TELEGRAM_BOT_TOKEN:
+            tg_client.enqueue("answerCallbackQuery", {"callback_query_id": cb.get("id")})
+        return
 
-        # cancel
-        if is_cancel(norm(text)):
-            set_mode(chat_id, "")
-            await tg_send(chat_id, "✅ Cancelled.")
-            return {"ok": True}
-
-        mode = get_mode(chat_id)
-
-        # awaiting study
-        if mode == "awaiting_study" and text:
-            topic = extract_study_topic(text) or text
-            append_study(chat_id, user_id, username, topic, text_raw)
-            set_mode(chat_id, "")
-            await tg_send_buttons(chat_id, f'✅ Saved: "{topic}"', main_menu_buttons())
-            return {"ok": True}
-
-        # awaiting resource
-        if mode == "awaiting_resource":
-            url = extract_url(text_raw)
-            if not url:
-                await tg_send(chat_id, "Paste a URL (or type cancel).")
-                return {"ok": True}
-            append_resource_link(chat_id, user_id, title="Saved link", url=url, raw_text=text_raw)
-            set_mode(chat_id, "")
-            await tg_send_buttons(chat_id, f"🔖 Saved to Learning Bag:\n{url}", main_menu_buttons())
-            return {"ok": True}
-
-        # awaiting quiz topic (placeholder)
-        if mode == "awaiting_quiz_topic" and text:
-            if text.strip().lower() == "quiz recent":
-                rec = get_recent_study(chat_id, n=1)
-                if not rec:
-                    await tg_send(chat_id, 'No study items yet. Try: "I studied EOQ"')
-                    return {"ok": True}
-                topic = rec[0]["topic"]
-            else:
-                topic = text.strip()
-
-            set_mode(chat_id, "")
-            await tg_send(chat_id, f"🧠 Quiz coming next for: {topic}\n\nFor now: reply with 3 key takeaways + 1 example.")
-            await tg_send_buttons(chat_id, "Main Menu:", main_menu_buttons())
-            return {"ok": True}
-
-        # recent/recollect commands
-        if is_recent(norm(text)):
-            items = get_recent_study(chat_id, n=5)
-            if not items:
-                await tg_send(chat_id, 'No study items yet. Try: "I studied EOQ"')
-            else:
-                lines = [f"{i+1}) {it['topic']} ({it['ts']})" for i, it in enumerate(items)]
-                await tg_send(chat_id, "📌 Recent study:\n" + "\n".join(lines))
-            return {"ok": True}
-
-        if is_recollect(norm(text)):
-            item = get_random_study(chat_id)
-            if not item:
+    # 2) MESSAGES
+    msg = update.get("message") or update.get("edited_message")
+    if not msg:
+        return
+
+    chat_id = str((msg.get("chat") or {}).get("id", ""))
+    user = msg.get("from") or {}
+    user_id = str(user.get("id", ""))
+    username = user.get("username", "") or ""
+    text_raw = msg.get("text", "") or ""
+    text = text_raw.strip()
+
+    if not chat_id or not allowed(user_id):
+        return
+
+    intent = route(text)
+    ctx = {"chat_id": chat_id, "user_id": user_id, "username": username, "text_raw": text_raw}
+
+    # help/cancel win over whatever mode the chat is in
+    if intent.name in PREEMPTIVE_INTENTS:
+        metrics.intents.inc(intent.name)
+        await INTENT_HANDLERS[intent.name](ctx, intent)
+        return
+
+    mode = await get_mode(chat_id)
+    if (mode in {"awaiting_study", "awaiting_quiz_topic", "quiz_answering"} and text) or mode == "awaiting_resource":
+        metrics.intents.inc(f"mode:{mode}")
+    else:
+        metrics.intents.inc(intent.name)
+
+    # awaiting study
+    if mode == "awaiting_study" and text:
+        topic = intent.slots["topic"] if intent.name == "study" else text
+        label = await append_study(chat_id, user_id, username, topic, text_raw)
+        prefetch.schedule(label)
+        await set_mode(chat_id, "")
+        await tg_send_buttons(chat_id, f'✅ Saved: "{topic}"' + same_topic_note(topic, label), main_menu_buttons())
+        return
+
+    # awaiting resource
+    if mode == "awaiting_resource":
+        url = extract_url(text_raw)
+        if not url:
+            await tg_send(chat_id, "Paste a URL (or type cancel).")
+            return
+        await append_resource_link(chat_id, user_id, title="Saved link", url=url, raw_text=text_raw)
+        await set_mode(chat_id, "")
+        await tg_send_buttons(chat_id, f"🔖 Saved to Learning Bag:\n{url}", main_menu_buttons())
+        return
+
+    # awaiting quiz topic
+    if mode == "awaiting_quiz_topic" and text:
+        if text.strip().lower() == "quiz recent":
+            rec = await get_recent_study(chat_id, n=1)
+            if not rec:
                 await tg_send(chat_id, 'No study items yet. Try: "I studied EOQ"')
-            else:
-                await tg_send(chat_id, f"🧠 Recollect:\n{item['topic']}\n({item['ts']})")
-            return {"ok": True}
-
-        # natural ingestion "I studied ..."
-        topic = extract_study_topic(text_raw)
-        if topic:
-            append_study(chat_id, user_id, username, topic, text_raw)
-            await tg_send(chat_id, f'✅ Saved. You studied: "{topic}"')
-            return {"ok": True}
-
-        # fallback
-        await tg_send(chat_id, 'Got it. Type "help" for menu.')
-        return {"ok": True}
+                return
+            topic = rec[0]["topic"]
+        else:
+            topic = text.strip()
 
-    except Exception as e:
-        # Never let Telegram see a 500; log and return OK
-        print("Webhook error:", repr(e))
-        return {"ok": True}
+        await set_mode(chat_id, "")
+        await start_quiz(chat_id, user_id, topic)
+        return
+
+    # answering a quiz question
+    if mode == "quiz_answering" and text:
+        await continue_quiz(chat_id, text_raw)
+        return
+
+    handler = INTENT_HANDLERS.get(intent.name)
+    if handler:
+        await handler(ctx, intent)
+        return
+
+    # fallback
+    await tg_send(chat_id, 'Got it. Type "help" for menu.')
+
+# -----------------------
+# Message intents (see agent.router); one handler per intent name
+# -----------------------
+async def on_help(ctx: dict, intent: Intent):
+    await tg_send_buttons(ctx["chat_id"], "Main Menu:", main_menu_buttons())
+
+async def on_cancel(ctx: dict, intent: Intent):
+    await set_mode(ctx["chat_id"], "")
+    await tg_send(ctx["chat_id"], "✅ Cancelled.")
+
+async def on_recent(ctx: dict, intent: Intent):
+    items = await get_recent_study(ctx["chat_id"], n=5)
+    if not items:
+        await tg_send(ctx["chat_id"], 'No study items yet. Try: "I studied EOQ"')
+    else:
+        lines = [f"{i+1}) {it['topic']} ({it['ts']})" for i, it in enumerate(items)]
+        await tg_send(ctx["chat_id"], "📌 Recent study:\n" + "\n".join(lines))
+
+async def on_recollect(ctx: dict, intent: Intent):
+    item = await get_random_study(ctx["chat_id"])
+    if not item:
+        await tg_send(ctx["chat_id"], 'No study items yet. Try: "I studied EOQ"')
+    else:
+        await tg_send(ctx["chat_id"], f"🧠 Recollect:\n{item['topic']}\n({item['ts']})")
+
+async def send_next_item(chat_id: str):
+    # the most overdue review item, else the next one coming due
+    item = await get_due_item(chat_id) or await get_next_item_anytime(chat_id)
+    if not item:
+        await tg_send(chat_id, "No recall items yet. Save something with: I studied ...")
+    else:
+        await tg_send_buttons(chat_id, f"🔁 Nudge:\n{item.get('topic')}\n({item.get('ts')})\n\nHow well did you recall it?",
+                              review_buttons(item["id"]))
+
+async def on_next(ctx: dict, intent: Intent):
+    await send_next_item(ctx["chat_id"])
+
+async def on_search(ctx: dict, intent: Intent):
+    query = intent.slots["query"]
+    hits = await search(ctx["chat_id"], query, limit=SEARCH_RESULTS)
+    if not hits:
+        await tg_send(ctx["chat_id"], f'🔍 Nothing found for "{query}".')
+        return
+    lines = [f"{i+1}) {'🔖' if h['kind'] == 'resource' else '📝'} {h['title']}" + (f"\n   {h['url']}" if h["url"] else "")
+             + (f"\n   {h['snippet']}" if h["snippet"] and h["snippet"] != h["title"] else "")
+             for i, h in enumerate(hits)]
+    await tg_send(ctx["chat_id"], f'🔍 Results for "{query}":\n' + "\n".join(lines))
+
+async def on_add_resource(ctx: dict, intent: Intent):
+    url = intent.slots.get("url")
+    if not url:
+        await set_mode(ctx["chat_id"], "awaiting_resource")
+        await tg_send(ctx["chat_id"], "🎒 Paste a link to save (or type cancel).")
+        return
+    await append_resource_link(ctx["chat_id"], ctx["user_id"], title="Saved link", url=url, raw_text=ctx["text_raw"])
+    await tg_send(ctx["chat_id"], f"🔖 Saved to Learning Bag:\n{url}")
+
+async def on_study(ctx: dict, intent: Intent):
+    # natural ingestion "I studied ..."
+    topic = intent.slots["topic"]
+    label = await append_study(ctx["chat_id"], ctx["user_id"], ctx["username"], topic, ctx["text_raw"])
+    prefetch.schedule(label)
+    await tg_send(ctx["chat_id"], f'✅ Saved. You studied: "{topic}"' + same_topic_note(topic, label))
+
+INTENT_HANDLERS = {
+    "help": on_help,
+    "cancel": on_cancel,
+    "recent": on_recent,
+    "recollect": on_recollect,
+    "next": on_next,
+    "search": on_search,
+    "add_resource": on_add_resource,
+    "study": on_study,
+}
+PREEMPTIVE_INTENTS = {"help", "cancel"}
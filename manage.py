@@ -0,0 +1,42 @@
+"""
+Offline maintenance commands. Stop the bot and the dashboard API first.
+
+    python manage.py rebuild-stats [--chunk 5000]
+
+rebuild-stats recomputes the stats rollups (totals, streaks, daily buckets)
+from the study, resource and quiz tables, a chunk of rows per transaction, so
+memory stays flat however large the history. Run it once on a database from
+before the rollups existed, or whenever they are suspected to have drifted.
+"""
+import argparse
+import time
+
+import db
+
+def rebuild_stats(chunk: int):
+    db.init_db()
+    conn = db._conn()
+    t0 = time.perf_counter()
+    with db._transaction(conn):
+        for table in ("chat_stats", "chat_daily_stats", "chat_topic_weeks"):
+            conn.execute(f"DELETE FROM {table}")
+    for source in db.STATS_SOURCES:
+        after = 0
+        while after is not None:
+            after = db.rebuild_stats_chunk(conn, source, after, chunk)
+        print(f"{source} rolled up ({time.perf_counter() - t0:.1f}s)")
+    print(f"stats and streaks for {db.recount_streaks(conn)} chats")
+    db.close_db()
+    print(f"done in {time.perf_counter() - t0:.1f}s")
+
+def main():
+    ap = argparse.ArgumentParser(description="Offline maintenance for the anamnesis database.")
+    sub = ap.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("rebuild-stats", help="recompute the stats rollups from the logs")
+    p.add_argument("--chunk", type=int, default=5000, help="rows rolled up per transaction")
+    args = ap.parse_args()
+    if args.command == "rebuild-stats":
+        rebuild_stats(max(1, args.chunk))
+
+if __name__ == "__main__":
+    main()
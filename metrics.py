@@ -0,0 +1,190 @@
+"""
+In-process metrics, rendered in the Prometheus text format at /metrics.
+
+Counters and histograms are plain dicts keyed by label values behind one lock;
+gauges are callbacks read at scrape time (queue depths and the like).
+
+With METRICS_ENABLED off, timed() hands back the undecorated function and
+inc()/observe() return straight away, so the hot paths pay nothing but a
+boolean check.
+"""
+import asyncio
+import functools
+import os
+import threading
+import time
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1").strip().lower() in {"1", "true", "yes"}
+
+# seconds; spans a cached SQLite read up to a slow LLM call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_registry: dict[str, "_Metric"] = {}
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple, object] = {}
+
+    def _label_str(self, values: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{_escape(v)}"' for k, v in zip(self.labels, values)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *values, n: float = 1):
+        if not METRICS_ENABLED:
+            return
+        with _lock:
+            self.values[values] = self.values.get(values, 0) + n
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{self._label_str(k)} {_num(v)}" for k, v in self.values.items()]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *values):
+        if not METRICS_ENABLED:
+            return
+        with _lock:
+            state = self.values.get(values)
+            if state is None:
+                state = self.values[values] = [[0] * len(self.buckets), 0.0, 0]   # per-bucket counts, sum, count
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> list[str]:
+        out = []
+        for k, (counts, total, n) in self.values.items():
+            running = 0
+            for b, c in zip(self.buckets, counts):
+                running += c
+                le = 'le="' + _num(b) + '"'
+                out.append(f"{self.name}_bucket{self._label_str(k, le)} {running}")
+            out.append(f"{self.name}_bucket{self._label_str(k, _LE_INF)} {n}")
+            out.append(f"{self.name}_sum{self._label_str(k)} {_num(total)}")
+            out.append(f"{self.name}_count{self._label_str(k)} {n}")
+        return out
+
+class Gauge(_Metric):
+    """Values come from callbacks at scrape time: gauge.track(fn, *label_values)."""
+    kind = "gauge"
+
+    def track(self, fn, *values):
+        self.values[values] = fn
+
+    def render(self) -> list[str]:
+        out = []
+        for k, fn in list(self.values.items()):
+            try:
+                out.append(f"{self.name}{self._label_str(k)} {_num(fn())}")
+            except Exception:
+                pass
+        return out
+
+_LE_INF = 'le="+Inf"'
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _num(v) -> str:
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+def _register(metric):
+    existing = _registry.get(metric.name)
+    if existing is not None:
+        return existing
+    _registry[metric.name] = metric
+    return metric
+
+def counter(name: str, help: str, labels: tuple = ()) -> Counter:
+    return _register(Counter(name, help, labels))
+
+def histogram(name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help, labels, buckets))
+
+def gauge(name: str, help: str, labels: tuple = ()) -> Gauge:
+    return _register(Gauge(name, help, labels))
+
+def timed(hist: Histogram, errors: Counter | None = None, *values):
+    """
+    Decorator: observes the wrapped call's latency in hist (and counts exceptions
+    in errors) under the given label values. A no-op when metrics are disabled.
+    """
+    def wrap(fn):
+        if not METRICS_ENABLED:
+            return fn
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def awrapper(*args, **kwargs):
+                t = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(*values)
+                    raise
+                finally:
+                    hist.observe(time.perf_counter() - t, *values)
+            return awrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(*values)
+                raise
+            finally:
+                hist.observe(time.perf_counter() - t, *values)
+        return wrapper
+    return wrap
+
+def render() -> str:
+    lines = []
+    with _lock:
+        metrics = list(_registry.values())
+        for m in metrics:
+            if m.kind == "gauge":
+                continue
+            lines += [f"# HELP {m.name} {m.help}", f"# TYPE {m.name} {m.kind}", *m.render()]
+    # gauge callbacks run outside the lock; they may take locks of their own
+    for m in metrics:
+        if m.kind == "gauge":
+            lines += [f"# HELP {m.name} {m.help}", f"# TYPE {m.name} {m.kind}", *m.render()]
+    return "\n".join(lines) + "\n"
+
+# --- Shared metrics, used across modules ---
+db_seconds = histogram("anamnesis_db_seconds", "Latency of db calls via db_async, queue wait included.", ("fn", "kind"))
+db_errors = counter("anamnesis_db_errors_total", "db calls that raised.", ("fn", "kind"))
+db_write_batch = histogram("anamnesis_db_write_batch_size", "Writes group-committed per transaction.", (),
+                           buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+tg_seconds = histogram("anamnesis_telegram_seconds", "Telegram Bot API call latency, retries included.", ("method",))
+tg_errors = counter("anamnesis_telegram_errors_total", "Telegram calls that failed or raised.", ("method", "code"))
+tg_sends = counter("anamnesis_telegram_enqueued_total", "Bot API calls queued on the outbox.", ("method",))
+llm_seconds = histogram("anamnesis_llm_seconds", "OpenAI call latency by operation.", ("op",))
+llm_errors = counter("anamnesis_llm_errors_total", "OpenAI calls that raised.", ("op",))
+updates = counter("anamnesis_updates_total", "Telegram updates by outcome.", ("outcome",))
+update_seconds = histogram("anamnesis_update_seconds", "Time to handle one Telegram update.")
+intents = counter("anamnesis_intents_total", "Messages handled, by intent (or mode).", ("intent",))
+callbacks = counter("anamnesis_callbacks_total", "Button callbacks handled, by action.", ("action",))
+queue_depth = gauge("anamnesis_queue_depth", "Items waiting in in-process queues.", ("queue",))
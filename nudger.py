@@ -0,0 +1,108 @@
+"""
+Background nudge broadcaster.
+
+Every NUDGE_INTERVAL_SEC it sweeps all chats that have a due, un-nudged review
+item (keyset-paginated by chat_id, NUDGE_PAGE_SIZE at a time, so memory stays
+flat however many chats there are) and sends each one a recall prompt.
+
+Progress is checkpointed in kv_state after every page, and each item is marked
+nudged before it's sent, so a restart resumes the sweep without re-sending. A
+prompt the outbox drops, or Telegram refuses, has its mark cleared again, so
+the next sweep retries it.
+"""
+import asyncio
+import os
+import time
+
+import db_async
+from agent import send_recall_prompt
+
+NUDGE_BROADCAST = os.getenv("NUDGE_BROADCAST", "1").strip().lower() in {"1", "true", "yes"}
+NUDGE_INTERVAL_SEC = int(os.getenv("NUDGE_INTERVAL_SEC", "3600"))
+NUDGE_PAGE_SIZE = int(os.getenv("NUDGE_PAGE_SIZE", "500"))
+NUDGE_CONCURRENCY = int(os.getenv("NUDGE_CONCURRENCY", "16"))
+# Leave headroom under Telegram's ~30 msg/s for interactive replies
+NUDGE_RATE = float(os.getenv("NUDGE_RATE", "20"))
+
+STATE_KEY = "nudge_sweep"
+
+_task: asyncio.Task | None = None
+
+def start(send):
+    """send: async def send(chat_id, text, item) -> bool, True once Telegram has taken the prompt."""
+    global _task
+    if NUDGE_BROADCAST and _task is None:
+        _task = asyncio.create_task(_run(send), name="nudger")
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+
+async def _run(send):
+    while True:
+        state = await db_async.get_state(STATE_KEY, {}) or {}
+        if state.get("cursor") is None:
+            wait = state.get("last_completed", 0) + NUDGE_INTERVAL_SEC - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        try:
+            sent = await sweep(send)
+            print(f"Nudge sweep done: {sent} prompts sent")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("Nudge sweep error:", repr(e))
+            await asyncio.sleep(60)
+
+async def sweep(send) -> int:
+    """One pass over every chat with due items; resumes a checkpointed pass if there is one."""
+    state = await db_async.get_state(STATE_KEY, {}) or {}
+    if state.get("cursor") is None:
+        state = {"started": int(time.time()), "cursor": ""}
+        await db_async.set_state(STATE_KEY, state)
+    now, cursor = state["started"], state["cursor"]
+
+    sem = asyncio.Semaphore(NUDGE_CONCURRENCY)
+    interval = 1.0 / NUDGE_RATE if NUDGE_RATE > 0 else 0.0
+    next_slot = time.monotonic()
+    sent = 0
+
+    async def nudge(chat_id: str):
+        nonlocal sent
+        async with sem:
+            item = await db_async.claim_due_nudge(chat_id, now)
+            if not item:
+                return
+            try:
+                ok = await send_recall_prompt(chat_id, item, lambda cid, text: send(cid, text, item))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("Nudge send error:", repr(e))
+                ok = False
+            if ok:
+                sent += 1
+            else:
+                await db_async.release_nudge(chat_id, item["nudged"], now)
+
+    while True:
+        chats = await db_async.get_chats_with_pending_nudges(cursor, now, NUDGE_PAGE_SIZE)
+        if not chats:
+            break
+        tasks = []
+        for chat_id in chats:
+            # pace launches so the outbox isn't flooded faster than Telegram drains it
+            delay = next_slot - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_slot = max(next_slot, time.monotonic()) + interval
+            tasks.append(asyncio.create_task(nudge(chat_id)))
+        await asyncio.gather(*tasks)
+        cursor = chats[-1]
+        await db_async.set_state(STATE_KEY, {"started": now, "cursor": cursor})
+
+    await db_async.set_state(STATE_KEY, {"last_completed": int(time.time()), "cursor": None})
+    return sent
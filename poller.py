@@ -0,0 +1,143 @@
+"""
+Long-polling ingestion: pulls updates with getUpdates instead of waiting for
+the webhook, so the bot runs without a public endpoint and drains a backlog
+at up to POLL_LIMIT updates per round trip.
+
+Each batch is handled by the same process_update as the webhook, on per-chat
+lanes: one chat's updates run in order, different chats run concurrently.
+
+Nothing fetched is lost and nothing is handled twice: a batch and the offset
+that confirms it are written to the update_inbox table in one transaction
+before the next getUpdates tells Telegram to forget it, and each update leaves
+the inbox once handled. On start, leftovers are replayed; process_update's
+update_id dedup skips any that had already begun, so one cut off mid-handler
+by a hard crash is dropped rather than half-applied twice (the same guarantee
+the webhook path gives).
+
+Enable with TELEGRAM_POLLING=1 (main's lifespan starts it alongside the
+dashboard API), or run headless: python poller.py
+"""
+import asyncio
+import os
+import signal
+
+import db
+import db_async
+import metrics
+import tg_client
+from lanes import Lanes
+
+TELEGRAM_POLLING = os.getenv("TELEGRAM_POLLING", "").strip().lower() in {"1", "true", "yes"}
+POLL_TIMEOUT_SEC = int(os.getenv("POLL_TIMEOUT_SEC", "50"))
+POLL_LIMIT = max(1, min(100, int(os.getenv("POLL_LIMIT", "100"))))
+# Stop fetching while this many updates are still waiting to be handled
+POLL_MAX_PENDING = int(os.getenv("POLL_MAX_PENDING", "1000"))
+POLL_RETRY_SEC = float(os.getenv("POLL_RETRY_SEC", "5"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+
+ALLOWED_UPDATES = ["message", "edited_message", "callback_query"]
+
+_batch_size = metrics.histogram("anamnesis_poll_batch_size", "Updates returned per getUpdates call.", (),
+                                buckets=(0, 1, 5, 10, 25, 50, 100))
+
+_task: asyncio.Task | None = None
+_lanes: Lanes | None = None
+
+def start(process, chat_key):
+    """
+    process: async def process(update) -> handles one update, never raises.
+    chat_key: def chat_key(update) -> str, the lane an update is ordered on.
+    """
+    global _task, _lanes
+    if _task is not None:
+        return
+
+    async def handle(key, update):
+        # not acked if cancelled mid-way, so a shutdown leaves it for the next start
+        await process(update)
+        await db_async.ack_inbox(update["update_id"])
+
+    _lanes = Lanes(handle, workers=UPDATE_WORKERS, max_pending=POLL_MAX_PENDING + POLL_LIMIT, name="poll")
+    _lanes.start()
+    metrics.queue_depth.track(lambda: _lanes.depth if _lanes else 0, "poll")
+    _task = asyncio.create_task(_run(chat_key), name="poller")
+
+async def stop(timeout: float = 10.0):
+    """Stops fetching, then lets updates already fetched finish (up to timeout)."""
+    global _task, _lanes
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+    if _lanes is not None:
+        # anything cut off here is still in the inbox and is replayed on the next start
+        await _lanes.stop(timeout)
+        _lanes = None
+
+def pending() -> int:
+    return _lanes.depth if _lanes else 0
+
+async def _run(chat_key):
+    for update in await db_async.get_inbox():
+        _lanes.submit(chat_key(update), update)
+    offset = await db_async.get_state(db.POLL_OFFSET_KEY, 0) or 0
+
+    # getUpdates is refused (409) while a webhook is set
+    try:
+        body = await tg_client.call("deleteWebhook", {"drop_pending_updates": False})
+        if not body.get("ok"):
+            print("deleteWebhook failed:", body.get("error_code"), body.get("description"))
+    except Exception as e:
+        print("deleteWebhook error:", repr(e))
+
+    while True:
+        while _lanes.depth >= POLL_MAX_PENDING:
+            await asyncio.sleep(0.05)
+        try:
+            body = await tg_client.call("getUpdates", {
+                "offset": offset,
+                "limit": POLL_LIMIT,
+                "timeout": POLL_TIMEOUT_SEC,
+                "allowed_updates": ALLOWED_UPDATES,
+            }, timeout=POLL_TIMEOUT_SEC + 10)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("getUpdates error:", repr(e))
+            await asyncio.sleep(POLL_RETRY_SEC)
+            continue
+        if not body.get("ok"):
+            print("getUpdates failed:", body.get("error_code"), body.get("description"))
+            await asyncio.sleep(POLL_RETRY_SEC)
+            continue
+
+        updates = body.get("result") or []
+        _batch_size.observe(len(updates))
+        if not updates:
+            continue
+        offset = max(u["update_id"] for u in updates) + 1
+        await db_async.inbox_updates(updates, offset)
+        for update in updates:
+            if not _lanes.submit(chat_key(update), update):
+                # unreachable while the depth check above holds; the inbox keeps it for the next start
+                print("Poll queue full, deferring update", update["update_id"])
+
+async def _serve():
+    import main
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    async with main.lifespan(main.app):
+        print("Polling Telegram for updates")
+        await stopping.wait()
+
+if __name__ == "__main__":
+    # main's lifespan starts the poller (a separate import of this module) when this is set
+    os.environ["TELEGRAM_POLLING"] = "1"
+    from dotenv import load_dotenv
+    load_dotenv()
+    if not os.getenv("TELEGRAM_BOT_TOKEN", "").strip():
+        raise SystemExit("TELEGRAM_BOT_TOKEN is required")
+    asyncio.run(_serve())
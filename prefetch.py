@@ -0,0 +1,68 @@
+"""
+Background quiz prefetch.
+
+When a study item is saved, its topic is queued here and a quiz is generated
+into quiz_cache ahead of time, so "❓ Quiz me" / "quiz recent" on it starts
+instantly. Runs with bounded concurrency and yields to interactive LLM calls;
+topics with a fresh cached quiz are skipped.
+"""
+import asyncio
+import os
+
+import agent_llm
+import quiz_cache
+
+QUIZ_PREFETCH = os.getenv("QUIZ_PREFETCH", "1").strip().lower() in {"1", "true", "yes"}
+QUIZ_PREFETCH_CONCURRENCY = int(os.getenv("QUIZ_PREFETCH_CONCURRENCY", "1"))
+QUIZ_PREFETCH_MAX_PENDING = int(os.getenv("QUIZ_PREFETCH_MAX_PENDING", "100"))
+
+_queue: asyncio.Queue | None = None
+_queued: set[str] = set()
+_workers: list[asyncio.Task] = []
+
+def start():
+    global _queue
+    if _workers:
+        return
+    _queue = asyncio.Queue()
+    for i in range(QUIZ_PREFETCH_CONCURRENCY):
+        _workers.append(asyncio.create_task(_worker(), name=f"quiz-prefetch-{i}"))
+
+async def stop():
+    for t in _workers:
+        t.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _queued.clear()
+
+def pending() -> int:
+    return len(_queued)
+
+def schedule(topic: str) -> bool:
+    """Queues a prefetch for topic. False if disabled, already queued, or the queue is full."""
+    if not QUIZ_PREFETCH or not quiz_cache.cacheable() or not (topic or "").strip():
+        return False
+    if not _workers:
+        start()
+    key = quiz_cache.cache_key(topic, quiz_cache.QUIZ_QUESTIONS)
+    if key in _queued or quiz_cache.inflight(topic) or len(_queued) >= QUIZ_PREFETCH_MAX_PENDING:
+        return False
+    _queued.add(key)
+    _queue.put_nowait((key, topic))
+    return True
+
+async def _worker():
+    while True:
+        key, topic = await _queue.get()
+        try:
+            # low priority: don't take an LLM slot while interactive calls are queued for one
+            while agent_llm.saturated():
+                await asyncio.sleep(0.5)
+            if not await quiz_cache.has_fresh(topic):
+                await quiz_cache.get_quiz(topic, shuffle=False)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("Quiz prefetch error:", repr(e))
+        finally:
+            _queued.discard(key)
@@ -0,0 +1,104 @@
+"""
+Cache of generated quizzes, keyed on (OPENAI_MODEL, n, normalized topic).
+Normalization is topics.normalize, so "EOQ model" and "eoq" share an entry.
+
+Two tiers: an in-process LRU in front of the quiz_cache table, both with a
+TTL. Concurrent requests for the same key share one upstream LLM call
+(singleflight), so a burst of "quiz me on EOQ" costs one generation.
+"""
+import asyncio
+import os
+import random
+
+import agent_llm
+import db_async
+import topics
+from cache import LRUCache, MISSING
+
+QUIZ_QUESTIONS = int(os.getenv("QUIZ_QUESTIONS", "5"))
+QUIZ_CACHE_TTL_SEC = int(os.getenv("QUIZ_CACHE_TTL_SEC", str(7 * 24 * 3600)))
+QUIZ_CACHE_MAX_ROWS = int(os.getenv("QUIZ_CACHE_MAX_ROWS", "5000"))
+QUIZ_CACHE_MEM_SIZE = int(os.getenv("QUIZ_CACHE_MEM_SIZE", "256"))
+QUIZ_CACHE_SHUFFLE = os.getenv("QUIZ_CACHE_SHUFFLE", "1").strip().lower() in {"1", "true", "yes"}
+
+_mem = LRUCache(QUIZ_CACHE_MEM_SIZE, ttl=QUIZ_CACHE_TTL_SEC, name="quiz")
+_inflight: dict[str, asyncio.Future] = {}
+
+def normalize_topic(topic: str) -> str:
+    return topics.normalize(topic)
+
+def cache_key(topic: str, n: int) -> str:
+    return f"{agent_llm.OPENAI_MODEL}|{n}|{normalize_topic(topic)}"
+
+def cacheable() -> bool:
+    # without an API key llm_generate_quiz returns a canned fallback; don't pin it
+    return bool(agent_llm.OPENAI_API_KEY)
+
+async def _lookup(key: str):
+    items = _mem.get(key)
+    if items is not MISSING:
+        return items
+    items = await db_async.get_cached_quiz(key, QUIZ_CACHE_TTL_SEC)
+    if items:
+        _mem.put(key, items)
+        await db_async.touch_cached_quiz(key)
+    return items
+
+async def has_fresh(topic: str, n: int = QUIZ_QUESTIONS) -> bool:
+    return bool(await _lookup(cache_key(topic, n)))
+
+async def store(topic: str, n: int, items: list[dict]):
+    if not items or not cacheable():
+        return
+    key = cache_key(topic, n)
+    _mem.put(key, items)
+    await db_async.put_cached_quiz(key, normalize_topic(topic), n, agent_llm.OPENAI_MODEL, items,
+                                   QUIZ_CACHE_MAX_ROWS, QUIZ_CACHE_TTL_SEC)
+
+async def _generate(topic: str, n: int) -> list[dict]:
+    items = await agent_llm.llm_generate_quiz(topic, n)
+    await store(topic, n, items)
+    return items
+
+def inflight(topic: str, n: int = QUIZ_QUESTIONS) -> bool:
+    return cache_key(topic, n) in _inflight
+
+def claim(topic: str, n: int = QUIZ_QUESTIONS) -> asyncio.Future | None:
+    """
+    Takes the singleflight slot for a generation the caller runs itself (a
+    streamed quiz), so get_quiz for the same key waits on it instead of calling
+    the LLM again. None when a generation is already in flight. The caller must
+    resolve the future with the items, or [] when generation failed.
+    """
+    key = cache_key(topic, n)
+    if key in _inflight:
+        return None
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
+    fut.add_done_callback(lambda _: _inflight.pop(key, None))
+    return fut
+
+async def get_quiz(topic: str, n: int = QUIZ_QUESTIONS, shuffle: bool = QUIZ_CACHE_SHUFFLE) -> list[dict]:
+    """
+    Returns a quiz for topic: from cache when fresh, else one shared LLM call.
+    A cached set comes back with its questions reshuffled when shuffle is on.
+    """
+    key = cache_key(topic, n)
+    items = await _lookup(key) if cacheable() else None
+    if items:
+        items = [dict(it) for it in items]
+        if shuffle:
+            random.shuffle(items)
+        return items
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_generate(topic, n))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield: one caller giving up mustn't cancel the generation others are waiting on
+    items = await asyncio.shield(task)
+    return [dict(it) for it in items]
+
+def stats() -> dict:
+    return {**_mem.stats(), "inflight": len(_inflight)}
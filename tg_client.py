@@ -0,0 +1,198 @@
+"""
+Shared Telegram Bot API client.
+
+One keep-alive httpx.AsyncClient for the whole process, plus an outbox that
+paces sends to Telegram's limits (global and per chat) and retries 429/5xx
+with retry_after-aware backoff. Handlers call enqueue() and move on; sends for
+the same chat still go out in order. deliver() is the same, but waits for the
+outcome, for callers that must know the message went out.
+"""
+import asyncio
+import os
+import random
+import time
+
+import httpx
+
+import metrics
+from lanes import Lanes
+
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").strip().rstrip("/")
+TG_TIMEOUT = float(os.getenv("TG_TIMEOUT", "15"))
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))   # messages/sec across all chats
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))       # messages/sec per chat
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))
+TG_SEND_WORKERS = int(os.getenv("TG_SEND_WORKERS", "16"))
+TG_QUEUE_MAX = int(os.getenv("TG_QUEUE_MAX", "10000"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "5"))
+
+class _Bucket:
+    """Token bucket; take() reserves a token and returns how long to wait for it."""
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+_token = ""
+_client: httpx.AsyncClient | None = None
+_outbox: Lanes | None = None
+_global_bucket = _Bucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+_chat_buckets: dict[str, _Bucket] = {}
+_background: set[asyncio.Task] = set()
+
+def configure(token: str):
+    global _token
+    _token = token
+
+def _ensure_started():
+    global _client, _outbox
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=TG_TIMEOUT,
+            limits=httpx.Limits(max_connections=TG_SEND_WORKERS * 2, max_keepalive_connections=TG_SEND_WORKERS),
+        )
+    if _outbox is None:
+        _outbox = Lanes(_deliver, workers=TG_SEND_WORKERS, max_pending=TG_QUEUE_MAX, name="tg-outbox")
+        _outbox.start()
+
+async def start(token: str):
+    configure(token)
+    _ensure_started()
+
+async def stop(timeout: float = 10.0):
+    """Flushes the outbox (up to timeout) and closes the shared client."""
+    global _client, _outbox
+    if _outbox is not None:
+        await _outbox.stop(timeout)
+        _outbox = None
+    if _background:
+        await asyncio.wait(list(_background), timeout=timeout)
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def queue_depth() -> int:
+    return _outbox.depth if _outbox else 0
+
+def _backoff(attempt: int) -> float:
+    return min(30.0, 0.5 * (2 ** attempt)) * (0.5 + random.random() / 2)
+
+async def call(method: str, payload: dict, timeout: float | None = None) -> dict:
+    """
+    Calls a Bot API method directly, retrying 429/5xx/network errors.
+    Returns the decoded Telegram response ({"ok": ..., ...}).
+    """
+    if not metrics.METRICS_ENABLED:
+        return await _call(method, payload, timeout)
+    t = time.perf_counter()
+    try:
+        body = await _call(method, payload, timeout)
+    except Exception:
+        metrics.tg_errors.inc(method, "exception")
+        raise
+    finally:
+        metrics.tg_seconds.observe(time.perf_counter() - t, method)
+    if not body.get("ok"):
+        metrics.tg_errors.inc(method, str(body.get("error_code")))
+    return body
+
+async def _call(method: str, payload: dict, timeout: float | None) -> dict:
+    _ensure_started()
+    url = f"{TELEGRAM_API_BASE}/bot{_token}/{method}"
+    for attempt in range(TG_MAX_RETRIES + 1):
+        last = attempt == TG_MAX_RETRIES
+        try:
+            r = await _client.post(url, json=payload, timeout=timeout or TG_TIMEOUT)
+        except httpx.TransportError:
+            if last:
+                raise
+            await asyncio.sleep(_backoff(attempt))
+            continue
+
+        try:
+            body = r.json()
+        except ValueError:
+            body = {"ok": False, "error_code": r.status_code, "description": r.text[:200]}
+
+        if (r.status_code == 429 or r.status_code >= 500) and not last:
+            retry_after = (body.get("parameters") or {}).get("retry_after")
+            await asyncio.sleep(float(retry_after) if retry_after else _backoff(attempt))
+            continue
+        return body
+    return body
+
+def _chat_bucket(chat_id: str) -> _Bucket:
+    b = _chat_buckets.get(chat_id)
+    if b is None:
+        if len(_chat_buckets) > 50000:
+            # forget chats whose bucket has refilled; they'd start full anyway
+            now = time.monotonic()
+            for k in [k for k, v in _chat_buckets.items() if v.tokens + (now - v.stamp) * v.rate >= v.burst]:
+                del _chat_buckets[k]
+        b = _chat_buckets[chat_id] = _Bucket(TG_CHAT_RATE, TG_CHAT_BURST)
+    return b
+
+async def _deliver(chat_id, job):
+    method, payload, done = job
+    ok = False
+    try:
+        delay = max(_chat_bucket(chat_id).take(), _global_bucket.take())
+        if delay:
+            await asyncio.sleep(delay)
+        body = await call(method, payload)
+        ok = bool(body.get("ok"))
+        if not ok:
+            print(f"Telegram {method} failed:", body.get("error_code"), body.get("description"))
+    finally:
+        if done is not None and not done.done():
+            done.set_result(ok)
+
+async def _call_logged(method: str, payload: dict):
+    try:
+        body = await call(method, payload)
+        if not body.get("ok"):
+            print(f"Telegram {method} failed:", body.get("error_code"), body.get("description"))
+    except Exception as e:
+        print(f"Telegram {method} error:", repr(e))
+
+def enqueue(method: str, payload: dict) -> bool:
+    """
+    Queues a Bot API call and returns immediately.
+    Calls with a chat_id are paced and kept in order per chat; others
+    (e.g. answerCallbackQuery) are fired straight away in the background.
+    """
+    _ensure_started()
+    metrics.tg_sends.inc(method)
+    chat_id = payload.get("chat_id")
+    if chat_id is None:
+        task = asyncio.create_task(_call_logged(method, payload))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+        return True
+    ok = _outbox.submit(str(chat_id), (method, payload, None))
+    if not ok:
+        print("Telegram outbox full, dropping", method, "for", chat_id)
+    return ok
+
+async def deliver(method: str, payload: dict) -> bool:
+    """
+    Queues a chat message like enqueue(), then waits until Telegram has taken
+    it. False if the outbox was full or the call failed after its retries.
+    """
+    _ensure_started()
+    metrics.tg_sends.inc(method)
+    done = asyncio.get_running_loop().create_future()
+    if not _outbox.submit(str(payload["chat_id"]), (method, payload, done)):
+        print("Telegram outbox full, dropping", method, "for", payload["chat_id"])
+        return False
+    return await done
@@ -0,0 +1,109 @@
+"""
+Topic normalization and near-duplicate matching (shingling + MinHash LSH).
+
+Users log the same subject in different words ("EOQ", "eoq model", "economic
+order quantity"). normalize() lowercases, drops filler words and plural s, so
+trivially different wordings become the same alias. acronym_keys() lets an
+acronym and its spelled-out form meet. Everything else goes through MinHash: a
+topic's shingles (its words plus character trigrams of the words run together,
+so "re-order point" still meets "reorder point") are reduced to a fixed-size
+signature. Two signatures agree in about
+the same fraction of positions as the shingle sets' Jaccard similarity.
+Signatures are cut into TOPIC_LSH_BANDS bands of TOPIC_LSH_ROWS values. Topics
+that share any band hash are candidates, so a lookup is one index seek per
+band rather than a scan.
+
+Pure functions only; the tables live in db.py (# --- Topic Clusters ---).
+"""
+import hashlib
+import os
+import re
+import struct
+import zlib
+from functools import lru_cache
+
+# 32 bands x 3 rows: candidates at Jaccard 0.5 are found ~99% of the time, at 0.3 ~58%.
+# Not configurable: stored signatures and band buckets are cut to this shape, so
+# changing it would silently stop new wordings from meeting existing clusters.
+TOPIC_LSH_BANDS = 32
+TOPIC_LSH_ROWS = 3
+# Estimated similarity at which a new wording joins an existing cluster
+TOPIC_MATCH_THRESHOLD = float(os.getenv("TOPIC_MATCH_THRESHOLD", "0.55"))
+# ... and down to which other clusters are reported as related
+TOPIC_RELATED_THRESHOLD = float(os.getenv("TOPIC_RELATED_THRESHOLD", "0.25"))
+
+FILLER = {
+    "a", "an", "the", "of", "on", "in", "to", "for", "and", "with", "about", "some", "more",
+    "what", "how", "is", "are", "basic", "basics", "intro", "introduction", "overview",
+    "concept", "concepts", "model", "models", "theory", "topic",
+}
+
+_PERMS = TOPIC_LSH_BANDS * TOPIC_LSH_ROWS
+# one 64-byte blake2b digest yields 16 independent 32-bit hashes; each salt gives 16 more.
+# Signatures are stored, so the salts must never change.
+_SALTS = [i.to_bytes(16, "little") for i in range(-(-_PERMS // 16))]
+_DIGEST = struct.Struct("<16I")
+
+def _singular(word: str) -> str:
+    return word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")) else word
+
+def normalize(topic: str) -> str:
+    """Lowercased singular words without punctuation or filler; "" if nothing is left."""
+    words = re.sub(r"[^\w\s]", " ", re.sub(r"['’]s\b", "", (topic or "").lower())).split()
+    kept = [_singular(w) for w in words if w not in FILLER] or words
+    if len(kept) > 2:
+        # "economic order quantity (EOQ)": the trailing acronym repeats the words before it
+        kept = [w for w in kept if w != "".join(x[0] for x in kept if x != w)]
+    return " ".join(kept)
+
+def _is_acronym(word: str) -> bool:
+    return 2 <= len(word) <= 6 and word.isalnum()
+
+def acronym_keys(norm: str) -> tuple[str | None, str | None]:
+    """
+    (key to look up, key to register) in the alias table, so an acronym and
+    its spelled-out form find each other. A single short word is looked up
+    among initials; a phrase's initials are looked up among acronyms.
+    """
+    words = norm.split()
+    if len(words) == 1:
+        return ("ini:" + words[0], "acr:" + words[0]) if _is_acronym(words[0]) else (None, None)
+    initials = "".join(w[0] for w in words)
+    return ("acr:" + initials, "ini:" + initials) if _is_acronym(initials) else (None, None)
+
+def shingles(norm: str) -> set[str]:
+    words = norm.split()
+    joined = "#" + "".join(words) + "#"
+    return set(words) | {joined[i:i + 3] for i in range(len(joined) - 2)}
+
+@lru_cache(maxsize=65536)
+def _hashes(shingle: str) -> tuple[int, ...]:
+    # trigrams recur across most topics, so this cache takes most of the hashing off new topics
+    data = shingle.encode()
+    out = []
+    for salt in _SALTS:
+        out.extend(_DIGEST.unpack(hashlib.blake2b(data, salt=salt).digest()))
+    return tuple(out)
+
+def signature(norm: str) -> tuple[int, ...]:
+    """MinHash signature: per hash function, the smallest hash over the topic's shingles."""
+    rows = [_hashes(sh) for sh in shingles(norm)]
+    if not rows:
+        return (0,) * _PERMS
+    return tuple(map(min, zip(*rows)))[:_PERMS]
+
+@lru_cache(maxsize=1024)
+def band_keys(sig: tuple[int, ...]) -> tuple[int, ...]:
+    """One bucket id per band; equal buckets in any band make two topics candidates."""
+    data, width = pack(sig), 4 * TOPIC_LSH_ROWS
+    return tuple(zlib.crc32(data[i:i + width]) for i in range(0, len(data), width))
+
+def similarity(a: tuple[int, ...], b: tuple[int, ...]) -> float:
+    """Estimated Jaccard similarity of the topics behind two signatures."""
+    return sum(x == y for x, y in zip(a, b)) / _PERMS
+
+def pack(sig: tuple[int, ...]) -> bytes:
+    return struct.pack(f"<{_PERMS}I", *sig)
+
+def unpack(blob: bytes) -> tuple[int, ...]:
+    return struct.unpack(f"<{_PERMS}I", blob)